@@ -1,10 +1,15 @@
 import os
+import asyncio
+import json
+import threading
 import torch
 from transformers import pipeline
 import time
 import traceback
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import numpy as np
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import uvicorn
@@ -13,6 +18,28 @@ from pyngrok import ngrok
 
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 
+from scheduler import BatchScheduler, QueueFullError, sampling_key
+from streaming import AsyncTextStreamer, sse_event
+from cache import ResponseCache, make_cache_key
+from prefix_cache import PrefixCache, generate_with_prefix
+from model_registry import ModelRegistry, model_memory_footprint, safetensors_parameter_count
+from quantization import activations_depend_on_batch, load_int8_pipeline
+from fake_backend import load_fake_embedding_pipeline, load_fake_pipeline
+from speculative import SpeculativeDecoder, load_draft_model
+from stopping import RequestControl, stopping_criteria_for
+from warmup import compile_pipeline, save_compile_artifacts, warm_up_pipeline
+from workers import process_memory, serve_forked
+from thread_tuning import candidate_splits, parse_split, tune_threads
+from sessions import SessionStore, commit_turn, run_chat_turn
+from multi_sample import generate_samples, rank_candidates
+from load_policy import PRIORITIES, LoadPolicy, LoadSheddingError
+from fairness import DEFAULT_CLIENT_ID, ClientQuotas, QuotaExceededError
+from embeddings import (
+    EMBEDDING_PROMPT_NAMES, ENCODING_FORMATS, encode_embeddings, load_embedding_pipeline,
+)
+import metrics
+from metrics import GenerationTimer
+
 # --- 設定 ---
 # モデル名を設定
 # MODEL_NAME = "google/gemma-2-2b-jpn-it"  # お好みのモデルに変更可能です
@@ -20,10 +47,188 @@ MODEL_NAME = "elyza/ELYZA-japanese-CodeLlama-7b-instruct" # デカすぎて無
 # MODEL_NAME = "AXCXEPT/EZO-gemma-2-2b-jpn-it" #他のモデルを試した
 print(f"モデル名を設定: {MODEL_NAME}")
 
+# 投機的デコーディングで候補トークンを提案する小さなドラフトモデル（MODEL_NAME と組にして使う。未設定なら無効）
+# 同じトークナイザー（語彙）のモデルが望ましいが、異なる場合もトークナイザー間で変換しながら検証する
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME") or None
+# DRAFT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+NUM_ASSISTANT_TOKENS = int(os.environ.get("NUM_ASSISTANT_TOKENS", 5))  # 1回に提案させる候補トークン数の初期値
+
+# モデルの読み込み方法: "bits"（bitsandbytesの4bit量子化、CUDAが必要）/ "int8"（CPU向けのint8動的量子化）/
+# "bf16"（量子化しない）/ "fake"（モデルを読み込まずに決まった速度で応答する、ベンチマーク用）/
+# "auto"（CUDAがあれば "bits"、無ければ "int8"）
+LOAD_MODE = os.environ.get("LOAD_MODE", "auto")
+# LOAD_MODE="fake" のときの生成速度（トークン/秒）とプレフィルの速度（トークン/秒）
+FAKE_TOKENS_PER_SECOND = float(os.environ.get("FAKE_TOKENS_PER_SECOND", 50))
+FAKE_PREFILL_TOKENS_PER_SECOND = float(os.environ.get("FAKE_PREFILL_TOKENS_PER_SECOND", 2000))
+
+# 1つのプロセスで提供するモデルの一覧（先頭がデフォルト）。リクエストの "model" で選択する
+MODEL_NAMES = [name.strip() for name in os.environ.get(
+    "MODEL_NAMES",
+    ",".join([MODEL_NAME, "google/gemma-2-2b-jpn-it", "AXCXEPT/EZO-gemma-2-2b-jpn-it"]),
+).split(",") if name.strip()]
+# 常駐させるモデルの合計メモリの上限（GB）。超える場合は最も使われていないモデルから解放する（0で無制限）
+MODEL_MEMORY_BUDGET_GB = float(os.environ.get("MODEL_MEMORY_BUDGET_GB", 12))
+
+# マイクロバッチングの設定（環境変数で上書き可能）
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))  # 1回の推論にまとめる最大リクエスト数
+BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", 10))  # 後続リクエストを待つ最大時間（ミリ秒）
+# 推論スレッド数と待ち行列の上限（上限を超えたリクエストは503で即座に拒否する）
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 64))
+# 決定的な生成（do_sample=False）の応答キャッシュ
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", 3600))
+# 登録済みプレフィックス（共通のシステムプロンプトなど）のKVキャッシュに使うメモリの上限（MB）
+PREFIX_CACHE_MAX_MB = float(os.environ.get("PREFIX_CACHE_MAX_MB", 512))
+# モデルの読み込みに失敗した場合、次の読み込みを試みるまでの間隔（秒）
+MODEL_RETRY_INTERVAL = float(os.environ.get("MODEL_RETRY_INTERVAL", 30))
+# リクエストで deadline_seconds を指定しない場合の、受信から生成打ち切りまでの時間（秒）。0で無制限
+DEFAULT_DEADLINE_SECONDS = float(os.environ.get("DEFAULT_DEADLINE_SECONDS", 300))
+# 推論結果を待つ間、クライアントの切断を確認する間隔（秒）
+DISCONNECT_POLL_SECONDS = 0.5
+# 起動時のウォームアップ: これらの長さ（トークン数）のプロンプトで推論を済ませてから /ready を成功させる（空文字で無効）
+WARMUP_PROMPT_LENGTHS = [int(n) for n in os.environ.get("WARMUP_PROMPT_LENGTHS", "16,128,512").split(",") if n.strip()]
+WARMUP_BATCH_SIZES = [int(n) for n in os.environ.get("WARMUP_BATCH_SIZES", "1").split(",") if n.strip()]
+WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", 8))
+# torch.compile のモード（"default" / "reduce-overhead" / "max-autotune"）。空文字ならコンパイルしない
+COMPILE_MODE = os.environ.get("COMPILE_MODE", "")
+# コンパイル結果を保存し、再起動時に再利用するディレクトリ
+COMPILE_CACHE_DIR = os.environ.get(
+    "COMPILE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".torch_compile_cache")
+)
+# リクエストで max_new_tokens を省略（null）した場合に生成する最大トークン数
+DEFAULT_MAX_NEW_TOKENS = int(os.environ.get("DEFAULT_MAX_NEW_TOKENS", 512))
+# 負荷に応じた生成トークン数の削減: 待ち行列がこの長さを超えると max_new_tokens を少しずつ減らし始め、
+# DEGRADE_QUEUE_FULL 件で最大まで（要求の DEGRADE_MIN_BUDGET_FACTOR 倍、ただし DEGRADE_MIN_MAX_NEW_TOKENS 以上）減らす
+DEGRADE_QUEUE_START = int(os.environ.get("DEGRADE_QUEUE_START", 4))
+DEGRADE_QUEUE_FULL = int(os.environ.get("DEGRADE_QUEUE_FULL", 32))
+# 1系列あたりのデコード速度（トークン/秒）がこれを下回っても減らし始め、DEGRADE_MIN_TOKENS_PER_SECOND で最大になる（0で無効）
+DEGRADE_TARGET_TOKENS_PER_SECOND = float(os.environ.get("DEGRADE_TARGET_TOKENS_PER_SECOND", 0))
+DEGRADE_MIN_TOKENS_PER_SECOND = float(os.environ.get("DEGRADE_MIN_TOKENS_PER_SECOND", 0))
+DEGRADE_MIN_BUDGET_FACTOR = float(os.environ.get("DEGRADE_MIN_BUDGET_FACTOR", 0.25))
+DEGRADE_MIN_MAX_NEW_TOKENS = int(os.environ.get("DEGRADE_MIN_MAX_NEW_TOKENS", 16))
+# 負荷（0〜1）がこの値以上になったら、優先度 "low" / "normal" のリクエストを503で断る（"high" は断らない）
+SHED_LOW_PRESSURE = float(os.environ.get("SHED_LOW_PRESSURE", 0.5))
+SHED_NORMAL_PRESSURE = float(os.environ.get("SHED_NORMAL_PRESSURE", 1.0))
+# クライアントごとの重みと上限（JSON）。例: {"ui": {"weight": 4}, "batch-eval": {"weight": 1, "max_concurrency": 4,
+# "tokens_per_second": 200}}。weight は同じ優先度の中での取り出しの比率、max_concurrency は待ち＋実行中の件数の上限、
+# tokens_per_second は max_new_tokens の合計の上限（burst_seconds 秒分まではまとめて使える）。超えた分は429で断る
+CLIENT_QUOTAS = json.loads(os.environ.get("CLIENT_QUOTAS", "{}"))
+# CLIENT_QUOTAS に無いクライアント（client_id を指定しないリクエストを含む）に適用する上限（JSON）
+DEFAULT_CLIENT_QUOTA = json.loads(os.environ.get("DEFAULT_CLIENT_QUOTA", "{}"))
+# /chat の会話セッション: この秒数使われなかった会話は削除し、KVキャッシュの合計がこの上限（MB）を超えたら
+# 最も古く使われた会話のキャッシュから解放する（履歴は残り、次のターンで全体をプレフィルし直す）
+CHAT_SESSION_IDLE_SECONDS = float(os.environ.get("CHAT_SESSION_IDLE_SECONDS", 1800))
+CHAT_SESSION_MAX_MB = float(os.environ.get("CHAT_SESSION_MAX_MB", 1024))
+# リクエストが無い間も、この秒数ごとに使われなくなった会話を削除する（0なら次のリクエストのときだけ削除する）
+CHAT_SESSION_SWEEP_SECONDS = float(os.environ.get("CHAT_SESSION_SWEEP_SECONDS", 60))
+# 同時に実行する推論の数（INFERENCE_WORKERS）と、推論1つあたりの torch のスレッド数の組み合わせ:
+# "off"（INFERENCE_WORKERS と torch の既定のスレッド数のまま）/ "2x4" のような手動指定（同時実行数xスレッド数）/
+# "auto"（デフォルトモデルの読み込み後に候補を実測して選ぶ）。"auto" は候補ごとに「同時実行数×2回」の短い生成を
+# デフォルトモデルで行うため、その間 /ready が遅れる（CPUで7Bモデルなら数分）。一度 "auto" で選んだ結果を
+# "2x4" のように指定して使うことを想定している
+THREAD_SPLIT = os.environ.get("THREAD_SPLIT", "off")
+# "auto" のとき、1件あたりの遅延（p95、秒）がこれを超える組み合わせは選ばない（0なら遅延は見ない）
+THREAD_TUNING_LATENCY_TARGET = float(os.environ.get("THREAD_TUNING_LATENCY_TARGET", 0))
+# "auto" で試す同時実行数の上限（1, 2, 4, ... と倍にしながら試す）
+THREAD_TUNING_MAX_WORKERS = int(os.environ.get("THREAD_TUNING_MAX_WORKERS", 4))
+# torch の inter-op スレッド数（演算どうしの並列化。0なら torch の既定値）
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0))
+# /embeddings で使う埋め込みモデル（sentence-transformers。最初のリクエストで読み込む）と、入力の最大トークン数
+EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", "infly/inf-retriever-v1-1.5b")
+EMBEDDING_MAX_SEQ_LENGTH = int(os.environ.get("EMBEDDING_MAX_SEQ_LENGTH", 8192))
+# 同時に届いたリクエストのテキストを、BATCH_WAIT_MS の間に最大 EMBEDDING_MAX_BATCH_SIZE 件まで1回の encode にまとめる
+# （encode の中では EMBEDDING_BATCH_SIZE 件ずつのミニバッチで計算する）
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 256))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5))
+# encode を待てるテキスト数の上限（超える場合は503で断る。1リクエストのテキスト数もこれが上限）
+EMBEDDING_MAX_QUEUE_SIZE = int(os.environ.get("EMBEDDING_MAX_QUEUE_SIZE", 4096))
+# 1リクエストで生成できる候補の数（n / best_of）の上限
+MAX_SAMPLES = int(os.environ.get("MAX_SAMPLES", 16))
+# 複数ワーカーで起動する場合に、埋め込みモデルも fork 前に読み込んで共有するか
+EMBEDDING_PRELOAD = os.environ.get("EMBEDDING_PRELOAD", "0") == "1"
+# HTTPを処理するワーカープロセスの数。2以上なら、デフォルトモデルを読み込んでから fork して重みを共有する
+WORKERS = int(os.environ.get("WORKERS", 1))
+
 # --- モデル設定クラス ---
 class Config:
-    def __init__(self, model_name=MODEL_NAME):
+    def __init__(self, model_name=MODEL_NAME, max_batch_size=MAX_BATCH_SIZE, batch_wait_ms=BATCH_WAIT_MS,
+                 inference_workers=INFERENCE_WORKERS, max_queue_size=MAX_QUEUE_SIZE,
+                 cache_max_entries=CACHE_MAX_ENTRIES, cache_ttl_seconds=CACHE_TTL_SECONDS,
+                 prefix_cache_max_mb=PREFIX_CACHE_MAX_MB, model_retry_interval=MODEL_RETRY_INTERVAL,
+                 model_names=None, model_memory_budget_gb=MODEL_MEMORY_BUDGET_GB,
+                 draft_model_name=DRAFT_MODEL_NAME, num_assistant_tokens=NUM_ASSISTANT_TOKENS,
+                 default_deadline_seconds=DEFAULT_DEADLINE_SECONDS, default_max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+                 load_mode=LOAD_MODE,
+                 warmup_prompt_lengths=WARMUP_PROMPT_LENGTHS, warmup_batch_sizes=WARMUP_BATCH_SIZES,
+                 warmup_max_new_tokens=WARMUP_MAX_NEW_TOKENS, compile_mode=COMPILE_MODE,
+                 compile_cache_dir=COMPILE_CACHE_DIR, fake_tokens_per_second=FAKE_TOKENS_PER_SECOND,
+                 fake_prefill_tokens_per_second=FAKE_PREFILL_TOKENS_PER_SECOND, workers=WORKERS,
+                 chat_session_idle_seconds=CHAT_SESSION_IDLE_SECONDS, chat_session_max_mb=CHAT_SESSION_MAX_MB,
+                 chat_session_sweep_seconds=CHAT_SESSION_SWEEP_SECONDS,
+                 degrade_queue_start=DEGRADE_QUEUE_START, degrade_queue_full=DEGRADE_QUEUE_FULL,
+                 degrade_target_tokens_per_second=DEGRADE_TARGET_TOKENS_PER_SECOND,
+                 degrade_min_tokens_per_second=DEGRADE_MIN_TOKENS_PER_SECOND,
+                 degrade_min_budget_factor=DEGRADE_MIN_BUDGET_FACTOR, degrade_min_max_new_tokens=DEGRADE_MIN_MAX_NEW_TOKENS,
+                 shed_low_pressure=SHED_LOW_PRESSURE, shed_normal_pressure=SHED_NORMAL_PRESSURE,
+                 client_quotas=None, default_client_quota=None, thread_split=THREAD_SPLIT,
+                 thread_tuning_latency_target=THREAD_TUNING_LATENCY_TARGET,
+                 thread_tuning_max_workers=THREAD_TUNING_MAX_WORKERS, torch_interop_threads=TORCH_INTEROP_THREADS,
+                 embedding_model_name=EMBEDDING_MODEL_NAME, embedding_max_seq_length=EMBEDDING_MAX_SEQ_LENGTH,
+                 embedding_max_batch_size=EMBEDDING_MAX_BATCH_SIZE, embedding_batch_size=EMBEDDING_BATCH_SIZE,
+                 embedding_batch_wait_ms=EMBEDDING_BATCH_WAIT_MS, embedding_max_queue_size=EMBEDDING_MAX_QUEUE_SIZE,
+                 embedding_preload=EMBEDDING_PRELOAD, max_samples=MAX_SAMPLES):
         self.MODEL_NAME = model_name
+        self.LOAD_MODE = load_mode
+        self.FAKE_TOKENS_PER_SECOND = fake_tokens_per_second
+        self.FAKE_PREFILL_TOKENS_PER_SECOND = fake_prefill_tokens_per_second
+        self.DRAFT_MODEL_NAME = draft_model_name
+        self.NUM_ASSISTANT_TOKENS = num_assistant_tokens
+        # デフォルトモデルを先頭にして、他の提供モデルを続ける
+        self.MODEL_NAMES = [model_name] + [name for name in (model_names or MODEL_NAMES) if name != model_name]
+        self.MODEL_MEMORY_BUDGET_GB = model_memory_budget_gb
+        self.MAX_BATCH_SIZE = max_batch_size
+        self.BATCH_WAIT_MS = batch_wait_ms
+        self.INFERENCE_WORKERS = inference_workers
+        self.MAX_QUEUE_SIZE = max_queue_size
+        self.CACHE_MAX_ENTRIES = cache_max_entries
+        self.CACHE_TTL_SECONDS = cache_ttl_seconds
+        self.PREFIX_CACHE_MAX_MB = prefix_cache_max_mb
+        self.MODEL_RETRY_INTERVAL = model_retry_interval
+        self.DEFAULT_DEADLINE_SECONDS = default_deadline_seconds
+        self.DEFAULT_MAX_NEW_TOKENS = default_max_new_tokens
+        self.WARMUP_PROMPT_LENGTHS = warmup_prompt_lengths
+        self.WARMUP_BATCH_SIZES = warmup_batch_sizes
+        self.WARMUP_MAX_NEW_TOKENS = warmup_max_new_tokens
+        self.COMPILE_MODE = compile_mode
+        self.COMPILE_CACHE_DIR = compile_cache_dir
+        self.WORKERS = workers
+        self.CHAT_SESSION_IDLE_SECONDS = chat_session_idle_seconds
+        self.CHAT_SESSION_MAX_MB = chat_session_max_mb
+        self.CHAT_SESSION_SWEEP_SECONDS = chat_session_sweep_seconds
+        self.DEGRADE_QUEUE_START = degrade_queue_start
+        self.DEGRADE_QUEUE_FULL = degrade_queue_full
+        self.DEGRADE_TARGET_TOKENS_PER_SECOND = degrade_target_tokens_per_second
+        self.DEGRADE_MIN_TOKENS_PER_SECOND = degrade_min_tokens_per_second
+        self.DEGRADE_MIN_BUDGET_FACTOR = degrade_min_budget_factor
+        self.DEGRADE_MIN_MAX_NEW_TOKENS = degrade_min_max_new_tokens
+        self.SHED_LOW_PRESSURE = shed_low_pressure
+        self.SHED_NORMAL_PRESSURE = shed_normal_pressure
+        self.CLIENT_QUOTAS = client_quotas if client_quotas is not None else CLIENT_QUOTAS
+        self.DEFAULT_CLIENT_QUOTA = default_client_quota if default_client_quota is not None else DEFAULT_CLIENT_QUOTA
+        self.THREAD_SPLIT = thread_split.strip().lower()
+        self.THREAD_TUNING_LATENCY_TARGET = thread_tuning_latency_target
+        self.THREAD_TUNING_MAX_WORKERS = thread_tuning_max_workers
+        self.TORCH_INTEROP_THREADS = torch_interop_threads
+        self.EMBEDDING_MODEL_NAME = embedding_model_name
+        self.EMBEDDING_MAX_SEQ_LENGTH = embedding_max_seq_length
+        self.EMBEDDING_MAX_BATCH_SIZE = embedding_max_batch_size
+        self.EMBEDDING_BATCH_SIZE = embedding_batch_size
+        self.EMBEDDING_BATCH_WAIT_MS = embedding_batch_wait_ms
+        self.EMBEDDING_MAX_QUEUE_SIZE = embedding_max_queue_size
+        self.EMBEDDING_PRELOAD = embedding_preload
+        self.MAX_SAMPLES = max_samples
 
 config = Config(MODEL_NAME)
 
@@ -51,48 +256,119 @@ class Message(BaseModel):
 # 直接プロンプトを使用した簡略化されたリクエスト
 class SimpleGenerationRequest(BaseModel):
     prompt: str
+    model: Optional[str] = None  # 省略時はデフォルトモデル（Config.MODEL_NAME）
     max_new_tokens: Optional[int] = 512
     do_sample: Optional[bool] = True
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
+    use_cache: Optional[bool] = True  # Falseの場合は応答キャッシュを使わずに必ず推論する
+    speculative: Optional[bool] = True  # ドラフトモデルが設定されている場合に投機的デコーディングを使う
+    deadline_seconds: Optional[float] = None  # 受信からこの秒数で生成を打ち切る（省略時はサーバーの既定値）
+    stop: Optional[List[str]] = None  # いずれかの文字列が生成されたら打ち切る（応答には含めない）
+    priority: Optional[str] = "normal"  # "high" / "normal" / "low"。負荷が高いときは低いものから断られる
+    client_id: Optional[str] = None  # 同じ優先度の中でクライアント間の公平性と上限を判定する単位（省略時は "anonymous"）
+    n: Optional[int] = 1  # 返す候補の数（/generate のみ。プロンプトのプレフィルは1回だけ行う）
+    best_of: Optional[int] = None  # この数の候補を生成し、1トークンあたりの対数確率が高い順に n 個を返す
 
 class GenerationResponse(BaseModel):
     generated_text: str
     response_time: float
+    cached: Optional[bool] = False
+    model: Optional[str] = None
+    max_new_tokens: Optional[int] = None  # 負荷に応じて実際に適用した生成トークン数の上限
+    speculative: Optional[Dict[str, Any]] = None  # 投機的デコーディングの受理率と推定速度向上率
+    finish_reason: Optional[str] = None  # "eos" / "length" / "stop" / "deadline" / "cancelled"
+    # n / best_of を指定した場合の候補（text, finish_reason, completion_tokens, logprob）。generated_text は先頭の候補
+    candidates: Optional[List[Dict[str, Any]]] = None
+    prompt_tokens: Optional[int] = None
 
-# --- モデル関連の関数 ---
-# モデルのグローバル変数
-model = None
+# 複数プロンプトをまとめて生成するリクエスト（各要素で生成パラメータを個別に指定可能）
+class BatchGenerationRequest(BaseModel):
+    items: List[SimpleGenerationRequest]
+
+class BatchGenerationResponse(BaseModel):
+    results: List[GenerationResponse]
+    total_time: float
 
-def load_model():
+# 会話を続けるリクエスト（session_id を省略すると新しい会話を始める）
+class ChatRequest(BaseModel):
+    messages: List[Message]  # 前のターンまでの履歴はサーバーが保持しているので、今回追加するメッセージだけを送る
+    session_id: Optional[str] = None
+    model: Optional[str] = None  # 新しい会話を始めるときのモデル（省略時はデフォルトモデル）
+    max_new_tokens: Optional[int] = 512
+    do_sample: Optional[bool] = True
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = 0.9
+    deadline_seconds: Optional[float] = None
+    stop: Optional[List[str]] = None
+    priority: Optional[str] = "normal"
+    client_id: Optional[str] = None
+
+class ChatResponse(BaseModel):
+    session_id: str
+    message: Message
+    response_time: float
+    model: str
+    max_new_tokens: int  # 負荷に応じて実際に適用した生成トークン数の上限
+    finish_reason: Optional[str] = None
+    prompt_tokens: int  # 履歴全体のトークン数
+    reused_tokens: int  # 前のターンのKVキャッシュを再利用したトークン数
+    prefilled_tokens: int  # このターンで新たにプレフィルしたトークン数
+
+# 埋め込みのリクエスト（mode="query" は検索クエリ、"document" は検索対象の文書）
+class EmbeddingRequest(BaseModel):
+    texts: List[str]
+    mode: Optional[str] = "document"
+    model: Optional[str] = None  # 省略時は Config.EMBEDDING_MODEL_NAME
+    normalize: Optional[bool] = False  # True の場合は長さ1に正規化する（内積がコサイン類似度になる）
+    encoding_format: Optional[str] = "float"  # "float" / "base64"（float32）/ "float16"（float16 を base64）
+
+class EmbeddingResponse(BaseModel):
+    model: str
+    mode: str
+    count: int
+    dimensions: int
+    encoding_format: str
+    embeddings: Optional[List[List[float]]] = None  # encoding_format="float" の場合
+    data: Optional[str] = None  # それ以外の場合: (count, dimensions) の行優先のバイト列を base64 にしたもの
+    dtype: Optional[str] = None  # data の numpy の dtype（"<f4" / "<f2"）
+    response_time: float
+
+class PrefixRequest(BaseModel):
+    prefix: str
+    model: Optional[str] = None
+
+# --- モデル関連の関数 ---
+def load_model(model_name=None):
     """推論用のLLMモデルを読み込む"""
-    global model  # グローバル変数を更新するために必要
+    model_name = model_name or config.MODEL_NAME
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"使用デバイス: {device}")
+        model_registry.set_stage(model_name, "パイプラインを構築中")
         pipe = pipeline(
             "text-generation",
-            model=config.MODEL_NAME,
+            model=model_name,
             model_kwargs={"torch_dtype": torch.bfloat16},
             device=device
         )
-        print(f"モデル '{config.MODEL_NAME}' の読み込みに成功しました")
-        model = pipe  # グローバル変数を更新
+        print(f"モデル '{model_name}' の読み込みに成功しました")
         return pipe
     except Exception as e:
-        error_msg = f"モデル '{config.MODEL_NAME}' の読み込みに失敗: {e}"
+        error_msg = f"モデル '{model_name}' の読み込みに失敗: {e}"
         print(error_msg)
         traceback.print_exc()  # 詳細なエラー情報を出力
         return None
 
 # 量子化ロード関数
-def load_model_bits():
-    global model
+def load_model_bits(model_name=None):
+    model_name = model_name or config.MODEL_NAME
     try:
-        print(f"量子化してモデルを読み込みます: {config.MODEL_NAME}")
+        print(f"量子化してモデルを読み込みます: {model_name}")
 
         # トークナイザー
-        tokenizer = AutoTokenizer.from_pretrained(config.MODEL_NAME)
+        model_registry.set_stage(model_name, "トークナイザーを読み込み中")
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
 
         # 4bit量子化の設定
         bnb_config = BitsAndBytesConfig(
@@ -102,12 +378,14 @@ def load_model_bits():
             bnb_4bit_compute_dtype=torch.float16
         )
 
+        model_registry.set_stage(model_name, "量子化した重みを読み込み中")
         model_base = AutoModelForCausalLM.from_pretrained(
-            config.MODEL_NAME,
+            model_name,
             quantization_config=bnb_config,
             device_map="auto"
         )
 
+        model_registry.set_stage(model_name, "パイプラインを構築中")
         pipe = pipeline(
             "text-generation",
             model=model_base,
@@ -115,7 +393,6 @@ def load_model_bits():
         )
 
         print("量子化モデルの読み込みに成功しました。")
-        model = pipe
         return pipe
 
     except Exception as e:
@@ -123,6 +400,68 @@ def load_model_bits():
         traceback.print_exc()
         return None
 
+# CPU向けのint8量子化ロード関数
+def load_model_int8(model_name=None):
+    """Linear層をint8に動的量子化してCPU上に読み込む（bitsandbytes・CUDAが無い環境向け）"""
+    model_name = model_name or config.MODEL_NAME
+    try:
+        print(f"int8に動的量子化してモデルを読み込みます: {model_name}")
+        pipe = load_int8_pipeline(model_name, on_stage=lambda stage: model_registry.set_stage(model_name, stage))
+        print("int8量子化モデルの読み込みに成功しました。")
+        return pipe
+    except Exception as e:
+        print(f"モデルのint8量子化読み込みに失敗しました: {e}")
+        traceback.print_exc()
+        return None
+
+# ベンチマーク用の偽のバックエンド
+def load_model_fake(model_name=None):
+    """モデルを読み込まずに、設定した速度で決まった応答を返す偽のパイプラインを作る"""
+    model_name = model_name or config.MODEL_NAME
+    print(f"偽のバックエンドを使用します: {model_name} ({config.FAKE_TOKENS_PER_SECOND}トークン/秒)")
+    return load_fake_pipeline(config.FAKE_TOKENS_PER_SECOND, config.FAKE_PREFILL_TOKENS_PER_SECOND)
+
+# 読み込み方法（Config.LOAD_MODE）ごとの読み込み関数。モデル名を受け取り、text-generation パイプラインと
+# 同じように呼び出せるオブジェクト（失敗時は None）を返す関数を登録すれば、別の推論バックエンドも使える
+MODEL_LOADERS = {
+    # load_model関数を呼び出して通常の精度で読み込む場合
+    "bf16": lambda model_name: load_model(model_name),
+    # load_model_bits関数を呼び出し、量子化モデルを読み込む
+    "bits": lambda model_name: load_model_bits(model_name),
+    # load_model_int8関数を呼び出し、CPU上でint8に量子化して読み込む
+    "int8": lambda model_name: load_model_int8(model_name),
+    # load_model_fake関数を呼び出し、モデルを使わずに性能を測る
+    "fake": lambda model_name: load_model_fake(model_name),
+}
+
+# 読み込み方法ごとの、読み込み中に1パラメータあたりに必要なメモリ量（バイト）の目安
+# （int8 は bf16 で読み込んでから変換するため、ピークは bf16 と同じ）
+LOAD_BYTES_PER_PARAMETER = {"bf16": 2, "bits": 0.5, "int8": 2, "fake": 0}
+
+def estimate_model_memory(model_name):
+    """初めて読み込むモデルのメモリ量を、safetensors のパラメータ数と読み込み方法から見積もる（分からなければ None）"""
+    bytes_per_parameter = LOAD_BYTES_PER_PARAMETER.get(resolve_load_mode(config.LOAD_MODE))
+    if not bytes_per_parameter:
+        return None
+    count = safetensors_parameter_count(model_name)
+    return int(count * bytes_per_parameter) if count else None
+
+def resolve_load_mode(load_mode):
+    """"auto" の場合は、CUDAがあれば bitsandbytes の4bit量子化、無ければ int8 動的量子化を選ぶ"""
+    if load_mode == "auto":
+        return "bits" if torch.cuda.is_available() else "int8"
+    return load_mode
+
+def prepare_pipeline_for_batching(pipe):
+    """複数プロンプトをパディングして1バッチで推論できるようにトークナイザーを設定する"""
+    tokenizer = pipe.tokenizer
+    if tokenizer.pad_token_id is None:
+        # パディングトークンが無いモデルではEOSトークンで代用する
+        tokenizer.pad_token_id = pipe.model.config.eos_token_id
+    # デコーダのみのモデルは左側にパディングしないと生成位置がずれる
+    tokenizer.padding_side = "left"
+    return pipe
+
 
 def extract_assistant_response(outputs, user_prompt):
     """モデルの出力からアシスタントの応答を抽出する"""
@@ -173,15 +512,452 @@ def extract_assistant_response(outputs, user_prompt):
 
     return assistant_response
 
+def count_tokens(pipe, texts):
+    """テキストのトークン数の合計を返す（メトリクス用）"""
+    return sum(len(pipe.tokenizer(text, add_special_tokens=False).input_ids) for text in texts)
+
+def speculative_decoder_for(model_name, params):
+    """投機的デコーディングを使う場合はドラフトモデルの組を、使わない場合は None を返す"""
+    if not params.get("speculative", True):
+        return None
+    return speculative_decoders.get(model_name)
+
+def finish_result(model_name, pipe, control, text, **extra):
+    """停止文字列での切り詰めと打ち切り理由の確定を行い、1件分の応答を作る"""
+    text, dropped = control.finish(text)
+    if control.finish_reason == "cancelled":
+        # 切断したクライアントのために生成したトークンは誰にも届かない
+        metrics.WASTED_TOKENS.inc(control.generated_tokens, model=model_name, reason="cancelled")
+    elif dropped:
+        metrics.WASTED_TOKENS.inc(count_tokens(pipe, [dropped]), model=model_name, reason="stop")
+    metrics.FINISH_REASONS.inc(model=model_name, reason=control.finish_reason)
+    return {"generated_text": text, "finish_reason": control.finish_reason, **extra}
+
+def cacheable_result(result):
+    """
+    応答キャッシュに保存できる生成結果か（期限切れ・切断で途中までになったものや、
+    int8 動的量子化のモデルで他のプロンプトとまとめて推論した、バッチに左右される結果は保存しない）
+    """
+    return result["finish_reason"] in ("eos", "length") and not result.get("batch_dependent")
+
+def observe_generation(model_name, timer, prompt_tokens, completion_tokens):
+    """生成の時間とトークン数をメトリクスに記録し、負荷の判定に使う1系列あたりのデコード速度を更新する"""
+    metrics.observe_generation(model_name, timer, prompt_tokens, completion_tokens)
+    # GenerationTimer はデコードのステップ数（1系列あたりのトークン数）、投機的デコーディングは1件分のトークン数
+    sequence_tokens = timer.steps - 1 if isinstance(timer, GenerationTimer) else completion_tokens
+    load_policy.observe_decode(sequence_tokens, timer.decode_time)
+
+def run_speculative_generation(decoder, model_name, prompt, params, control):
+    """ドラフトモデルを使って1件分を生成し、受理率と推定速度向上率を記録する"""
+    stopping_criteria = stopping_criteria_for(decoder.pipe, [control], [prompt])
+    text, run = decoder.generate(prompt, {**params, "stopping_criteria": stopping_criteria})
+    observe_generation(model_name, run, count_tokens(decoder.pipe, [prompt]), run.new_tokens)
+    metrics.observe_speculative(model_name, run)
+    print(f"投機的デコーディング: 受理率={run.acceptance_rate}, 推定速度向上率={run.estimated_speedup}")
+    return finish_result(model_name, decoder.pipe, control, text, speculative=run.info())
+
+def run_generation_batch(model_name, prompts, params, controls=None):
+    """
+    同じモデル・同じ生成パラメータのプロンプト群を1回のパディング済みバッチとして推論する
+
+    Args:
+        controls (list, optional): プロンプトごとの打ち切り条件（RequestControl）。None の要素は条件なし
+
+    Returns:
+        list: プロンプトごとの {"generated_text": 応答, "finish_reason": 打ち切り理由, ...}
+            （投機的デコーディングの場合はその統計を含む。int8 動的量子化のモデルで、1件だけの通常の推論と
+            出力が変わりうる方法で生成した場合は batch_dependent=True）
+    """
+    pipe = model_registry.get(model_name)
+    if pipe is None:
+        raise RuntimeError(f"モデル '{model_name}' は解放されたため利用できません。")
+    decoder = speculative_decoder_for(model_name, params)
+    params = {k: v for k, v in params.items() if k != "speculative"}
+    controls = [
+        control or RequestControl(max_new_tokens=params.get("max_new_tokens"))
+        for control in (controls or [None] * len(prompts))
+    ]
+    results = [None] * len(prompts)
+    # 活性化のスケールがバッチ全体で決まるモデルでは、まとめて推論した結果は1件だけの推論と異なりうる
+    batch_dependent = activations_depend_on_batch(pipe.model)
+
+    # 待っている間にクライアントが切断した、または期限を過ぎたリクエストは推論しない
+    for i, control in enumerate(controls):
+        if control.check_before_start():
+            results[i] = finish_result(model_name, pipe, control, "")
+
+    # 登録済みプレフィックスで始まるプロンプトは、一致したプレフィックスごとにまとめて1回のバッチで生成し、
+    # 保存済みのKVキャッシュから続きだけをプレフィルする
+    if len(prefix_cache) > 0:
+        groups = {}
+        for i, prompt in enumerate(prompts):
+            if results[i] is not None:
+                continue
+            token_ids = pipe.tokenizer(prompt).input_ids
+            entry, reused_tokens = prefix_cache.match(model_name, token_ids)
+            if entry is not None:
+                groups.setdefault((entry, reused_tokens), []).append((i, token_ids))
+        for (entry, reused_tokens), rows in groups.items():
+            indices = [i for i, _ in rows]
+            group_prompts = [prompts[i] for i in indices]
+            timer = GenerationTimer()
+            stopping_criteria = stopping_criteria_for(pipe, [controls[i] for i in indices], group_prompts)
+            texts = generate_with_prefix(
+                pipe, prefix_cache, entry, reused_tokens, [token_ids for _, token_ids in rows],
+                {**params, "logits_processor": [timer], "stopping_criteria": stopping_criteria},
+            )
+            for i, text in zip(indices, texts):
+                # プレフィックスと続きを分けてプレフィルするため、1件でも通常の推論とは異なりうる
+                results[i] = finish_result(model_name, pipe, controls[i], text, batch_dependent=batch_dependent)
+            observe_generation(model_name, timer, count_tokens(pipe, group_prompts), count_tokens(pipe, texts))
+
+    # ドラフトモデルによる検証は1件ずつしか行えないため、バッチにはまとめずに順に生成する
+    if decoder is not None:
+        for i, prompt in enumerate(prompts):
+            if results[i] is None:
+                results[i] = run_speculative_generation(decoder, model_name, prompt, params, controls[i])
+                results[i]["batch_dependent"] = batch_dependent
+
+    remaining = [i for i, result in enumerate(results) if result is None]
+    if remaining:
+        batch_prompts = [prompts[i] for i in remaining]
+        print(f"バッチ推論を開始: batch_size={len(batch_prompts)}, params={params}")
+        timer = GenerationTimer()
+        # 行ごとの期限・停止文字列・切断を毎ステップ確認し、満たした行から生成を止める
+        stopping_criteria = stopping_criteria_for(pipe, [controls[i] for i in remaining], batch_prompts)
+        outputs = pipe(
+            batch_prompts, batch_size=len(batch_prompts), logits_processor=[timer], stopping_criteria=stopping_criteria,
+            **params,
+        )
+        # リスト入力の場合、プロンプトごとに出力のリストが返る
+        texts = {}
+        for i, output in zip(remaining, outputs):
+            texts[i] = extract_assistant_response(output, prompts[i])
+            results[i] = finish_result(
+                model_name, pipe, controls[i], texts[i], batch_dependent=batch_dependent and len(remaining) > 1
+            )
+        observe_generation(
+            model_name, timer, count_tokens(pipe, batch_prompts), count_tokens(pipe, list(texts.values())),
+        )
+    return results
+
+def require_model(model_name=None, registry=None):
+    """
+    リクエストで指定されたモデルを返す
+
+    未読み込みなら読み込みを（必要なら）開始し、その場では待たずに503を送出する。
+
+    Args:
+        registry (ModelRegistry, optional): モデルを探すレジストリ（省略時は生成用の model_registry）
+
+    Returns:
+        tuple: (モデル名, パイプライン)
+    """
+    registry = registry or model_registry
+    try:
+        model_name = registry.resolve(model_name)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail=f"モデル '{model_name}' は提供されていません。利用可能なモデル: {registry.model_names}",
+        )
+    pipe = registry.get(model_name)
+    if pipe is not None:
+        return model_name, pipe
+    registry.ensure_loaded(model_name)
+    raise HTTPException(
+        status_code=503,
+        detail={"message": "モデルが利用できません。後でもう一度お試しください。", "model_load": registry.progress(model_name)},
+        headers={"Retry-After": str(registry.retry_after(model_name))},
+    )
+
+def generation_params(request):
+    """リクエストからモデルに渡す生成パラメータを取り出す"""
+    return {
+        "max_new_tokens": request.max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "speculative": request.speculative,
+    }
+
+def request_control(request, max_new_tokens=None):
+    """リクエストの期限と停止文字列から、生成を打ち切る条件を作る（max_new_tokens は実際に適用する上限）"""
+    deadline_seconds = request.deadline_seconds
+    if deadline_seconds is None:
+        deadline_seconds = config.DEFAULT_DEADLINE_SECONDS
+    return RequestControl(
+        deadline_seconds=deadline_seconds, stop=request.stop, max_new_tokens=max_new_tokens or request.max_new_tokens
+    )
+
+def apply_load_policy(request, params, model_name, endpoint, start_time):
+    """
+    負荷に応じて params の max_new_tokens を減らす
+
+    max_new_tokens が省略（null）された場合は Config.DEFAULT_MAX_NEW_TOKENS を使う。
+    負荷が優先度ごとの閾値を超えている場合は、推論を始める前に503（Retry-After付き）で断る。
+    """
+    if request.priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority は {list(PRIORITIES)} のいずれかを指定してください。")
+    if params["max_new_tokens"] is None:
+        params = {**params, "max_new_tokens": config.DEFAULT_MAX_NEW_TOKENS}
+    elif params["max_new_tokens"] < 1:
+        raise HTTPException(status_code=400, detail="max_new_tokens は1以上を指定してください。")
+    try:
+        budget, pressure = load_policy.apply(params["max_new_tokens"], request.priority, scheduler.waiting)
+    except LoadSheddingError as e:
+        print(f"{endpoint}エンドポイント: 負荷が高いため拒否しました (priority={e.priority}, 負荷={e.pressure:.2f})")
+        metrics.SHED_REQUESTS.inc(priority=e.priority)
+        observe_request(model_name, endpoint, start_time, "shed")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if budget < params["max_new_tokens"]:
+        print(f"負荷={pressure:.2f}のため max_new_tokens を {params['max_new_tokens']} から {budget} に減らしました")
+    return {**params, "max_new_tokens": budget}
+
+def client_id_for(request):
+    return request.client_id or DEFAULT_CLIENT_ID
+
+def quota_exceeded(e, model_name, endpoint, start_time):
+    """クライアントごとの上限を超えたリクエストを429（Retry-After付き）で断る HTTPException を作る"""
+    print(f"{endpoint}エンドポイント: {e}")
+    metrics.QUOTA_REJECTIONS.inc(client=metrics.client_label(e.client_id))
+    observe_request(model_name, endpoint, start_time, "rejected")
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def sample_count(request):
+    """
+    n / best_of を検証し、生成する候補の数を返す（1件だけ生成する通常のリクエストの場合は None）
+    """
+    if (request.n or 1) == 1 and request.best_of is None:
+        return None
+    n = request.n or 1
+    num_samples = request.best_of or n
+    if n < 1 or num_samples < n:
+        raise HTTPException(status_code=400, detail="n は1以上、best_of は n 以上を指定してください。")
+    if num_samples > config.MAX_SAMPLES:
+        raise HTTPException(status_code=400, detail=f"生成できる候補の数は{config.MAX_SAMPLES}個までです。")
+    if num_samples > 1 and not request.do_sample:
+        raise HTTPException(status_code=400, detail="複数の候補を生成するには do_sample=True を指定してください。")
+    return num_samples
+
+def require_model_generate(pipe, feature):
+    """
+    パイプラインを通さずに model.generate を直接呼ぶ機能を、それに対応していないバックエンドで使おうとした場合は400を返す
+    （MODEL_LOADERS に登録する推論バックエンドは、パイプラインとして呼び出せれば model.generate を持たなくてもよい）
+    """
+    if not callable(getattr(pipe.model, "generate", None)):
+        raise HTTPException(status_code=400, detail=f"このモデルの推論バックエンドは {feature} に対応していません。")
+
+def reject_samples(request, endpoint):
+    """n / best_of に対応していないエンドポイントで指定された場合は400を返す"""
+    if (request.n or 1) != 1 or request.best_of is not None:
+        raise HTTPException(status_code=400, detail=f"n / best_of は /generate でのみ指定できます（{endpoint}）。")
+
+def run_multi_sample_generation(pipe, model_name, prompt, n, num_samples, params, control):
+    """
+    プロンプトを1回だけプレフィルし、num_samples 個の候補を1回のバッチデコードで生成する（推論スレッドで実行）
+
+    Returns:
+        dict: 先頭の候補の generated_text と finish_reason、n 個の候補、プロンプトのトークン数
+    """
+    if control.check_before_start():
+        return {**finish_result(model_name, pipe, control, ""), "candidates": [], "prompt_tokens": 0}
+    controls = control.split(num_samples)
+    # 登録済みプレフィックスがあれば、その続きからプレフィルする
+    past_key_values, reused_tokens = None, 0
+    if len(prefix_cache) > 0:
+        past_key_values, reused_tokens = prefix_cache.lookup(model_name, pipe.tokenizer(prompt).input_ids)
+    timer = GenerationTimer()
+    sample_params = {key: params[key] for key in ("max_new_tokens", "do_sample", "temperature", "top_p")}
+    output = generate_samples(
+        pipe, prompt, num_samples, sample_params, controls, past_key_values, reused_tokens, logits_processor=[timer]
+    )
+    # プロンプトのトークンは候補の数によらず1回分だけ数える
+    observe_generation(
+        model_name, timer, output["prompt_tokens"],
+        sum(candidate["completion_tokens"] for candidate in output["candidates"]),
+    )
+    candidates = []
+    for candidate, candidate_control in zip(output["candidates"], controls):
+        result = finish_result(model_name, pipe, candidate_control, candidate["text"])
+        candidates.append({
+            "text": result["generated_text"],
+            "finish_reason": result["finish_reason"],
+            "completion_tokens": candidate["completion_tokens"],
+            "logprob": candidate["logprob"],
+        })
+    if num_samples > n:
+        candidates = rank_candidates(candidates, n)
+    print(
+        f"{num_samples}個の候補を生成し、{len(candidates)}個を返します "
+        f"(プレフィル={output['prefilled_tokens']}トークン, 生成={[c['completion_tokens'] for c in candidates]})"
+    )
+    return {
+        "generated_text": candidates[0]["text"],
+        "finish_reason": candidates[0]["finish_reason"],
+        "candidates": candidates,
+        "prompt_tokens": output["prompt_tokens"],
+    }
+
+def use_response_cache(request, params):
+    """応答キャッシュを参照・保存してよいリクエストか（停止文字列を指定したものは対象外）"""
+    return request.use_cache and not request.stop and response_cache.is_cacheable(params)
+
+async def wait_for_result(awaitable, http_request, controls):
+    """
+    クライアントの切断を監視しながら推論結果を待つ
+
+    切断された場合は生成を打ち切らせ、推論スレッドが止まるまで待ってから結果を返す。
+    """
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return task.result()
+        if await http_request.is_disconnected():
+            print("クライアントが切断したため、生成を打ち切ります。")
+            for control in controls:
+                control.cancel()
+            return await task
+
+def observe_queue_wait(seconds, model_name, client_id, priority):
+    """推論開始までの待ち時間を、モデルごとと、クライアント・優先度ごとに記録する"""
+    metrics.QUEUE_WAIT.observe(seconds, model=model_name)
+    metrics.CLIENT_QUEUE_WAIT.observe(seconds, client=metrics.client_label(client_id), priority=priority)
+
+# 同時リクエストをまとめて推論するスケジューラ
+# （優先度クラスの間は厳密に優先し、同じ優先度の中ではクライアント間で重み付き公平に順番を回す）
+scheduler = BatchScheduler(
+    run_generation_batch,
+    max_batch_size=config.MAX_BATCH_SIZE,
+    max_wait_ms=config.BATCH_WAIT_MS,
+    max_workers=config.INFERENCE_WORKERS,
+    max_queue_size=config.MAX_QUEUE_SIZE,
+    on_wait=observe_queue_wait,
+    quotas=ClientQuotas(config.CLIENT_QUOTAS, config.DEFAULT_CLIENT_QUOTA),
+)
+# 待ち行列の深さと推論中の件数は、提供するモデルごとに出す
+for served_model_name in config.MODEL_NAMES:
+    metrics.IN_FLIGHT.set_function(lambda name=served_model_name: scheduler.in_flight_for(name), model=served_model_name)
+    metrics.QUEUE_DEPTH.set_function(lambda name=served_model_name: scheduler.waiting_for(name), model=served_model_name)
+
+# 同時に実行する推論の数と torch のスレッド数（/health で返す）
+thread_split = {"mode": config.THREAD_SPLIT, "pinned": False, "workers": config.INFERENCE_WORKERS, "threads": None,
+                "interop_threads": None, "candidates": None, "tuning_seconds": None}
+
+def apply_thread_split(workers, threads):
+    """推論の同時実行数と、推論1つあたりの torch のスレッド数を設定する"""
+    torch.set_num_threads(threads)
+    scheduler.resize(workers)
+    thread_split.update(pinned=True, workers=workers, threads=threads, interop_threads=torch.get_num_interop_threads())
+    print(f"推論の同時実行数={workers}, torchのスレッド数={threads}, inter-opスレッド数={thread_split['interop_threads']}")
+
+def tune_thread_split(pipe, registry, model_name):
+    """デフォルトモデルで同時実行数とスレッド数の組み合わせを実測し、最もスループットが高いものに固定する"""
+    if config.THREAD_SPLIT != "auto" or thread_split["candidates"] is not None:
+        # 手動指定の場合と、解放後に読み込み直した場合は実測しない
+        return
+    registry.set_stage(model_name, "スレッド数を調整中")
+    # 複数ワーカーで起動する場合、コアはワーカー間で等分する
+    cores = max(1, (os.cpu_count() or 1) // max(1, config.WORKERS))
+    tuning_start = time.time()
+    try:
+        best, results = tune_threads(
+            pipe, candidate_splits(cores, config.THREAD_TUNING_MAX_WORKERS),
+            latency_target=config.THREAD_TUNING_LATENCY_TARGET,
+        )
+    except Exception as e:
+        # 調整に失敗しても、既定のスレッド数のままモデルの提供は続ける
+        print(f"スレッド数の調整に失敗しました: {e}")
+        traceback.print_exc()
+        thread_split["candidates"] = []
+        return
+    thread_split.update(candidates=results, tuning_seconds=time.time() - tuning_start)
+    apply_thread_split(best["workers"], best["threads"])
+
+if config.TORCH_INTEROP_THREADS > 0:
+    try:
+        # inter-op スレッド数は最初の並列処理の前にしか変更できない
+        torch.set_num_interop_threads(config.TORCH_INTEROP_THREADS)
+    except RuntimeError as e:
+        print(f"inter-opスレッド数を変更できませんでした: {e}")
+if config.THREAD_SPLIT not in ("auto", "off", ""):
+    apply_thread_split(*parse_split(config.THREAD_SPLIT))
+thread_split.update(threads=torch.get_num_threads(), interop_threads=torch.get_num_interop_threads())
+
+def run_embedding_batch(model_name, texts, params, controls=None):
+    """同じモデル・同じ mode のテキスト群を、1回の encode で埋め込む（推論スレッドで実行）"""
+    pipe = embedding_registry.get(model_name)
+    if pipe is None:
+        raise RuntimeError(f"埋め込みモデル '{model_name}' は解放されたため利用できません。")
+    matrix = pipe.encode(texts, params["prompt_name"], config.EMBEDDING_BATCH_SIZE, params["normalize"])
+    metrics.EMBEDDING_BATCH_SIZE.observe(len(texts), model=model_name)
+    return list(matrix)
+
+# 同時に届いた /embeddings のテキストを、モデル・mode ごとにまとめて encode するスケジューラ
+embedding_scheduler = BatchScheduler(
+    run_embedding_batch,
+    max_batch_size=config.EMBEDDING_MAX_BATCH_SIZE,
+    max_wait_ms=config.EMBEDDING_BATCH_WAIT_MS,
+    max_workers=1,
+    max_queue_size=config.EMBEDDING_MAX_QUEUE_SIZE,
+    batch_key=lambda params: (params["prompt_name"], params["normalize"]),
+)
+
+# 決定的な生成の応答キャッシュ
+response_cache = ResponseCache(max_entries=config.CACHE_MAX_ENTRIES, ttl_seconds=config.CACHE_TTL_SECONDS)
+
+# 共通プレフィックスのKVキャッシュ
+prefix_cache = PrefixCache(max_bytes=int(config.PREFIX_CACHE_MAX_MB * 1024 * 1024))
+
+# 負荷に応じた生成トークン数の削減と、優先度の低いリクエストの拒否
+load_policy = LoadPolicy(
+    queue_start=config.DEGRADE_QUEUE_START,
+    queue_full=config.DEGRADE_QUEUE_FULL,
+    target_tokens_per_second=config.DEGRADE_TARGET_TOKENS_PER_SECOND,
+    min_tokens_per_second=config.DEGRADE_MIN_TOKENS_PER_SECOND,
+    min_budget_factor=config.DEGRADE_MIN_BUDGET_FACTOR,
+    min_max_new_tokens=config.DEGRADE_MIN_MAX_NEW_TOKENS,
+    shed_low_at=config.SHED_LOW_PRESSURE,
+    shed_normal_at=config.SHED_NORMAL_PRESSURE,
+)
+metrics.LOAD_PRESSURE.set_function(lambda: load_policy.pressure(scheduler.waiting))
+
+# /chat の会話セッション（履歴と past_key_values）
+chat_sessions = SessionStore(
+    max_bytes=int(config.CHAT_SESSION_MAX_MB * 1024 * 1024), idle_timeout=config.CHAT_SESSION_IDLE_SECONDS,
+    sweep_interval=config.CHAT_SESSION_SWEEP_SECONDS,
+)
+metrics.CHAT_SESSIONS.set_function(lambda: len(chat_sessions))
+metrics.CHAT_CACHE_BYTES.set_function(lambda: chat_sessions.total_bytes)
+
+# モデル名 -> ドラフトモデルとの組（投機的デコーディング用）
+speculative_decoders = {}
+
+# 起動から準備完了までの時間と、起動後最初のリクエストの応答時間
+startup_stats = {"started_at": None, "time_to_ready": None, "first_request_latency": None}
+
 # --- FastAPIエンドポイント定義 ---
 @app.on_event("startup")
 async def startup_event():
-    """起動時にモデルを初期化"""
-    load_model_task()  # バックグラウンドではなく同期的に読み込む
-    if model is None:
-        print("警告: 起動時にモデルの初期化に失敗しました")
-    else:
-        print("起動時にモデルの初期化が完了しました。")
+    """起動時にモデルの読み込みをバックグラウンドで開始"""
+    # 読み込み中もポートを開けておき、/health や /ready に応答できるようにする
+    # 読み込みの後にウォームアップ（Config.WARMUP_PROMPT_LENGTHS）まで済ませてから /ready が成功する
+    # デフォルト以外のモデルは、最初にリクエストされたときに読み込む
+    if not model_registry.is_resident(config.MODEL_NAME):
+        startup_stats.update(started_at=time.time(), time_to_ready=None, first_request_latency=None)
+    # 複数ワーカーで起動した場合は、fork 前に親プロセスで読み込み済み（preload_models）
+    model_registry.ensure_loaded(config.MODEL_NAME)
+    scheduler.start()
+    embedding_scheduler.start()
+    chat_sessions.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時にスケジューラを停止"""
+    await scheduler.stop()
+    await embedding_scheduler.stop()
+    await chat_sessions.stop()
 
 @app.get("/")
 async def root():
@@ -191,75 +967,645 @@ async def root():
 @app.get("/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
-    global model
-    if model is None:
-        return {"status": "error", "message": "No model loaded"}
+    models = model_registry.stats()
+    if not models["resident_models"]:
+        return {"status": "error", "message": "No model loaded", "model_load": model_registry.progress(config.MODEL_NAME), "models": models}
+
+    return {
+        "status": "ok",
+        "model": config.MODEL_NAME,
+        "load_mode": resolve_load_mode(config.LOAD_MODE),
+        "startup": startup_stats,
+        "models": models,
+        "cache": response_cache.stats(),
+        "speculative": {name: decoder.stats() for name, decoder in list(speculative_decoders.items())},
+        "chat_sessions": chat_sessions.stats(),
+        "embeddings": embedding_registry.stats(),
+        "load": load_policy.stats(scheduler.waiting),
+        # 推論の同時実行数と torch のスレッド数（"auto" の場合は候補ごとの実測結果を含む）
+        "threads": thread_split,
+        # 応答したワーカーのメモリ使用量（shared は他のワーカーと共有している重みなどのページ）
+        "process": process_memory(),
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """レディネスチェック。デフォルトモデルが推論可能になるまでは503を返す"""
+    progress = model_registry.progress(config.MODEL_NAME)
+    if not model_registry.is_resident(config.MODEL_NAME):
+        # 読み込みに失敗した場合も、再試行の間隔が過ぎていれば読み込み直す
+        model_registry.ensure_loaded(config.MODEL_NAME)
+        return JSONResponse(status_code=503, content=progress)
+    return progress
+
+@app.get("/stats")
+async def stats():
+    """スケジューラの統計情報（待ち行列の深さ、待ち時間、バッチの充填率など）を返すエンドポイント"""
+    return {"scheduler": scheduler.stats(), "embeddings": embedding_scheduler.stats()}
 
-    return {"status": "ok", "model": config.MODEL_NAME}
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus形式のメトリクスを返すエンドポイント"""
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+def observe_request(model_name, endpoint, start_time, status):
+    """エンドポイントごとのリクエスト数と応答完了までの時間を記録する"""
+    metrics.REQUESTS.inc(model=model_name, endpoint=endpoint, status=status)
+    if status == "ok":
+        latency = time.time() - start_time
+        metrics.REQUEST_LATENCY.observe(latency, model=model_name, endpoint=endpoint)
+        if startup_stats["first_request_latency"] is None:
+            startup_stats["first_request_latency"] = latency
+            metrics.FIRST_REQUEST_LATENCY.set(latency)
+            print(f"起動後最初のリクエストの応答時間: {latency:.2f}秒 ({endpoint})")
+
+@app.get("/prefixes")
+async def list_prefixes():
+    """登録済みプレフィックスとKVキャッシュの使用状況を返す"""
+    return prefix_cache.stats()
+
+@app.post("/prefixes")
+async def register_prefix(request: PrefixRequest):
+    """共通プレフィックス（システムプロンプトなど）を登録し、そのKVキャッシュを事前に計算する"""
+    model_name, pipe = require_model(request.model)
+    try:
+        entry = await scheduler.submit_single(
+            prefix_cache.register, pipe, model_name, request.prefix, model_name=model_name
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"プレフィックスの登録中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"プレフィックスの登録中にエラーが発生しました: {str(e)}")
+    return {"status": "ok", **entry.info()}
+
+@app.delete("/prefixes")
+async def delete_prefix(request: PrefixRequest):
+    """登録済みプレフィックスを削除する"""
+    model_name = request.model or config.MODEL_NAME
+    if not prefix_cache.remove(model_name, request.prefix):
+        raise HTTPException(status_code=404, detail="指定されたプレフィックスは登録されていません。")
+    return {"status": "ok"}
 
 # 簡略化されたエンドポイント
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_simple(request: SimpleGenerationRequest):
+async def generate_simple(request: SimpleGenerationRequest, http_request: Request):
     """単純なプロンプト入力に基づいてテキストを生成"""
-    global model
-
-    if model is None:
-        print("generateエンドポイント: モデルが読み込まれていません。読み込みを試みます...")
-        load_model_task()  # 再度読み込みを試みる
-        if model is None:
-            print("generateエンドポイント: モデルの読み込みに失敗しました。")
-            raise HTTPException(status_code=503, detail="モデルが利用できません。後でもう一度お試しください。")
+    # 読み込み中・失敗時はその場で読み込まずに即座に503を返す
+    model_name, pipe = require_model(request.model)
+    num_samples = sample_count(request)
+    if num_samples is not None:
+        require_model_generate(pipe, "n / best_of")
 
+    start_time = time.time()
+    # 負荷が高いときは生成トークン数を減らし、優先度の低いリクエストは推論せずに断る
+    params = apply_load_policy(request, generation_params(request), model_name, "generate", start_time)
     try:
-        start_time = time.time()
-        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={request.max_new_tokens}")  # 長いプロンプトは切り捨て
+        print(f"シンプルなリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={params['max_new_tokens']}")  # 長いプロンプトは切り捨て
+
+        if num_samples is not None:
+            # 複数の候補は、プレフィルを共有して1回のバッチデコードで生成する（応答キャッシュは使わない）
+            control = request_control(request, params["max_new_tokens"])
+            result = await wait_for_result(
+                scheduler.submit_single(
+                    run_multi_sample_generation, pipe, model_name, request.prompt, request.n or 1, num_samples,
+                    params, control, model_name=model_name, client_id=client_id_for(request),
+                    priority=request.priority, cost=params["max_new_tokens"] * num_samples,
+                ),
+                http_request,
+                [control],
+            )
+            response_time = time.time() - start_time
+            print(f"応答生成時間: {response_time:.2f}秒 (候補数={num_samples})")
+            observe_request(model_name, "generate", start_time, "ok")
+            return GenerationResponse(
+                response_time=response_time, model=model_name, max_new_tokens=params["max_new_tokens"], **result
+            )
+
+        # サンプリングしない生成は結果が決まっているため、同じ入力ならキャッシュから返す
+        cache_key = None
+        if use_response_cache(request, params):
+            cache_key = make_cache_key(request.prompt, model_name, params)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                response_time = time.time() - start_time
+                print(f"キャッシュから応答を返しました: {response_time:.4f}秒")
+                observe_request(model_name, "generate", start_time, "ok")
+                return GenerationResponse(
+                    **cached_response, response_time=response_time, cached=True, model=model_name,
+                    max_new_tokens=params["max_new_tokens"],
+                )
 
-        # プロンプトテキストで直接応答を生成
+        # スケジューラ経由で、同時に届いた他のリクエストとまとめて推論する
         print("モデル推論を開始...")
-        outputs = model(
-            request.prompt,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=request.do_sample,
-            temperature=request.temperature,
-            top_p=request.top_p,
+        control = request_control(request, params["max_new_tokens"])
+        result = await wait_for_result(
+            scheduler.submit(
+                model_name, request.prompt, params, control, client_id=client_id_for(request), priority=request.priority
+            ),
+            http_request,
+            [control],
         )
-        print("モデル推論が完了しました。")
-
-        # アシスタント応答を抽出
-        assistant_response = extract_assistant_response(outputs, request.prompt)
+        assistant_response = result["generated_text"]
+        print(f"モデル推論が完了しました。(finish_reason={result['finish_reason']})")
+        if cache_key is not None and cacheable_result(result):
+            response_cache.put(cache_key, {"generated_text": assistant_response, "finish_reason": result["finish_reason"]})
         print(f"抽出されたアシスタント応答: {assistant_response[:100]}...")  # 長い場合は切り捨て
 
         end_time = time.time()
         response_time = end_time - start_time
         print(f"応答生成時間: {response_time:.2f}秒")
+        observe_request(model_name, "generate", start_time, "ok")
 
         return GenerationResponse(
             generated_text=assistant_response,
-            response_time=response_time
+            response_time=response_time,
+            model=model_name,
+            max_new_tokens=params["max_new_tokens"],
+            speculative=result.get("speculative"),
+            finish_reason=result["finish_reason"],
         )
 
+    except QueueFullError as e:
+        print(f"generateエンドポイント: 待ち行列が上限に達したため拒否しました (queue_depth={scheduler.waiting})")
+        observe_request(model_name, "generate", start_time, "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QuotaExceededError as e:
+        raise quota_exceeded(e, model_name, "generate", start_time)
     except Exception as e:
+        observe_request(model_name, "generate", start_time, "error")
         print(f"シンプル応答生成中にエラーが発生しました: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
 
-def load_model_task():
-    """モデルを読み込むバックグラウンドタスク"""
-    global model
-    print("load_model_task: モデルの読み込みを開始...")
-    # load_model関数を呼び出し、結果をグローバル変数に設定
-    # loaded_pipe = load_model()
-    
-    # load_model_bits関数を呼び出し、量子化モデルの結果をグローバル変数に設定
-    loaded_pipe = load_model_bits()
-    if loaded_pipe:
-        model = loaded_pipe  # グローバル変数を更新
-        print("load_model_task: モデルの読み込みが完了しました。")
-    else:
+@app.post("/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(request: BatchGenerationRequest, http_request: Request):
+    """複数のプロンプトをパディング済みバッチで推論し、要素ごとの結果を返す"""
+    if not request.items:
+        return BatchGenerationResponse(results=[], total_time=0.0)
+    for item in request.items:
+        reject_samples(item, "/generate/batch")
+    # 要素ごとに指定されたモデルがすべて利用可能であることを先に確認する
+    item_models = [require_model(item.model)[0] for item in request.items]
+    model_name = item_models[0]  # メトリクスのラベルには先頭要素のモデルを使う
+
+    start_time = time.time()
+    print(f"バッチリクエストを受信: items={len(request.items)}")
+    results = [None] * len(request.items)
+
+    # キャッシュに無いものだけを、モデルと生成パラメータが同じもの同士でまとめる
+    groups = {}
+    # 1つでも断られる要素があればバッチ全体を断る（推論を始める前に判定する）
+    item_params = [
+        apply_load_policy(item, generation_params(item), item_model, "generate_batch", start_time)
+        for item, item_model in zip(request.items, item_models)
+    ]
+    controls = [request_control(item, params["max_new_tokens"]) for item, params in zip(request.items, item_params)]
+    for i, (item, item_model, params) in enumerate(zip(request.items, item_models, item_params)):
+        cache_key = None
+        if use_response_cache(item, params):
+            cache_key = make_cache_key(item.prompt, item_model, params)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                results[i] = GenerationResponse(
+                    **cached_response, response_time=time.time() - start_time, cached=True, model=item_model,
+                    max_new_tokens=params["max_new_tokens"],
+                )
+                continue
+        # 公平性と上限はクライアント・優先度ごとに判定するため、それらが異なるものも別のグループにする
+        client_id = client_id_for(item)
+        group = groups.setdefault(
+            (item_model,) + sampling_key(params) + (client_id, item.priority),
+            {"model": item_model, "params": params, "client_id": client_id, "priority": item.priority,
+             "indices": [], "cache_keys": []},
+        )
+        group["indices"].append(i)
+        group["cache_keys"].append(cache_key)
+
+    async def collect_chunk(item_model, indices, cache_keys, task):
+        responses = await task
+        response_time = time.time() - start_time
+        for i, cache_key, response in zip(indices, cache_keys, responses):
+            if cache_key is not None and cacheable_result(response):
+                response_cache.put(
+                    cache_key, {"generated_text": response["generated_text"], "finish_reason": response["finish_reason"]}
+                )
+            results[i] = GenerationResponse(
+                response_time=response_time, model=item_model, max_new_tokens=item_params[i]["max_new_tokens"], **response
+            )
+
+    # スケジューラの最大バッチサイズごとに分割し、受け付けを確定させてから推論スレッドで実行する
+    chunks = []
+    try:
+        for group in groups.values():
+            for offset in range(0, len(group["indices"]), scheduler.max_batch_size):
+                indices = group["indices"][offset:offset + scheduler.max_batch_size]
+                prompts = [request.items[i].prompt for i in indices]
+                task = scheduler.submit_single(
+                    run_generation_batch, group["model"], prompts, group["params"], [controls[i] for i in indices],
+                    model_name=group["model"], client_id=group["client_id"], priority=group["priority"],
+                    cost=group["params"]["max_new_tokens"] * len(indices),
+                )
+                chunks.append((group["model"], indices, group["cache_keys"][offset:offset + scheduler.max_batch_size], task))
+    except QueueFullError as e:
+        for *_, task in chunks:
+            task.cancel()
+        print(f"generate/batchエンドポイント: 待ち行列が上限に達したため拒否しました (queue_depth={scheduler.waiting})")
+        observe_request(model_name, "generate_batch", start_time, "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QuotaExceededError as e:
+        for *_, task in chunks:
+            task.cancel()
+        raise quota_exceeded(e, model_name, "generate_batch", start_time)
+
+    try:
+        await wait_for_result(asyncio.gather(*(collect_chunk(*chunk) for chunk in chunks)), http_request, controls)
+    except Exception as e:
+        observe_request(model_name, "generate_batch", start_time, "error")
+        print(f"バッチ応答生成中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+
+    total_time = time.time() - start_time
+    print(f"バッチ応答生成時間: {total_time:.2f}秒 (items={len(results)}, chunks={len(chunks)})")
+    observe_request(model_name, "generate_batch", start_time, "ok")
+    return BatchGenerationResponse(results=results, total_time=total_time)
+
+def run_chat_generation(pipe, model_name, session, messages, params, control):
+    """会話セッションの past_key_values の続きから1ターン分を生成する（推論スレッドで実行）"""
+    if control.check_before_start():
+        return {**finish_result(model_name, pipe, control, ""), "prompt_tokens": 0, "reused_tokens": 0, "prefilled_tokens": 0}
+    timer = GenerationTimer()
+    turn = run_chat_turn(pipe, chat_sessions, session, messages, params, control, logits_processor=[timer])
+    observe_generation(model_name, timer, turn["prefilled_tokens"], turn["completion_tokens"])
+    metrics.CHAT_REUSED_TOKENS.inc(turn["reused_tokens"], model=model_name)
+    result = finish_result(model_name, pipe, control, turn["text"])
+    if result["finish_reason"] != "cancelled":
+        # 停止文字列で切り詰めた応答を履歴に残す（次のターンでキャッシュと一致しなくなった位置からプレフィルし直す）。
+        # 切断されたターンは、届かなかった応答と一緒に今回のメッセージも履歴に残さない
+        commit_turn(session, turn["messages"], {"role": "assistant", "content": result["generated_text"]})
+    return {**result, "prompt_tokens": turn["prompt_tokens"], "reused_tokens": turn["reused_tokens"],
+            "prefilled_tokens": turn["prefilled_tokens"]}
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """会話を1ターン進める。前のターンまでのKVキャッシュを再利用し、追加されたメッセージだけをプレフィルする"""
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messages が空です。")
+    session = None
+    if request.session_id is not None:
+        session = chat_sessions.get(request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"セッション '{request.session_id}' は存在しないか、期限切れで削除されました。")
+        if request.model is not None and request.model != session.model_name:
+            raise HTTPException(status_code=400, detail=f"セッション '{request.session_id}' はモデル '{session.model_name}' で開始されています。")
+        if session.busy:
+            raise HTTPException(status_code=409, detail=f"セッション '{request.session_id}' は前のターンを処理中です。")
+    model_name, pipe = require_model(session.model_name if session is not None else request.model)
+    # 新しい会話は、最初のターンが受け付けられてから保持する（断られたターンの会話を残さないため）
+    new_session = session is None
+    if new_session:
+        session = chat_sessions.new_session(model_name)
+
+    start_time = time.time()
+    print(f"chatリクエストを受信: session={session.session_id}, turns={session.turns}, 追加メッセージ数={len(request.messages)}")
+    params = {
+        "max_new_tokens": request.max_new_tokens,
+        "do_sample": request.do_sample,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+    }
+    params = apply_load_policy(request, params, model_name, "chat", start_time)
+    control = request_control(request, params["max_new_tokens"])
+    session.busy = True
+    try:
+        task = scheduler.submit_single(
+            run_chat_generation, pipe, model_name, session, [message.dict() for message in request.messages],
+            params, control, model_name=model_name, client_id=client_id_for(request), priority=request.priority,
+            cost=params["max_new_tokens"],
+        )
+        if new_session:
+            chat_sessions.add(session)
+        result = await wait_for_result(task, http_request, [control])
+    except QueueFullError as e:
+        observe_request(model_name, "chat", start_time, "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QuotaExceededError as e:
+        raise quota_exceeded(e, model_name, "chat", start_time)
+    except Exception as e:
+        if new_session:
+            # 最初のターンで失敗した会話は、クライアントにIDが届かないため残さない
+            chat_sessions.delete(session.session_id)
+        observe_request(model_name, "chat", start_time, "error")
+        print(f"chat応答生成中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"応答の生成中にエラーが発生しました: {str(e)}")
+    finally:
+        session.busy = False
+    if new_session and result["finish_reason"] == "cancelled":
+        # 最初のターンの途中で切断した場合も、IDを受け取れなかった会話は残さない
+        chat_sessions.delete(session.session_id)
+    reply = Message(role="assistant", content=result["generated_text"])
+
+    response_time = time.time() - start_time
+    print(f"chat応答生成時間: {response_time:.2f}秒 (再利用={result['reused_tokens']}, プレフィル={result['prefilled_tokens']}トークン)")
+    observe_request(model_name, "chat", start_time, "ok")
+    return ChatResponse(
+        session_id=session.session_id,
+        message=reply,
+        response_time=response_time,
+        model=model_name,
+        max_new_tokens=params["max_new_tokens"],
+        finish_reason=result["finish_reason"],
+        prompt_tokens=result["prompt_tokens"],
+        reused_tokens=result["reused_tokens"],
+        prefilled_tokens=result["prefilled_tokens"],
+    )
+
+@app.get("/chat/{session_id}")
+async def get_chat_session(session_id: str):
+    """会話の履歴と、保持しているKVキャッシュの情報を返す"""
+    session = chat_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"セッション '{session_id}' は存在しないか、期限切れで削除されました。")
+    return {**session.info(), "history": session.messages}
+
+@app.delete("/chat/{session_id}")
+async def delete_chat_session(session_id: str):
+    """会話を終了し、KVキャッシュを解放する"""
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"セッション '{session_id}' は存在しません。")
+    return {"status": "ok", "session_id": session_id}
+
+@app.post("/embeddings", response_model=EmbeddingResponse)
+async def create_embeddings(request: EmbeddingRequest):
+    """テキストの埋め込みを返す。同時に届いた他のリクエストのテキストとまとめて encode する"""
+    if request.mode not in EMBEDDING_PROMPT_NAMES:
+        raise HTTPException(status_code=400, detail=f"mode は {list(EMBEDDING_PROMPT_NAMES)} のいずれかを指定してください。")
+    if request.encoding_format not in ENCODING_FORMATS:
+        raise HTTPException(status_code=400, detail=f"encoding_format は {list(ENCODING_FORMATS)} のいずれかを指定してください。")
+    if not request.texts or len(request.texts) > embedding_scheduler.max_queue_size:
+        raise HTTPException(
+            status_code=400, detail=f"texts には1〜{embedding_scheduler.max_queue_size}件のテキストを指定してください。"
+        )
+    model_name, _ = require_model(request.model, embedding_registry)
+
+    start_time = time.time()
+    params = {"prompt_name": EMBEDDING_PROMPT_NAMES[request.mode], "normalize": request.normalize}
+    try:
+        # 一部のテキストだけ受け付けて残りを断ることがないよう、すべてのテキストをまとめて受け付ける
+        futures = embedding_scheduler.submit_many(model_name, request.texts, params)
+    except QueueFullError as e:
+        print(f"embeddingsエンドポイント: 待ち行列が上限に達したため拒否しました (queue_depth={embedding_scheduler.waiting})")
+        observe_request(model_name, "embeddings", start_time, "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    try:
+        vectors = await asyncio.gather(*futures)
+    except Exception as e:
+        observe_request(model_name, "embeddings", start_time, "error")
+        print(f"埋め込みの計算中にエラーが発生しました: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"埋め込みの計算中にエラーが発生しました: {str(e)}")
+
+    matrix = np.stack(vectors)
+    metrics.EMBEDDING_TEXTS.inc(len(request.texts), model=model_name, mode=request.mode)
+    response_time = time.time() - start_time
+    print(f"埋め込みを返しました: {len(request.texts)}件, mode={request.mode}, {response_time:.3f}秒")
+    observe_request(model_name, "embeddings", start_time, "ok")
+    return EmbeddingResponse(
+        model=model_name,
+        mode=request.mode,
+        count=matrix.shape[0],
+        dimensions=matrix.shape[1],
+        encoding_format=request.encoding_format,
+        response_time=response_time,
+        **encode_embeddings(matrix, request.encoding_format),
+    )
+
+def run_streaming_generation(pipe, model_name, prompt, params, streamer, control):
+    """
+    ストリーマーにトークンを流しながら1件分を生成する（推論スレッドで実行）
+
+    Returns:
+        dict | None: 投機的デコーディングを使った場合はその統計
+    """
+    decoder = speculative_decoder_for(model_name, params)
+    params = {k: v for k, v in params.items() if k != "speculative"}
+    try:
+        if control.check_before_start():
+            return None
+        params["stopping_criteria"] = stopping_criteria_for(pipe, [control], [prompt])
+        if decoder is not None:
+            started_at = decoder.begin()
+            pipe(prompt, streamer=streamer, **decoder.generate_kwargs(), **params)
+            run = decoder.end(started_at, len(streamer.token_times))
+            observe_generation(model_name, run, streamer.prompt_tokens, run.new_tokens)
+            metrics.observe_speculative(model_name, run)
+            return run.info()
+        timer = GenerationTimer()
+        pipe(prompt, streamer=streamer, logits_processor=[timer], **params)
+        observe_generation(model_name, timer, streamer.prompt_tokens, len(streamer.token_times))
+        return None
+    finally:
+        # 例外で中断した場合でもストリームの終端をクライアントへ伝える
+        if not streamer.finished:
+            streamer.end()
+
+@app.post("/generate/stream")
+async def generate_stream(request: SimpleGenerationRequest):
+    """生成されたトークンを Server-Sent Events として逐次返す"""
+    reject_samples(request, "/generate/stream")
+    model_name, pipe = require_model(request.model)
+
+    start_time = time.time()
+    params = apply_load_policy(request, generation_params(request), model_name, "generate_stream", start_time)
+    print(f"ストリーミングリクエストを受信: prompt={request.prompt[:100]}..., max_new_tokens={params['max_new_tokens']}")
+    streamer = AsyncTextStreamer(pipe.tokenizer, asyncio.get_running_loop(), skip_prompt=True, skip_special_tokens=True)
+    control = request_control(request, params["max_new_tokens"])
+    try:
+        task = scheduler.submit_single(
+            run_streaming_generation, pipe, model_name, request.prompt, params, streamer, control,
+            model_name=model_name, client_id=client_id_for(request), priority=request.priority,
+            cost=params["max_new_tokens"],
+        )
+    except QueueFullError as e:
+        print(f"generate/streamエンドポイント: 待ち行列が上限に達したため拒否しました (queue_depth={scheduler.waiting})")
+        observe_request(model_name, "generate_stream", start_time, "rejected")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except QuotaExceededError as e:
+        raise quota_exceeded(e, model_name, "generate_stream", start_time)
+
+    async def event_stream():
+        pieces = []
+        completed = False
+        try:
+            while True:
+                text, stream_end = await streamer.queue.get()
+                if text:
+                    pieces.append(text)
+                    yield sse_event({"token": text})
+                if stream_end:
+                    break
+            try:
+                speculative = await task
+            except Exception as e:
+                completed = True
+                print(f"ストリーミング生成中にエラーが発生しました: {e}")
+                traceback.print_exc()
+                observe_request(model_name, "generate_stream", start_time, "error")
+                yield sse_event({"detail": f"応答の生成中にエラーが発生しました: {str(e)}"}, event="error")
+                return
+            completed = True
+            response_time = time.time() - start_time
+            result = finish_result(model_name, pipe, control, "".join(pieces).strip())
+            summary = {
+                **result, "response_time": response_time, "model": model_name, "max_new_tokens": params["max_new_tokens"],
+            }
+            summary.update(streamer.timings())
+            if speculative is not None:
+                summary["speculative"] = speculative
+            print(f"ストリーミング応答生成時間: {response_time:.2f}秒, 最初のトークンまで: {summary['time_to_first_token']}")
+            observe_request(model_name, "generate_stream", start_time, "ok")
+            yield sse_event(summary, event="done")
+        finally:
+            if not completed:
+                # クライアントが切断してストリームが閉じられた場合は、生成を打ち切らせる
+                print("クライアントが切断したため、ストリーミング生成を打ち切ります。")
+                control.cancel()
+                task.add_done_callback(lambda _: finish_result(model_name, pipe, control, ""))
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+def load_model_task(model_name, registry):
+    """モデルを読み込むバックグラウンドタスク（ModelRegistry から読み込み用スレッドで呼ばれる）"""
+    load_mode = resolve_load_mode(config.LOAD_MODE)
+    print(f"load_model_task: モデル '{model_name}' の読み込みを開始... (load_mode={load_mode})")
+    loader = MODEL_LOADERS.get(load_mode)
+    if loader is None:
+        print(f"load_model_task: 不明な読み込み方法です: {load_mode} (選択肢: {list(MODEL_LOADERS)})")
+        return None
+    loaded_pipe = loader(model_name)
+    if not loaded_pipe:
         print("load_model_task: モデルの読み込みに失敗しました。")
+        return None
+    loaded_pipe = prepare_pipeline_for_batching(loaded_pipe)
+    if model_name == config.MODEL_NAME and config.DRAFT_MODEL_NAME:
+        load_draft_model_for(model_name, loaded_pipe, registry)
+    compiled = False
+    if config.COMPILE_MODE:
+        registry.set_stage(model_name, "torch.compileを設定中")
+        compiled = compile_pipeline(loaded_pipe, model_name, config.COMPILE_MODE, config.COMPILE_CACHE_DIR)
+    if config.WARMUP_PROMPT_LENGTHS:
+        # 推論可能として公開する前に、最初のリクエストで発生する初期化を済ませておく
+        registry.set_stage(model_name, "ウォームアップ中")
+        warmup_start = time.time()
+        warm_up_pipeline(
+            loaded_pipe, config.WARMUP_PROMPT_LENGTHS, config.WARMUP_BATCH_SIZES, config.WARMUP_MAX_NEW_TOKENS,
+            speculative_decoder=speculative_decoders.get(model_name),
+        )
+        print(f"load_model_task: ウォームアップが完了しました。({time.time() - warmup_start:.1f}秒)")
+    if model_name == config.MODEL_NAME:
+        tune_thread_split(loaded_pipe, registry, model_name)
+    if compiled:
+        save_compile_artifacts(config.COMPILE_CACHE_DIR, model_name)
+    metrics.MODEL_LOAD_TIME.set(registry.progress(model_name)["elapsed_seconds"], model=model_name)
+    metrics.MODEL_MEMORY.set(model_memory_footprint(loaded_pipe), model=model_name)
+    print("load_model_task: モデルの読み込みが完了しました。")
+    return loaded_pipe
+
+def load_embedding_task(model_name, registry):
+    """埋め込みモデルを読み込むバックグラウンドタスク（embedding_registry から読み込み用スレッドで呼ばれる）"""
+    if resolve_load_mode(config.LOAD_MODE) == "fake":
+        print(f"偽の埋め込みバックエンドを使用します: {model_name}")
+        return load_fake_embedding_pipeline(config.FAKE_PREFILL_TOKENS_PER_SECOND)
+    registry.set_stage(model_name, "埋め込みモデルを読み込み中")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    pipe = load_embedding_pipeline(model_name, device=device, max_seq_length=config.EMBEDDING_MAX_SEQ_LENGTH)
+    metrics.MODEL_MEMORY.set(model_memory_footprint(pipe), model=model_name)
+    print(f"埋め込みモデル '{model_name}' の読み込みに成功しました (次元数={pipe.dimensions}, device={device})")
+    return pipe
+
+def load_draft_model_for(model_name, pipe, registry):
+    """本体モデルと組にするドラフトモデルを読み込む。失敗しても本体モデルだけで提供を続ける"""
+    registry.set_stage(model_name, f"ドラフトモデル '{config.DRAFT_MODEL_NAME}' を読み込み中")
+    try:
+        draft_model, draft_tokenizer = load_draft_model(config.DRAFT_MODEL_NAME, pipe.model.device)
+    except Exception as e:
+        print(f"ドラフトモデルの読み込みに失敗しました。投機的デコーディングは無効になります: {e}")
+        traceback.print_exc()
+        return
+    speculative_decoders[model_name] = SpeculativeDecoder(
+        pipe, draft_model, draft_tokenizer,
+        draft_model_name=config.DRAFT_MODEL_NAME, num_assistant_tokens=config.NUM_ASSISTANT_TOKENS,
+    )
+    print(f"ドラフトモデル '{config.DRAFT_MODEL_NAME}' の読み込みに成功しました")
+
+def on_model_loaded(model_name):
+    """デフォルトモデルが推論可能になったら、起動から準備完了までの時間を記録する"""
+    if model_name != config.MODEL_NAME or startup_stats["started_at"] is None or startup_stats["time_to_ready"] is not None:
+        return
+    startup_stats["time_to_ready"] = time.time() - startup_stats["started_at"]
+    metrics.TIME_TO_READY.set(startup_stats["time_to_ready"])
+    print(f"起動から準備完了まで: {startup_stats['time_to_ready']:.1f}秒")
+
+def on_model_evicted(model_name):
+    """モデルの解放時に、そのモデル用のKVキャッシュとメトリクスを片付ける"""
+    prefix_cache.drop_model(model_name)
+    chat_sessions.drop_model(model_name)
+    decoder = speculative_decoders.pop(model_name, None)
+    if decoder is not None:
+        decoder.close()
+    metrics.MODEL_MEMORY.set(0, model=model_name)
+
+# 名前付きモデルの遅延読み込みとメモリ予算に基づく解放を行うレジストリ
+model_registry = ModelRegistry(
+    load_model_task,
+    config.MODEL_NAMES,
+    memory_budget_bytes=int(config.MODEL_MEMORY_BUDGET_GB * 1024 ** 3),
+    retry_interval=config.MODEL_RETRY_INTERVAL,
+    on_evict=on_model_evicted,
+    on_load=on_model_loaded,
+    estimate_bytes=estimate_model_memory,
+)
+
+# /embeddings 用の埋め込みモデル（生成用のモデルとは別に、最初のリクエストで読み込んで常駐させる）
+embedding_registry = ModelRegistry(
+    load_embedding_task,
+    [config.EMBEDDING_MODEL_NAME],
+    retry_interval=config.MODEL_RETRY_INTERVAL,
+    on_evict=lambda model_name: metrics.MODEL_MEMORY.set(0, model=model_name),
+)
 
 print("FastAPIエンドポイントを定義しました。")
 
+# --- 複数ワーカーでの実行 ---
+def preload_models():
+    """fork する前に、親プロセスでデフォルトモデルを読み込む（ワーカーはその重みをコピーオンライトで共有する）"""
+    startup_stats.update(started_at=time.time(), time_to_ready=None, first_request_latency=None)
+    if not model_registry.load_now(config.MODEL_NAME):
+        print("preload_models: デフォルトモデルを読み込めませんでした。各ワーカーで読み込みを再試行します。")
+    if config.EMBEDDING_PRELOAD and not embedding_registry.load_now(config.EMBEDDING_MODEL_NAME):
+        print("preload_models: 埋め込みモデルを読み込めませんでした。各ワーカーで読み込みを再試行します。")
+
+def on_worker_forked(index):
+    """fork 直後の各ワーカーで、推論スレッド数をワーカー数で分け合う（親プロセスで調整・指定した場合はその値）"""
+    threads = thread_split["threads"] if thread_split["pinned"] else max(1, (os.cpu_count() or 1) // config.WORKERS)
+    torch.set_num_threads(threads)
+    print(f"ワーカー{index} (pid={os.getpid()}): torchのスレッド数={threads}")
+
+def serve(port):
+    """Config.WORKERS に応じて、1プロセスまたは fork した複数のワーカーでサーバーを起動する"""
+    if config.WORKERS <= 1:
+        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+        return
+    preload_models()
+    serve_forked(app, "0.0.0.0", port, config.WORKERS, on_fork=on_worker_forked)
+
 # --- ngrokでAPIサーバーを実行する関数 ---
 def run_with_ngrok(port=8501):
     """ngrokでFastAPIアプリを実行"""
@@ -307,7 +1653,7 @@ def run_with_ngrok(port=8501):
         print(f"📖 APIドキュメント (Swagger UI): {public_url}/docs")
         print("---------------------------------------------------------------------")
         print("(APIクライアントやブラウザからアクセスするためにこのURLをコピーしてください)")
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")  # ログレベルをinfoに設定
+        serve(port)
 
     except Exception as e:
         print(f"\n ngrokまたはUvicornの起動中にエラーが発生しました: {e}")
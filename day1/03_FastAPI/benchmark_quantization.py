@@ -0,0 +1,200 @@
+# benchmark_quantization.py
+# bf16 と int8 動的量子化で読み込んだモデルの、読み込み時間・メモリ使用量・生成速度・出力のずれを比較する
+#
+# 使い方:
+#   python benchmark_quantization.py --model elyza/ELYZA-japanese-CodeLlama-7b-instruct --max-new-tokens 64
+#   python benchmark_quantization.py --modes int8 --prompts prompts.txt --output result.json
+#
+# 読み込み方法ごとに別プロセスで計測する（同じプロセスで続けて読み込むとメモリ使用量を正しく測れないため）。
+# 出力のずれは、bf16 の貪欲法の出力を基準として計算する。
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_MODEL = "elyza/ELYZA-japanese-CodeLlama-7b-instruct"
+DEFAULT_PROMPTS = [
+    "AIについて教えてください",
+    "日本の首都はどこですか？",
+    "Pythonでリストを逆順にする方法を教えてください",
+    "機械学習と深層学習の違いを説明してください",
+]
+
+
+def current_rss_bytes():
+    """現在の常駐メモリ量（バイト）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """これまでの最大常駐メモリ量（バイト）。Linuxでは ru_maxrss の単位はKB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def load(mode, model_name):
+    """指定された方法でモデルとトークナイザーをCPU上に読み込む"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    model.eval()
+    if mode == "int8":
+        from quantization import quantize_linear_layers_int8
+
+        quantize_linear_layers_int8(model)
+    return model, tokenizer
+
+
+def common_prefix_ratio(a, b):
+    """基準の出力 b のうち、先頭から一致しているトークンの割合"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length / len(b) if b else 1.0
+
+
+def run_worker(mode, model_name, prompts, max_new_tokens, reference=None):
+    """1つの読み込み方法について計測する（子プロセスで実行）"""
+    import torch
+
+    rss_before = current_rss_bytes()
+    start_time = time.time()
+    model, tokenizer = load(mode, model_name)
+    load_time = time.time() - start_time
+    rss_after_load = current_rss_bytes()
+
+    # 初回呼び出しのオーバーヘッドを計測に含めないよう、短く1回生成しておく
+    with torch.no_grad():
+        warmup_ids = tokenizer(prompts[0], return_tensors="pt").input_ids
+        model.generate(input_ids=warmup_ids, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+
+    outputs = []
+    generated_tokens = 0
+    generation_time = 0.0
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        start_time = time.time()
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_ids=input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id
+            )
+        generation_time += time.time() - start_time
+        new_ids = output_ids[0, input_ids.shape[1]:].tolist()
+        generated_tokens += len(new_ids)
+        outputs.append({"prompt": prompt, "token_ids": new_ids, "text": tokenizer.decode(new_ids, skip_special_tokens=True)})
+
+    result = {
+        "mode": mode,
+        "load_time": load_time,
+        "rss_after_load_gb": rss_after_load / 1024 ** 3,
+        "model_rss_gb": (rss_after_load - rss_before) / 1024 ** 3,
+        "peak_rss_gb": peak_rss_bytes() / 1024 ** 3,
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": generated_tokens / generation_time if generation_time else None,
+        "outputs": outputs,
+    }
+
+    if reference is not None:
+        # 貪欲法の出力がどれだけ一致するかと、基準の出力を入力したときに次トークンの予測が一致する割合
+        exact, prefix_ratios, agreed, total = 0, [], 0, 0
+        for output, ref in zip(outputs, reference["outputs"]):
+            exact += output["token_ids"] == ref["token_ids"]
+            prefix_ratios.append(common_prefix_ratio(output["token_ids"], ref["token_ids"]))
+            if not ref["token_ids"]:
+                continue
+            prompt_ids = tokenizer(ref["prompt"], return_tensors="pt").input_ids
+            ref_ids = torch.tensor([ref["token_ids"]])
+            with torch.no_grad():
+                logits = model(input_ids=torch.cat([prompt_ids, ref_ids], dim=1)).logits
+            predicted = logits[0, prompt_ids.shape[1] - 1:-1].argmax(dim=-1)
+            agreed += int((predicted == ref_ids[0]).sum())
+            total += ref_ids.shape[1]
+        result["drift"] = {
+            "reference": reference["mode"],
+            "exact_match_rate": exact / len(outputs),
+            "mean_common_prefix_ratio": sum(prefix_ratios) / len(prefix_ratios),
+            "next_token_agreement": agreed / total if total else None,
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bf16 と int8 動的量子化の読み込み時間・メモリ・速度・出力のずれを比較する")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Hugging Face のモデル名")
+    parser.add_argument("--modes", nargs="+", default=["bf16", "int8"], choices=["bf16", "int8"], help="比較する読み込み方法")
+    parser.add_argument("--prompts", help="1行に1プロンプトを書いたテキストファイル（省略時は組み込みのプロンプト）")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="プロンプトごとに生成する最大トークン数")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--worker", choices=["bf16", "int8"], help=argparse.SUPPRESS)
+    parser.add_argument("--reference", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    prompts = DEFAULT_PROMPTS
+    if args.prompts:
+        with open(args.prompts, encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    if args.worker:
+        reference = None
+        if args.reference:
+            with open(args.reference, encoding="utf-8") as f:
+                reference = json.load(f)
+        result = run_worker(args.worker, args.model, prompts, args.max_new_tokens, reference)
+        with open(args.result, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        return
+
+    # 出力のずれの基準にするため、bf16 を先に計測する
+    modes = sorted(set(args.modes), key=["bf16", "int8"].index)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reference_path = None
+        for mode in modes:
+            result_path = os.path.join(tmpdir, f"{mode}.json")
+            command = [sys.executable, os.path.abspath(__file__), "--worker", mode, "--model", args.model,
+                       "--max-new-tokens", str(args.max_new_tokens), "--result", result_path]
+            if args.prompts:
+                command += ["--prompts", os.path.abspath(args.prompts)]
+            if reference_path and mode != "bf16":
+                command += ["--reference", reference_path]
+            print(f"計測中: {mode} ({args.model})")
+            subprocess.run(command, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            with open(result_path, encoding="utf-8") as f:
+                results.append(json.load(f))
+            if mode == "bf16":
+                reference_path = result_path
+
+    print(f"\n{'mode':<6} {'load(s)':>8} {'RSS(GB)':>8} {'peak(GB)':>9} {'tok/s':>8} {'一致率':>7} {'次トークン一致':>12}")
+    for result in results:
+        # 基準（bf16）自身や、基準を計測していない場合はずれを表示しない
+        drift = result.get("drift", {})
+        exact = drift.get("exact_match_rate")
+        agreement = drift.get("next_token_agreement")
+        print(
+            f"{result['mode']:<6} {result['load_time']:>8.1f} {result['rss_after_load_gb']:>8.2f} "
+            f"{result['peak_rss_gb']:>9.2f} {result['tokens_per_second'] or 0:>8.2f} "
+            f"{f'{exact:.2f}' if exact is not None else '-':>7} "
+            f"{f'{agreement:.3f}' if agreement is not None else '-':>12}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "max_new_tokens": args.max_new_tokens, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"結果を {args.output} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
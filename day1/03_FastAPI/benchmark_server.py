@@ -0,0 +1,294 @@
+# benchmark_server.py
+# 偽のバックエンド（fake_backend.py）でAPIサーバーをプロセス内で起動し、同時実行数ごとのスループットと遅延を測る
+#
+# 使い方:
+#   python benchmark_server.py                                    # 計測結果を表示する
+#   python benchmark_server.py --scenarios generate               # 一部のシナリオだけ計測する
+#   python benchmark_server.py --save-baseline benchmark_baseline.json
+#   python benchmark_server.py --baseline benchmark_baseline.json  # 基準より悪化していたら終了コード1
+#
+# モデルを読み込まず、HTTPサーバーも起動せずに（httpx の ASGITransport で app を直接呼び出す）、
+# スケジューラ・バッチ処理・キャッシュ・メトリクスなど、サーバー側の処理だけの性能の変化を確認できる。
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+# app の読み込み前に、偽のバックエンドを使い、ウォームアップを行わない設定にする
+os.environ["LOAD_MODE"] = "fake"
+os.environ["WARMUP_PROMPT_LENGTHS"] = ""
+os.environ.pop("DRAFT_MODEL_NAME", None)
+os.environ.pop("COMPILE_MODE", None)
+os.environ["THREAD_SPLIT"] = "off"
+
+DEFAULT_CONCURRENCY = [1, 4, 16]
+# 複数候補の生成（n / best_of）で1リクエストあたりに生成する候補の数
+NUM_SAMPLES = 2
+# プレフィックスのシナリオで登録する共通プレフィックス
+BENCHMARK_PREFIX = "あなたはベンチマーク用のアシスタントです。次の質問に簡潔に答えてください。" * 4
+# /chat のシナリオで1つの会話を続けるターン数（超えたら新しい会話を始める）
+CHAT_TURNS = 4
+# /embeddings のシナリオで1リクエストに含めるテキストの数
+EMBEDDING_TEXTS = 8
+# 基準と比べて、この割合を超えて悪化したら回帰とみなす
+DEFAULT_TOLERANCE = 0.2
+
+
+def summarize(scenario, concurrency, latencies, errors, duration, generated_tokens):
+    """1つのシナリオ・同時実行数での計測結果をまとめる"""
+    from scheduler import percentile
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "duration_seconds": duration,
+        "requests_per_second": len(latencies) / duration if duration else 0.0,
+        "tokens_per_second": generated_tokens / duration if duration else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+    }
+
+
+# シナリオごとの1リクエスト分の処理。(client, 同時実行数, 通し番号, max_new_tokens, クライアントごとの状態) を受け取り、
+# 成功した場合は生成したトークン数（偽のバックエンドは1文字1トークン。埋め込みは入力のトークン数）を、
+# 失敗した場合は None を返す
+
+async def request_generate(client, concurrency, index, max_new_tokens, state):
+    """/generate で1件ずつ生成する（マイクロバッチングでまとめられる）"""
+    # 応答キャッシュに当たらないよう、リクエストごとに異なるプロンプトを使う
+    payload = {
+        "prompt": f"ベンチマーク用のプロンプト {concurrency}-{index}",
+        "max_new_tokens": max_new_tokens,
+        "do_sample": False,
+        "use_cache": False,
+    }
+    response = await client.post("/generate", json=payload)
+    if response.status_code != 200:
+        return None
+    return len(response.json()["generated_text"])
+
+
+async def request_generate_n(client, concurrency, index, max_new_tokens, state):
+    """/generate の n で、プレフィルを共有して複数の候補を生成する"""
+    payload = {
+        "prompt": f"ベンチマーク用のプロンプト {concurrency}-{index}",
+        "max_new_tokens": max_new_tokens,
+        "do_sample": True,
+        "n": NUM_SAMPLES,
+    }
+    response = await client.post("/generate", json=payload)
+    if response.status_code != 200:
+        return None
+    return sum(len(candidate["text"]) for candidate in response.json()["candidates"])
+
+
+async def request_prefix(client, concurrency, index, max_new_tokens, state):
+    """登録済みプレフィックスで始まるプロンプトを /generate で生成する（プレフィックスのKVキャッシュを再利用する）"""
+    payload = {
+        "prompt": f"{BENCHMARK_PREFIX}質問 {concurrency}-{index}",
+        "max_new_tokens": max_new_tokens,
+        "do_sample": False,
+        "use_cache": False,
+    }
+    response = await client.post("/generate", json=payload)
+    if response.status_code != 200:
+        return None
+    return len(response.json()["generated_text"])
+
+
+async def request_chat(client, concurrency, index, max_new_tokens, state):
+    """/chat で会話を続ける（クライアントごとに CHAT_TURNS ターンずつ、前のターンのKVキャッシュを再利用する）"""
+    payload = {
+        "messages": [{"role": "user", "content": f"質問 {concurrency}-{index}"}],
+        "max_new_tokens": max_new_tokens,
+        "do_sample": False,
+    }
+    if state.get("turns", 0) % CHAT_TURNS:
+        payload["session_id"] = state["session_id"]
+    response = await client.post("/chat", json=payload)
+    if response.status_code != 200:
+        return None
+    result = response.json()
+    state["session_id"] = result["session_id"]
+    state["turns"] = state.get("turns", 0) + 1
+    return len(result["message"]["content"])
+
+
+async def request_embeddings(client, concurrency, index, max_new_tokens, state):
+    """/embeddings で EMBEDDING_TEXTS 件のテキストを埋め込む（他のリクエストのテキストとまとめて encode される）"""
+    texts = [f"ベンチマーク用の文書 {concurrency}-{index}-{i}" for i in range(EMBEDDING_TEXTS)]
+    response = await client.post("/embeddings", json={"texts": texts, "encoding_format": "float16"})
+    if response.status_code != 200:
+        return None
+    return sum(len(text) for text in texts)
+
+
+async def setup_prefix(client):
+    """プレフィックスのシナリオの前に、共通プレフィックスを登録する"""
+    response = await client.post("/prefixes", json={"prefix": BENCHMARK_PREFIX})
+    response.raise_for_status()
+
+
+async def setup_embeddings(client):
+    """埋め込みモデルは最初のリクエストで読み込まれるため、読み込みが終わるまで待つ"""
+    while (await client.post("/embeddings", json={"texts": ["準備"]})).status_code == 503:
+        await asyncio.sleep(0.05)
+
+
+# シナリオ名 -> (1リクエスト分の処理, 計測前の準備)
+SCENARIOS = {
+    "generate": (request_generate, None),
+    "generate_n": (request_generate_n, None),
+    "prefix": (request_prefix, setup_prefix),
+    "chat": (request_chat, None),
+    "embeddings": (request_embeddings, setup_embeddings),
+}
+
+
+async def run_level(client, scenario, concurrency, num_requests, max_new_tokens):
+    """concurrency 個のクライアントが、応答を受け取るたびに次のリクエストを送る（クローズドループ）"""
+    request_once, _ = SCENARIOS[scenario]
+    latencies = []
+    errors = 0
+    generated_tokens = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, generated_tokens, next_index
+        state = {}
+        while next_index < num_requests:
+            index = next_index
+            next_index += 1
+            start_time = time.perf_counter()
+            tokens = await request_once(client, concurrency, index, max_new_tokens, state)
+            elapsed = time.perf_counter() - start_time
+            if tokens is None:
+                errors += 1
+                continue
+            latencies.append(elapsed)
+            generated_tokens += tokens
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(scenario, concurrency, latencies, errors, time.perf_counter() - start_time, generated_tokens)
+
+
+async def run_benchmark(scenarios, concurrency_levels, requests_per_level, max_new_tokens):
+    import httpx
+
+    import app
+
+    await app.startup_event()
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app.app), base_url="http://benchmark", timeout=300
+        ) as client:
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            results = []
+            for scenario in scenarios:
+                _, setup = SCENARIOS[scenario]
+                if setup is not None:
+                    await setup(client)
+                for concurrency in concurrency_levels:
+                    num_requests = max(requests_per_level, concurrency)
+                    print(f"計測中: scenario={scenario}, concurrency={concurrency}, requests={num_requests}")
+                    results.append(await run_level(client, scenario, concurrency, num_requests, max_new_tokens))
+            return results, app.config.FAKE_TOKENS_PER_SECOND
+    finally:
+        await app.shutdown_event()
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    基準の計測結果と比べ、スループットの低下や遅延の増加が許容範囲を超えた項目を返す
+
+    Returns:
+        list: 回帰した項目の説明
+    """
+    regressions = []
+    # シナリオを持たない古い基準は generate だけを計測したもの
+    baseline_by_level = {
+        (result.get("scenario", "generate"), result["concurrency"]): result for result in baseline["results"]
+    }
+    for result in results:
+        base = baseline_by_level.get((result["scenario"], result["concurrency"]))
+        if base is None:
+            print(f"警告: 基準に scenario={result['scenario']}, concurrency={result['concurrency']} の計測結果がありません")
+            continue
+        level = f"{result['scenario']} concurrency={result['concurrency']}"
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{level}: errors {base['errors']} -> {result['errors']}")
+        if result["requests_per_second"] < base["requests_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{level}: requests_per_second {base['requests_per_second']:.2f} -> {result['requests_per_second']:.2f}"
+            )
+        for key in ("latency_p50", "latency_p95", "latency_p99"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{level}: {key} {base[key] * 1000:.1f}ms -> {result[key] * 1000:.1f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="偽のバックエンドでAPIサーバーのスループットと遅延を測る")
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS), help="計測するシナリオ（エンドポイント）"
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=DEFAULT_CONCURRENCY, help="計測する同時実行数")
+    parser.add_argument("--requests", type=int, default=32, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--max-new-tokens", type=int, default=16, help="リクエストごとに生成するトークン数")
+    parser.add_argument("--tokens-per-second", type=float, help="偽のバックエンドの生成速度（省略時は app.py の設定）")
+    parser.add_argument("--baseline", help="比較する基準のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="回帰とみなす悪化の割合")
+    parser.add_argument("--save-baseline", help="計測結果を基準として書き出すJSONファイル")
+    args = parser.parse_args()
+
+    if args.tokens_per_second:
+        os.environ["FAKE_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+
+    results, tokens_per_second = asyncio.run(
+        run_benchmark(args.scenarios, args.concurrency, args.requests, args.max_new_tokens)
+    )
+
+    print(
+        f"\n{'scenario':<12} {'conc':>5} {'reqs':>5} {'err':>4} {'RPS':>8} {'tok/s':>8} "
+        f"{'p50(ms)':>8} {'p95(ms)':>8} {'p99(ms)':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['scenario']:<12} {result['concurrency']:>5} {result['requests']:>5} {result['errors']:>4} "
+            f"{result['requests_per_second']:>8.2f} {result['tokens_per_second']:>8.1f} "
+            f"{result['latency_p50'] * 1000:>8.1f} {result['latency_p95'] * 1000:>8.1f} {result['latency_p99'] * 1000:>8.1f}"
+        )
+
+    report = {
+        "max_new_tokens": args.max_new_tokens,
+        "fake_tokens_per_second": tokens_per_second,
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"計測結果を {args.save_baseline} に書き出しました")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("max_new_tokens") != args.max_new_tokens:
+            print(f"警告: 基準の max_new_tokens ({baseline.get('max_new_tokens')}) と異なる条件で計測しています")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n基準（{args.baseline}）より悪化しています:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\n基準（{args.baseline}）から許容範囲（{args.tolerance:.0%}）を超える悪化はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# cache.py
+# 決定的な生成（do_sample=False）の応答を再利用するための、サイズ上限とTTL付きLRUキャッシュ
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """
+    表記揺れでキャッシュを外さないよう、Unicode正規化（NFC）を行う
+
+    前後の空白はトークン化と生成結果を変えるため、取り除かずにキーに含める。
+    """
+    return unicodedata.normalize("NFC", prompt)
+
+
+def make_cache_key(prompt, model_name, params):
+    """正規化したプロンプト、モデル名、生成パラメータからキャッシュキーを作る"""
+    # 投機的デコーディングの有無は出力に影響しないためキーに含めない
+    params = {k: v for k, v in params.items() if k != "speculative"}
+    if not params.get("do_sample"):
+        # 貪欲法では temperature / top_p は出力に影響しないためキーに含めない
+        params = {k: v for k, v in params.items() if k not in ("temperature", "top_p")}
+    return (normalize_prompt(prompt), model_name, tuple(sorted(params.items())))
+
+
+class ResponseCache:
+    """件数上限とTTLを持つLRUキャッシュ"""
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600):
+        """
+        初期化
+
+        Args:
+            max_entries (int): 保持する最大件数。超えた場合は最も古く使われたものから削除する
+            ttl_seconds (float): エントリの有効期間（秒）。0以下なら期限なし
+        """
+        self.max_entries = max(0, int(max_entries))
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (保存時刻, 値)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def is_cacheable(params):
+        """
+        出力がプロンプトとパラメータだけで決まる（サンプリングしない）場合のみキャッシュする
+
+        int8 動的量子化のモデルでは貪欲法でも出力がバッチの他の行に左右されるため、保存するかどうかは
+        生成結果の batch_dependent も見て決める（app.cacheable_result）。
+        """
+        return not params.get("do_sample")
+
+    def get(self, key):
+        """キャッシュされた値を返す。無い場合や期限切れの場合は None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, value = entry
+        if self.ttl_seconds and self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """値を保存し、上限を超えた分を古い順に追い出す"""
+        if self.max_entries == 0:
+            return
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """ヒット・ミス・追い出しの件数を返す"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,65 @@
+# embeddings.py
+# 埋め込みモデル（sentence-transformers）をサーバーに常駐させ、同時に届いた /embeddings のテキストをまとめて encode する
+#
+# day3 の RAG ノートブックのように各クライアントが SentenceTransformer を読み込む代わりに、
+# 1つの常駐モデルを複数の検索用ワーカーから共有する。
+import base64
+
+import numpy as np
+
+# mode -> SentenceTransformer.encode の prompt_name（day3 のノートブックと同じく、検索クエリにだけ "query" を付ける）
+EMBEDDING_PROMPT_NAMES = {"query": "query", "document": None}
+# 応答の形式: "float"（数値のリスト）/ "base64"（float32 のリトルエンディアンを base64）/ "float16"（float16 を base64）
+ENCODING_FORMATS = ("float", "base64", "float16")
+_BINARY_DTYPES = {"base64": "<f4", "float16": "<f2"}
+
+
+class EmbeddingPipeline:
+    """SentenceTransformer を ModelRegistry で管理できるよう、model 属性と encode を持たせたもの"""
+
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def dimensions(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, prompt_name=None, batch_size=32, normalize=False):
+        """
+        テキストのリストを (テキスト数, 次元数) の float32 配列にする
+
+        SentenceTransformer.encode が長さ順に並べてからミニバッチに分け、結果を元の順に戻すため、
+        複数のリクエストのテキストをまとめて渡しても、長さの近いものが同じミニバッチになりパディングは少ない。
+        """
+        if prompt_name is not None and prompt_name not in (getattr(self.model, "prompts", None) or {}):
+            # "query" のプロンプトを持たないモデルでは、クエリも文書と同じように encode する
+            prompt_name = None
+        return self.model.encode(
+            texts, prompt_name=prompt_name, batch_size=batch_size, normalize_embeddings=normalize,
+            convert_to_numpy=True, show_progress_bar=False,
+        ).astype(np.float32, copy=False)
+
+
+def load_embedding_pipeline(model_name, device=None, max_seq_length=None):
+    """sentence-transformers で埋め込みモデルを読み込む"""
+    # 埋め込みを使う場合だけ必要な依存関係なので、ここで import する
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, trust_remote_code=True, device=device)
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+    return EmbeddingPipeline(model)
+
+
+def encode_embeddings(matrix, encoding_format):
+    """
+    埋め込みの行列を応答の形式にする
+
+    Returns:
+        dict: "float" の場合は {"embeddings": リストのリスト}、それ以外は {"data": base64 文字列, "dtype": ...}
+            （data は (テキスト数, 次元数) の行優先のバイト列）
+    """
+    if encoding_format == "float":
+        return {"embeddings": matrix.tolist()}
+    dtype = _BINARY_DTYPES[encoding_format]
+    return {"data": base64.b64encode(matrix.astype(dtype).tobytes()).decode("ascii"), "dtype": dtype}
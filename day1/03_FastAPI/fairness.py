@@ -0,0 +1,195 @@
+# fairness.py
+# 優先度クラス間の厳密な優先と、クライアント間の重み付き公平キューイング（WFQ）、クライアントごとの利用上限
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# 優先度（高い順）は load_policy と共通。上位のクラスに待っているリクエストがある間は、下位のクラスは取り出さない
+from load_policy import PRIORITIES
+
+DEFAULT_CLIENT_ID = "anonymous"
+# トークンバケットを保持するクライアント数の上限（client_id はリクエストごとに任意に指定できるため）
+MAX_TRACKED_CLIENTS = 10000
+
+
+class QuotaExceededError(Exception):
+    """クライアントごとの同時実行数やトークンレートの上限を超えたことを表す例外"""
+
+    def __init__(self, client_id, reason, retry_after):
+        super().__init__(f"クライアント '{client_id}' の{reason}の上限を超えています。{retry_after}秒後に再試行してください。")
+        self.client_id = client_id
+        self.retry_after = retry_after
+
+
+class FairQueue:
+    """
+    優先度クラスごとに、クライアント間で重み付き公平キューイングを行う待ち行列
+
+    各リクエストには「仮想終了時刻」= max(クラスの仮想時刻, そのクライアントの前回の仮想終了時刻) + コスト / 重み
+    を割り当て、最も小さいものから取り出す。大量に送るクライアントほど仮想終了時刻が先に進むため、
+    少しずつ送る（対話的な）クライアントが後ろで待たされ続けることがない。
+    """
+
+    def __init__(self, weights=None, default_weight=1.0):
+        """
+        初期化
+
+        Args:
+            weights (dict, optional): クライアントID -> 重み。重みが大きいクライアントほど多く取り出される
+            default_weight (float): weights に無いクライアントの重み
+        """
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self._queues = {priority: {} for priority in PRIORITIES}  # クラス -> クライアントID -> deque[(仮想終了時刻, item)]
+        self._virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self._last_finish = {priority: {} for priority in PRIORITIES}
+        self._size = 0
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return self._size
+
+    def put(self, item, client_id, priority, cost=1.0):
+        """item を待ち行列に追加する（cost は生成する最大トークン数など、処理の重さの見積もり）"""
+        weight = self.weights.get(client_id, self.default_weight)
+        start = max(self._virtual_time[priority], self._last_finish[priority].get(client_id, 0.0))
+        finish = start + max(cost, 1.0) / max(weight, 1e-6)
+        self._last_finish[priority][client_id] = finish
+        self._queues[priority].setdefault(client_id, deque()).append((finish, item))
+        self._size += 1
+        self._changed.set()
+
+    def pop(self, predicate=None):
+        """
+        最も優先度が高いクラスから、仮想終了時刻が最小の item を取り出す
+
+        Args:
+            predicate (callable, optional): 取り出してよい item かを判定する関数（各クライアントの先頭だけを見る）
+
+        Returns:
+            取り出した item。条件を満たすものが無ければ None
+        """
+        for priority in PRIORITIES:
+            queues = self._queues[priority]
+            candidates = [
+                (queue[0][0], client_id) for client_id, queue in queues.items()
+                if predicate is None or predicate(queue[0][1])
+            ]
+            if not candidates:
+                if any(queues.values()):
+                    # 上位のクラスに（条件に合わない）リクエストが残っている間は、下位のクラスを追い越させない
+                    return None
+                continue
+            finish, client_id = min(candidates)
+            _, item = queues[client_id].popleft()
+            if not queues[client_id]:
+                del queues[client_id]
+                # 最後の1件を取り出したクライアントの仮想終了時刻はクラスの仮想時刻と同じになり、覚えておく必要が無い
+                self._last_finish[priority].pop(client_id, None)
+                if not queues:
+                    # 待ちが無くなったクラスは、次に来たクライアントが過去の分を取り戻さないよう記録を消す
+                    self._last_finish[priority].clear()
+            self._virtual_time[priority] = finish
+            self._size -= 1
+            return item
+        return None
+
+    async def wait(self, timeout=None):
+        """
+        item が追加されるまで待つ
+
+        Returns:
+            bool: timeout までに追加された場合は True
+        """
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def depths(self):
+        """優先度クラス・クライアントごとの待ち件数"""
+        return {
+            priority: {client_id: len(queue) for client_id, queue in queues.items()}
+            for priority, queues in self._queues.items()
+        }
+
+
+class ClientQuotas:
+    """クライアントごとの同時実行数（待ち＋実行中）とトークンレートの上限"""
+
+    def __init__(self, quotas=None, default=None, max_clients=MAX_TRACKED_CLIENTS):
+        """
+        初期化
+
+        Args:
+            quotas (dict, optional): クライアントID -> {"weight", "max_concurrency", "tokens_per_second", "burst_seconds"}
+            default (dict, optional): quotas に無いクライアントに適用する設定
+            max_clients (int): トークンバケットを保持するクライアント数の上限。超えたら満杯まで回復したものを削除し、
+                それでも多ければ最も古く使われたものから削除する
+        """
+        self.quotas = dict(quotas or {})
+        self.default = dict(default or {})
+        self.max_clients = max(1, int(max_clients))
+        self._outstanding = {}  # 待ち＋実行中の件数が0のクライアントは保持しない
+        self._buckets = OrderedDict()  # クライアントID -> (残りトークン数, 最終更新時刻)（末尾ほど最近使われた）
+
+    def quota(self, client_id):
+        return self.quotas.get(client_id, self.default)
+
+    def weights(self):
+        return {client_id: quota["weight"] for client_id, quota in self.quotas.items() if "weight" in quota}
+
+    def acquire(self, client_id, tokens):
+        """
+        1件分の枠を確保する。上限を超える場合は QuotaExceededError を送出する
+
+        トークンレートは、生成する最大トークン数をトークンバケットから先に差し引く。
+        """
+        quota = self.quota(client_id)
+        max_concurrency = quota.get("max_concurrency")
+        if max_concurrency and self._outstanding.get(client_id, 0) >= max_concurrency:
+            raise QuotaExceededError(client_id, "同時実行数", 1)
+        rate = quota.get("tokens_per_second")
+        if rate:
+            capacity = rate * quota.get("burst_seconds", 10)
+            now = time.monotonic()
+            available, updated_at = self._buckets.get(client_id, (capacity, now))
+            available = min(capacity, available + (now - updated_at) * rate)
+            # バケットの容量より大きい要求は、満杯になるまで待てば受け付ける
+            needed = min(tokens, capacity)
+            if available < needed:
+                self._buckets[client_id] = (available, now)
+                raise QuotaExceededError(client_id, "トークンレート", max(1, int((needed - available) / rate + 0.999)))
+            self._buckets[client_id] = (available - needed, now)
+            self._buckets.move_to_end(client_id)
+            if len(self._buckets) > self.max_clients:
+                self._prune_buckets(now)
+        self._outstanding[client_id] = self._outstanding.get(client_id, 0) + 1
+
+    def _prune_buckets(self, now):
+        """満杯まで回復したバケット（無いのと同じ）を削除し、それでも上限を超えていれば古く使われたものから削除する"""
+        for client_id, (available, updated_at) in list(self._buckets.items()):
+            rate = self.quota(client_id).get("tokens_per_second")
+            if not rate or available + (now - updated_at) * rate >= rate * self.quota(client_id).get("burst_seconds", 10):
+                del self._buckets[client_id]
+        # 毎回すべてを調べ直さないよう、上限より少し少なくなるまで削除する
+        while len(self._buckets) > self.max_clients * 0.9:
+            self._buckets.popitem(last=False)
+
+    def release(self, client_id):
+        """処理が終わった（または取り消された）1件分の枠を返す"""
+        count = self._outstanding.get(client_id, 0) - 1
+        if count > 0:
+            self._outstanding[client_id] = count
+        else:
+            self._outstanding.pop(client_id, None)
+
+    def stats(self):
+        return {
+            "outstanding": dict(self._outstanding),
+            "tracked_clients": len(self._buckets),
+            "quotas": self.quotas,
+            "default": self.default,
+        }
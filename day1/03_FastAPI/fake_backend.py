@@ -0,0 +1,234 @@
+# fake_backend.py
+# モデルをダウンロードせずにAPIサーバーの性能を測るための、決まった速度でトークンを返す偽の推論バックエンド
+#
+# app.py のバックエンドは「transformers の text-generation パイプラインと同じように呼び出せるオブジェクト」で、
+# tokenizer・model 属性を持ち、pipe(prompts, batch_size=..., max_new_tokens=..., ...) で生成結果を返す。
+# FakeTextGenerationPipeline はこのうちサーバーが使う部分（pipe.model の forward / generate を含む）だけを、
+# 実際の計算の代わりに sleep で再現する。
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from transformers import BatchEncoding, DynamicCache
+
+# 生成するテキストの元になる文章（プロンプトから決まる位置から切り出すので、同じプロンプトなら同じ応答になる）
+FAKE_RESPONSE_TEXT = (
+    "これはベンチマーク用の偽のモデルが生成した応答です。"
+    "実際のモデルの代わりに、決まった速度で決まったトークンを返します。"
+)
+
+
+class FakeTokenizer:
+    """1文字を1トークンとして扱う簡易トークナイザー"""
+
+    pad_token_id = 0
+    bos_token_id = 1
+    eos_token_id = 2
+    _offset = 3  # 特殊トークンの分だけ文字コードをずらす
+    vocab_size = 0x10000 + _offset  # 基本多言語面の文字まで
+
+    def __init__(self):
+        self.padding_side = "left"
+
+    def encode(self, text, add_special_tokens=True):
+        ids = [ord(c) + self._offset for c in text]
+        return [self.bos_token_id] + ids if add_special_tokens else ids
+
+    def __call__(self, text, add_special_tokens=True, return_tensors=None, **kwargs):
+        ids = self.encode(text, add_special_tokens=add_special_tokens)
+        if return_tensors == "pt":
+            return BatchEncoding({"input_ids": torch.tensor([ids])})
+        return BatchEncoding({"input_ids": ids})
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        return "".join(chr(i - self._offset) for i in ids if i >= self._offset)
+
+    def get_vocab(self):
+        return {}
+
+
+class FakeModel(torch.nn.Module):
+    """
+    パラメータを持たないモデル（メモリ使用量の集計やフックの登録先として使われる）
+
+    プレフィックスの登録・/chat・複数候補の生成のように、パイプラインを通さずにモデルの順伝播や generate を
+    直接呼ぶ処理のために、forward と generate も実際の計算の代わりに sleep で再現する。
+    past_key_values には、処理したトークン数だけ長さを持つ小さな DynamicCache を返す。
+    """
+
+    kv_dim = 8  # 偽のKVキャッシュの1トークンあたりの次元数
+
+    def __init__(self, tokenizer=None, tokens_per_second=50.0, prefill_tokens_per_second=2000.0, max_concurrency=1):
+        """
+        初期化
+
+        Args:
+            tokens_per_second (float): デコード1ステップ（バッチ全体で1トークンずつ）あたりの速度
+            prefill_tokens_per_second (float): プロンプトの読み込み（プレフィル）の速度
+            max_concurrency (int): 同時に実行できる生成の数。実際のモデルと同じく、超えた分は順番待ちになる
+        """
+        super().__init__()
+        self.tokenizer = tokenizer or FakeTokenizer()
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self._semaphore = threading.Semaphore(max(1, max_concurrency))
+        self.config = SimpleNamespace(eos_token_id=FakeTokenizer.eos_token_id)
+        self.generation_config = SimpleNamespace(eos_token_id=FakeTokenizer.eos_token_id)
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def get_memory_footprint(self):
+        return 0
+
+    def _response_ids(self, prompt_ids):
+        text = FAKE_RESPONSE_TEXT * 2
+        start = zlib.crc32(np.asarray(prompt_ids, dtype=np.int64).tobytes()) % len(FAKE_RESPONSE_TEXT)
+        return self.tokenizer.encode(text[start:start + len(FAKE_RESPONSE_TEXT)], add_special_tokens=False)
+
+    def _extend_cache(self, past_key_values, batch_size, length):
+        """past_key_values を length トークン分だけ伸ばす（無ければ作る）"""
+        cache = past_key_values if past_key_values is not None else DynamicCache()
+        if length > 0:
+            states = torch.zeros(batch_size, 1, length, self.kv_dim)
+            cache.update(states, states, 0)
+        return cache
+
+    def forward(self, input_ids=None, attention_mask=None, past_key_values=None, use_cache=True, **kwargs):
+        """プロンプトのプレフィルだけを行う（past_key_values の続きから）"""
+        with self._semaphore:
+            time.sleep(input_ids.numel() / self.prefill_tokens_per_second)
+        cache = self._extend_cache(past_key_values, input_ids.shape[0], input_ids.shape[1]) if use_cache else None
+        return SimpleNamespace(past_key_values=cache, logits=None)
+
+    def generate(self, input_ids=None, attention_mask=None, past_key_values=None, max_new_tokens=32,
+                 logits_processor=None, stopping_criteria=None, streamer=None, return_dict_in_generate=False,
+                 output_logits=False, **kwargs):
+        """
+        左パディング済みの input_ids の続きを生成する（past_key_values がある場合、その分のプレフィルは省く）
+
+        Returns:
+            torch.Tensor | SimpleNamespace: 入力と生成したトークンを並べたID列。return_dict_in_generate の場合は
+                sequences・past_key_values・logits（output_logits の場合）を持つオブジェクト
+        """
+        batch_size, start_length = input_ids.shape
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        prompt_ids = [row[mask.bool()].tolist() for row, mask in zip(input_ids, attention_mask)]
+        responses = [self._response_ids(ids) for ids in prompt_ids]
+        cached_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+        rows = input_ids.tolist()
+        finished = [False] * batch_size
+        logits = []
+
+        with self._semaphore:
+            time.sleep(sum(max(0, len(ids) - cached_length) for ids in prompt_ids) / self.prefill_tokens_per_second)
+            if streamer is not None:
+                streamer.put(torch.tensor(prompt_ids[0]))
+            for step in range(max_new_tokens):
+                for row, response in enumerate(responses):
+                    token = self.tokenizer.pad_token_id if finished[row] else response[step % len(response)]
+                    rows[row].append(token)
+                sequences = torch.tensor(rows)
+                if output_logits:
+                    # 生成したトークンのロジットだけを1にした分布
+                    step_logits = torch.zeros(batch_size, self.tokenizer.vocab_size)
+                    step_logits[torch.arange(batch_size), sequences[:, -1]] = 1.0
+                    logits.append(step_logits)
+                for processor in logits_processor or []:
+                    processor(sequences, None)
+                if streamer is not None:
+                    streamer.put(sequences[0, -1:])
+                if stopping_criteria is not None:
+                    done = stopping_criteria(sequences, None)
+                    finished = [f or bool(d) for f, d in zip(finished, done)]
+                time.sleep(1.0 / self.tokens_per_second)
+                if all(finished):
+                    break
+            if streamer is not None:
+                streamer.end()
+
+        sequences = torch.tensor(rows)
+        if not return_dict_in_generate:
+            return sequences
+        # 実際のモデルと同じく、最後に生成したトークンはまだキャッシュに入っていない
+        cache = self._extend_cache(past_key_values, batch_size, sequences.shape[1] - 1 - cached_length)
+        return SimpleNamespace(sequences=sequences, past_key_values=cache, logits=tuple(logits) if output_logits else None)
+
+
+class FakeTextGenerationPipeline:
+    """text-generation パイプラインの代わりに、設定した速度でトークンを生成したことにする"""
+
+    def __init__(self, tokens_per_second=50.0, prefill_tokens_per_second=2000.0, max_concurrency=1):
+        """
+        初期化
+
+        Args:
+            tokens_per_second (float): デコード1ステップ（バッチ全体で1トークンずつ）あたりの速度
+            prefill_tokens_per_second (float): プロンプトの読み込み（プレフィル）の速度
+            max_concurrency (int): 同時に実行できる生成の数。実際のモデルと同じく、超えた分は順番待ちになる
+        """
+        self.tokenizer = FakeTokenizer()
+        self.model = FakeModel(self.tokenizer, tokens_per_second, prefill_tokens_per_second, max_concurrency)
+
+    def __call__(self, prompts, max_new_tokens=32, logits_processor=None, stopping_criteria=None, streamer=None,
+                 **kwargs):
+        single = isinstance(prompts, str)
+        prompts = [prompts] if single else list(prompts)
+        prompt_ids = [self.tokenizer.encode(prompt) for prompt in prompts]
+        start_length = max(len(ids) for ids in prompt_ids)
+        # 左パディングした入力
+        pad = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([[pad] * (start_length - len(ids)) + ids for ids in prompt_ids])
+        attention_mask = torch.tensor([[0] * (start_length - len(ids)) + [1] * len(ids) for ids in prompt_ids])
+        rows = self.model.generate(
+            input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens,
+            logits_processor=logits_processor, stopping_criteria=stopping_criteria, streamer=streamer,
+        )
+
+        outputs = [
+            [{"generated_text": prompt + self.tokenizer.decode(row[start_length:], skip_special_tokens=True)}]
+            for prompt, row in zip(prompts, rows)
+        ]
+        return outputs[0] if single else outputs
+
+
+def load_fake_pipeline(tokens_per_second=50.0, prefill_tokens_per_second=2000.0):
+    """偽のバックエンドを作る（モデルのダウンロードや重みの読み込みは行わない）"""
+    return FakeTextGenerationPipeline(tokens_per_second, prefill_tokens_per_second)
+
+
+class FakeEmbeddingPipeline:
+    """埋め込みモデルの代わりに、パディングを含めたトークン数に比例する時間をかけて決まったベクトルを返す"""
+
+    def __init__(self, tokens_per_second=2000.0, dimensions=64):
+        self.tokenizer = FakeTokenizer()
+        self.model = FakeModel()
+        self.tokens_per_second = tokens_per_second
+        self.dimensions = dimensions
+
+    def encode(self, texts, prompt_name=None, batch_size=32, normalize=False):
+        # SentenceTransformer.encode と同じく、長さ順に並べてからミニバッチに分ける
+        ordered = sorted(texts, key=len, reverse=True)
+        for offset in range(0, len(ordered), batch_size):
+            # ミニバッチは最も長いテキストに合わせてパディングされる
+            batch = ordered[offset:offset + batch_size]
+            time.sleep(len(batch) * max(len(text) for text in batch) / self.tokens_per_second)
+        vectors = np.stack([
+            np.random.default_rng(zlib.crc32(f"{prompt_name}:{text}".encode("utf-8"))).standard_normal(self.dimensions)
+            for text in texts
+        ]).astype(np.float32)
+        if normalize:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+def load_fake_embedding_pipeline(tokens_per_second=2000.0):
+    """偽の埋め込みバックエンドを作る"""
+    return FakeEmbeddingPipeline(tokens_per_second)
@@ -0,0 +1,306 @@
+# load_generator.py
+# python-client.py の LLMClient を使い、ポアソン到着（オープンループ）で生成リクエストを送る負荷生成ツール
+#
+# 使い方:
+#   python load_generator.py --url http://localhost:8501 --prompts prompts.jsonl --rate 2 --duration 60
+#   python load_generator.py --url ... --prompts prompts.jsonl --rate 5 --num-requests 500 --csv result.csv --json result.json
+#
+# prompts.jsonl は1行に1つの JSON で、"prompt" と任意の生成パラメータ（max_new_tokens, temperature, top_p, do_sample）を書く:
+#   {"prompt": "AIについて100文字で教えてください", "max_new_tokens": 128}
+#
+# 応答を待ってから次を送るクローズドループの計測では、サーバーが詰まると送信も遅くなるため待ち行列の崩壊が見えない。
+# ここでは応答時間と無関係に、指定した平均レートの指数分布の間隔でリクエストを送り、遅延は予定した送信時刻から測る。
+import argparse
+import csv
+import importlib.util
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# 1回の生成リクエストに渡せるパラメータ（prompts.jsonl の各行から読み取る）
+GENERATION_KEYS = ("max_new_tokens", "temperature", "top_p", "do_sample")
+# 予定した送信時刻から実際の送信までの遅れがこれを超えたら、負荷生成側が追いついていないと警告する
+MAX_SEND_LAG_SECONDS = 0.1
+
+
+def load_client_module():
+    """ファイル名にハイフンを含む python-client.py をモジュールとして読み込む"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python-client.py")
+    spec = importlib.util.spec_from_file_location("python_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+python_client = load_client_module()
+
+
+def read_prompts(path):
+    """JSONL ファイルからプロンプトと生成パラメータの dict のリストを読み込む"""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if "prompt" not in item:
+                raise ValueError(f"{path}:{line_number}: \"prompt\" がありません")
+            items.append(item)
+    if not items:
+        raise ValueError(f"{path}: プロンプトがありません")
+    return items
+
+
+def percentile(values, q):
+    """値のリストから q パーセンタイル（0〜100）を返す。値が無ければ None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def stream_generate(client, item, params, scheduled_at):
+    """
+    LLMClient.generate_stream で応答を最後まで読み、予定した送信時刻から最初のテキスト片までの時間を測る
+
+    Returns:
+        dict: 最初のテキスト片までの時間、受信したテキスト片の数、完了時の生成結果
+    """
+    first_chunk_at = None
+    chunks = 0
+    result = {}
+    for event in client.generate_stream(item["prompt"], **params):
+        if event.get("done"):
+            result = event
+        else:
+            if first_chunk_at is None:
+                first_chunk_at = time.time()
+            chunks += 1
+    return {"ttft": first_chunk_at - scheduled_at if first_chunk_at else None, "chunks": chunks, "summary": result}
+
+
+def send_request(client, index, item, scheduled_at, started_at, stream):
+    """1件のリクエストを送り、結果を1行分の記録として返す"""
+    params = {key: item[key] for key in GENERATION_KEYS if key in item}
+    record = {
+        "index": index,
+        "scheduled_at": scheduled_at - started_at,
+        "send_lag": time.time() - scheduled_at,
+        "status": "ok",
+        "http_status": 200,
+        "latency": None,
+        "ttft": None,
+        "chunks": None,
+        "finish_reason": None,
+        "error": None,
+    }
+    try:
+        if stream:
+            result = stream_generate(client, item, params, scheduled_at)
+            record["ttft"] = result["ttft"]
+            record["chunks"] = result["chunks"]
+            record["finish_reason"] = result["summary"].get("finish_reason")
+        else:
+            result = client.generate(item["prompt"], **params)
+            record["finish_reason"] = result.get("finish_reason")
+    except python_client.APIError as e:
+        # 待ち行列が一杯のときの 503 は、サーバーが過負荷で受け付けを拒否したものとして区別する
+        record["status"] = "rejected" if e.status_code == 503 else "error"
+        record["http_status"] = e.status_code
+        record["error"] = str(e)[:200]
+    except requests.Timeout as e:
+        record["status"] = "timeout"
+        record["http_status"] = None
+        record["error"] = str(e)[:200]
+    except requests.RequestException as e:
+        record["status"] = "error"
+        record["http_status"] = None
+        record["error"] = str(e)[:200]
+    finished_at = time.time()
+    # 送信が遅れた分も含めて、予定した送信時刻から測る（協調的な欠落を避ける）
+    record["latency"] = finished_at - scheduled_at
+    record["finished_at"] = finished_at - started_at
+    return record
+
+
+def run_open_loop(url, items, rate, duration=None, num_requests=None, stream=True, max_workers=256, timeout=None,
+                  seed=None):
+    """
+    平均 rate 件/秒のポアソン到着でリクエストを送る
+
+    送信は応答を待たずに行うため、サーバーが遅くなっても送信レートは変わらない。
+    duration 秒が経過するか num_requests 件を送ったら送信を止め、送信済みのリクエストの完了を待つ。
+
+    Returns:
+        list: リクエストごとの記録
+    """
+    rng = random.Random(seed)
+    local = threading.local()
+
+    def client():
+        # requests.Session はスレッド間で共有しないほうが安全なので、スレッドごとにクライアントを作る
+        if not hasattr(local, "client"):
+            local.client = python_client.LLMClient(url, timeout=timeout)
+        return local.client
+
+    def task(index, item, scheduled_at):
+        return send_request(client(), index, item, scheduled_at, started_at, stream)
+
+    futures = []
+    started_at = time.time()
+    next_at = started_at
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        index = 0
+        while num_requests is None or index < num_requests:
+            next_at += rng.expovariate(rate)
+            if duration is not None and next_at - started_at >= duration:
+                break
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(task, index, items[index % len(items)], next_at))
+            index += 1
+        print(f"{index}件を送信しました。完了を待っています...")
+        return [future.result() for future in futures]
+
+
+def summarize(records, elapsed):
+    """全体の達成スループット・エラー率・遅延とTTFTのパーセンタイルをまとめる"""
+    ok = [r for r in records if r["status"] == "ok"]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    statuses = {}
+    for record in records:
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+    send_span = max((r["scheduled_at"] for r in records), default=0.0)
+    return {
+        "requests": len(records),
+        "offered_rate": len(records) / send_span if send_span else None,
+        "achieved_throughput": len(ok) / elapsed if elapsed else None,
+        "elapsed_seconds": elapsed,
+        "statuses": statuses,
+        "error_rate": (len(records) - len(ok)) / len(records) if records else None,
+        "latency": {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+        "ttft": {f"p{q}": percentile(ttfts, q) for q in (50, 95, 99)},
+        "max_send_lag": max((r["send_lag"] for r in records), default=0.0),
+    }
+
+
+def summarize_windows(records, interval):
+    """
+    interval 秒ごとの時系列を作る
+
+    送信数は予定した送信時刻で、完了数・エラー・遅延は完了した時刻で区切る（過負荷になると完了が後ろにずれていく様子が見える）。
+    """
+    if not records:
+        return []
+    last = max(max(r["finished_at"] for r in records), max(r["scheduled_at"] for r in records))
+    windows = []
+    for number in range(int(last // interval) + 1):
+        start, end = number * interval, (number + 1) * interval
+        finished = [r for r in records if start <= r["finished_at"] < end]
+        ok = [r for r in finished if r["status"] == "ok"]
+        ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+        windows.append({
+            "start": start,
+            "sent": sum(1 for r in records if start <= r["scheduled_at"] < end),
+            "completed": len(ok),
+            "errors": len(finished) - len(ok),
+            "throughput": len(ok) / interval,
+            "error_rate": (len(finished) - len(ok)) / len(finished) if finished else None,
+            "latency_p50": percentile([r["latency"] for r in ok], 50),
+            "latency_p95": percentile([r["latency"] for r in ok], 95),
+            "latency_p99": percentile([r["latency"] for r in ok], 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p95": percentile(ttfts, 95),
+            "ttft_p99": percentile(ttfts, 99),
+        })
+    return windows
+
+
+def format_seconds(value):
+    return f"{value * 1000:.0f}" if value is not None else "-"
+
+
+def print_report(summary, windows):
+    print(f"\n{'start(s)':>8} {'sent':>5} {'ok':>5} {'err':>4} {'thr/s':>6} "
+          f"{'p50(ms)':>8} {'p95(ms)':>8} {'p99(ms)':>8} {'ttft50':>7} {'ttft95':>7} {'ttft99':>7}")
+    for w in windows:
+        print(
+            f"{w['start']:>8.0f} {w['sent']:>5} {w['completed']:>5} {w['errors']:>4} {w['throughput']:>6.2f} "
+            f"{format_seconds(w['latency_p50']):>8} {format_seconds(w['latency_p95']):>8} "
+            f"{format_seconds(w['latency_p99']):>8} {format_seconds(w['ttft_p50']):>7} "
+            f"{format_seconds(w['ttft_p95']):>7} {format_seconds(w['ttft_p99']):>7}"
+        )
+    print(f"\nリクエスト数: {summary['requests']} ({summary['statuses']})")
+    offered = summary["offered_rate"]
+    print(f"送信レート: {offered:.2f}件/秒" if offered else "送信レート: -")
+    print(f"達成スループット: {summary['achieved_throughput']:.2f}件/秒, エラー率: {summary['error_rate']:.1%}")
+    print("遅延(ms): " + ", ".join(f"{k}={format_seconds(v)}" for k, v in summary["latency"].items()))
+    print("TTFT(ms): " + ", ".join(f"{k}={format_seconds(v)}" for k, v in summary["ttft"].items()))
+    if summary["max_send_lag"] > MAX_SEND_LAG_SECONDS:
+        print(f"警告: 送信が予定より最大 {summary['max_send_lag']:.2f}秒遅れました。"
+              f"--max-workers を増やすか、レートを下げてください（オープンループになっていない可能性があります）")
+
+
+def write_csv(path, records):
+    fields = ["index", "scheduled_at", "send_lag", "finished_at", "status", "http_status", "latency", "ttft",
+              "chunks", "finish_reason", "error"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({field: record.get(field) for field in fields})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ポアソン到着（オープンループ）で生成リクエストを送り、スループットと遅延を測る")
+    parser.add_argument("--url", required=True, help="API のベース URL")
+    parser.add_argument("--prompts", required=True, help="プロンプトの JSONL ファイル（順に繰り返し使う）")
+    parser.add_argument("--rate", type=float, required=True, help="平均の送信レート（件/秒）")
+    parser.add_argument("--duration", type=float, help="送信を続ける秒数")
+    parser.add_argument("--num-requests", type=int, help="送信するリクエスト数")
+    parser.add_argument("--no-stream", action="store_true", help="/generate を使う（TTFT は測れない）")
+    parser.add_argument("--interval", type=float, default=10.0, help="時系列で集計する間隔（秒）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--max-workers", type=int, default=256, help="同時に応答を待てるリクエスト数の上限")
+    parser.add_argument("--seed", type=int, help="到着間隔の乱数シード")
+    parser.add_argument("--csv", help="リクエストごとの記録を書き出す CSV ファイル")
+    parser.add_argument("--json", help="集計結果と記録を書き出す JSON ファイル")
+    args = parser.parse_args()
+    if args.duration is None and args.num_requests is None:
+        parser.error("--duration か --num-requests のどちらかを指定してください")
+
+    items = read_prompts(args.prompts)
+    print(f"送信開始: rate={args.rate}件/秒, duration={args.duration}, num_requests={args.num_requests}")
+    started_at = time.time()
+    records = run_open_loop(
+        args.url, items, args.rate, duration=args.duration, num_requests=args.num_requests,
+        stream=not args.no_stream, max_workers=args.max_workers, timeout=args.timeout, seed=args.seed,
+    )
+    summary = summarize(records, time.time() - started_at)
+    windows = summarize_windows(records, args.interval)
+    print_report(summary, windows)
+
+    if args.csv:
+        write_csv(args.csv, records)
+        print(f"記録を {args.csv} に書き出しました")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summary": summary, "windows": windows, "records": records},
+                      f, ensure_ascii=False, indent=2)
+        print(f"集計結果を {args.json} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
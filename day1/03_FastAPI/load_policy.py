@@ -0,0 +1,107 @@
+# load_policy.py
+# 待ち行列の長さとデコード速度から負荷の高さを求め、生成トークン数の上限を段階的に減らし、優先度の低いリクエストから断る
+import threading
+
+# 優先度（高い順）。"high" は生成トークン数を減らさず、待ち行列が一杯になるまで断らない
+PRIORITIES = ("high", "normal", "low")
+
+
+class LoadSheddingError(Exception):
+    """負荷が高いため、優先度の低いリクエストを受け付けないことを表す例外"""
+
+    def __init__(self, priority, pressure, retry_after):
+        super().__init__(f"サーバーの負荷が高いため、優先度 '{priority}' のリクエストを受け付けられません (負荷={pressure:.2f})")
+        self.priority = priority
+        self.pressure = pressure
+        self.retry_after = retry_after
+
+
+class LoadPolicy:
+    """
+    負荷（0〜1）に応じて max_new_tokens を減らし、一定以上の負荷では優先度の低いリクエストを断る
+
+    負荷は次の2つのうち大きい方:
+      - 待ち行列の長さ: queue_start 件で0、queue_full 件で1になる
+      - 1系列あたりのデコード速度（直近の指数移動平均）: target_tokens_per_second で0、min_tokens_per_second で1になる
+    """
+
+    def __init__(self, queue_start=4, queue_full=32, target_tokens_per_second=0.0, min_tokens_per_second=0.0,
+                 min_budget_factor=0.25, min_max_new_tokens=16, shed_low_at=0.5, shed_normal_at=1.0, retry_after=5):
+        """
+        初期化
+
+        Args:
+            queue_start (int): 生成トークン数を減らし始める待ち行列の長さ
+            queue_full (int): 負荷を1とみなす待ち行列の長さ
+            target_tokens_per_second (float): デコード速度がこれを下回ると減らし始める。0ならデコード速度は見ない
+            min_tokens_per_second (float): 負荷を1とみなすデコード速度
+            min_budget_factor (float): 負荷が1のときに、要求された max_new_tokens に掛ける割合
+            min_max_new_tokens (int): 減らした場合でも下回らない max_new_tokens
+            shed_low_at (float): 優先度 "low" を断り始める負荷
+            shed_normal_at (float): 優先度 "normal" を断り始める負荷
+            retry_after (int): 断ったときに返す Retry-After（秒）
+        """
+        self.queue_start = queue_start
+        self.queue_full = max(queue_full, queue_start + 1)
+        self.target_tokens_per_second = target_tokens_per_second
+        self.min_tokens_per_second = min_tokens_per_second
+        self.min_budget_factor = min_budget_factor
+        self.min_max_new_tokens = min_max_new_tokens
+        self.shed_thresholds = {"low": shed_low_at, "normal": shed_normal_at}
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.decode_rate = None  # 1系列あたりのデコード速度（トークン/秒）の指数移動平均
+
+        self.degraded = 0
+        self.shed = {priority: 0 for priority in PRIORITIES}
+
+    def observe_decode(self, tokens, seconds, alpha=0.3):
+        """1回の生成で1系列あたりに生成したトークン数とデコード時間を記録する（推論スレッドから呼ばれる）"""
+        if not seconds or seconds <= 0 or tokens <= 0:
+            return
+        rate = tokens / seconds
+        with self._lock:
+            self.decode_rate = rate if self.decode_rate is None else (1 - alpha) * self.decode_rate + alpha * rate
+
+    def pressure(self, queue_depth):
+        """現在の負荷（0〜1）"""
+        queue_pressure = (queue_depth - self.queue_start) / (self.queue_full - self.queue_start)
+        rate_pressure = 0.0
+        target, floor = self.target_tokens_per_second, self.min_tokens_per_second
+        if target > 0 and self.decode_rate is not None and target > floor:
+            rate_pressure = (target - self.decode_rate) / (target - floor)
+        return min(1.0, max(0.0, queue_pressure, rate_pressure))
+
+    def apply(self, max_new_tokens, priority, queue_depth):
+        """
+        リクエストに適用する max_new_tokens を決める
+
+        Returns:
+            tuple: (適用する max_new_tokens, 負荷)
+
+        Raises:
+            LoadSheddingError: 負荷が優先度ごとの閾値を超えている場合
+        """
+        pressure = self.pressure(queue_depth)
+        threshold = self.shed_thresholds.get(priority)
+        if threshold is not None and pressure >= threshold:
+            with self._lock:
+                self.shed[priority] += 1
+            raise LoadSheddingError(priority, pressure, self.retry_after)
+        if priority == "high" or pressure <= 0:
+            return max_new_tokens, pressure
+        # 負荷に比例して、要求された値から min_budget_factor 倍まで少しずつ減らす
+        factor = 1.0 - pressure * (1.0 - self.min_budget_factor)
+        budget = min(max_new_tokens, max(self.min_max_new_tokens, int(max_new_tokens * factor)))
+        if budget < max_new_tokens:
+            with self._lock:
+                self.degraded += 1
+        return budget, pressure
+
+    def stats(self, queue_depth):
+        return {
+            "pressure": self.pressure(queue_depth),
+            "decode_tokens_per_second": self.decode_rate,
+            "degraded": self.degraded,
+            "shed": dict(self.shed),
+        }
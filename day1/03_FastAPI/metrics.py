@@ -0,0 +1,266 @@
+# metrics.py
+# Prometheus のテキスト形式で公開するメトリクス（外部ライブラリ無しの最小実装）
+import threading
+import time
+
+from transformers import LogitsProcessor
+
+# レイテンシ用のバケット（秒）。CPUでの長い生成も区別できるよう60秒超まで用意する
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# トークン/秒用のバケット
+THROUGHPUT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """ラベルごとの値を保持するメトリクスの基底クラス"""
+
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()  # 推論スレッドからも更新されるため
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            samples = self._samples()
+        for suffix, labelnames, labelvalues, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labelnames, labelvalues)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [("_total", self.labelnames, key, value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """任意に増減する値。取得時に関数を呼び出して値を決めることもできる"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """スクレイプ時に function() の戻り値を値として使う"""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def _samples(self):
+        values = dict(self._values)
+        for key, function in self._functions.items():
+            values[key] = function()
+        return [("", self.labelnames, key, value) for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    """値の分布をバケットごとに数えるヒストグラム"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        with self._lock:
+            key = self._key(labels)
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _samples(self):
+        samples = []
+        labelnames = self.labelnames + ("le",)
+        for key, state in self._values.items():
+            for bound, count in zip(self.buckets, state["counts"]):
+                samples.append(("_bucket", labelnames, key + (_format_value(bound),), count))
+            samples.append(("_sum", self.labelnames, key, state["sum"]))
+            samples.append(("_count", self.labelnames, key, state["count"]))
+        return samples
+
+
+class Registry:
+    """メトリクスをまとめて Prometheus のテキスト形式に変換する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class GenerationTimer(LogitsProcessor):
+    """
+    generate のデコードステップごとに呼ばれ、プレフィルとデコードの時間を測るロジットプロセッサ
+
+    最初の呼び出しはプロンプト全体の順伝播（プレフィル）が終わった直後になる。
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.first_step_at = None
+        self.last_step_at = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        now = time.time()
+        if self.first_step_at is None:
+            self.first_step_at = now
+        self.last_step_at = now
+        self.steps += 1
+        return scores
+
+    @property
+    def prefill_time(self):
+        return self.first_step_at - self.started_at if self.first_step_at is not None else None
+
+    @property
+    def decode_time(self):
+        return self.last_step_at - self.first_step_at if self.first_step_at is not None else None
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+QUEUE_WAIT = registry.histogram("llm_queue_wait_seconds", "推論開始までの待ち時間", ["model"])
+PREFILL_TIME = registry.histogram("llm_prefill_seconds", "プロンプトのプレフィルにかかった時間（バッチ単位）", ["model"])
+DECODE_TIME = registry.histogram("llm_decode_seconds", "トークンのデコードにかかった時間（バッチ単位）", ["model"])
+REQUEST_LATENCY = registry.histogram("llm_request_duration_seconds", "リクエスト受信から応答完了までの時間", ["model", "endpoint"])
+TOKENS_PER_SECOND = registry.histogram(
+    "llm_decode_tokens_per_second", "デコード中の生成トークン/秒（バッチ単位）", ["model"], buckets=THROUGHPUT_BUCKETS
+)
+PROMPT_TOKENS = registry.counter("llm_prompt_tokens", "入力されたプロンプトのトークン数", ["model"])
+COMPLETION_TOKENS = registry.counter("llm_completion_tokens", "生成されたトークン数", ["model"])
+REQUESTS = registry.counter("llm_requests", "処理したリクエスト数", ["model", "endpoint", "status"])
+IN_FLIGHT = registry.gauge("llm_requests_in_flight", "推論中のリクエスト数", ["model"])
+QUEUE_DEPTH = registry.gauge("llm_queue_depth", "推論開始を待っているリクエスト数", ["model"])
+MODEL_LOAD_TIME = registry.gauge("llm_model_load_seconds", "モデルの読み込みにかかった時間", ["model"])
+MODEL_MEMORY = registry.gauge("llm_model_memory_bytes", "常駐しているモデルのメモリ使用量", ["model"])
+TIME_TO_READY = registry.gauge("llm_time_to_ready_seconds", "起動からデフォルトモデルが推論可能になるまでの時間（ウォームアップ込み）")
+FIRST_REQUEST_LATENCY = registry.gauge("llm_first_request_seconds", "起動後最初のリクエストの応答時間")
+FINISH_REASONS = registry.counter("llm_finish_reasons", "生成を終えた理由ごとのリクエスト数", ["model", "reason"])
+WASTED_TOKENS = registry.counter(
+    "llm_wasted_tokens", "クライアントに届かなかった生成トークン数（切断・停止文字列以降）", ["model", "reason"]
+)
+LOAD_PRESSURE = registry.gauge("llm_load_pressure", "待ち行列の長さとデコード速度から求めた負荷（0〜1）")
+SHED_REQUESTS = registry.counter("llm_shed_requests", "負荷が高いために断ったリクエスト数", ["priority"])
+CLIENT_QUEUE_WAIT = registry.histogram(
+    "llm_client_queue_wait_seconds", "クライアント・優先度ごとの推論開始までの待ち時間", ["client", "priority"]
+)
+QUOTA_REJECTIONS = registry.counter("llm_quota_rejections", "クライアントごとの上限を超えたために断ったリクエスト数", ["client"])
+EMBEDDING_TEXTS = registry.counter("llm_embedding_texts", "/embeddings で埋め込んだテキスト数", ["model", "mode"])
+EMBEDDING_BATCH_SIZE = registry.histogram(
+    "llm_embedding_batch_size", "1回の encode にまとめたテキスト数", ["model"], buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+CHAT_SESSIONS = registry.gauge("llm_chat_sessions", "保持している /chat の会話セッション数")
+CHAT_CACHE_BYTES = registry.gauge("llm_chat_cache_bytes", "会話セッションが保持している past_key_values の合計サイズ")
+CHAT_REUSED_TOKENS = registry.counter(
+    "llm_chat_reused_tokens", "/chat で前のターンのKVキャッシュを再利用し、プレフィルを省いたトークン数", ["model"]
+)
+DRAFT_TOKENS = registry.counter("llm_speculative_draft_tokens", "ドラフトモデルが提案したトークン数", ["model"])
+ACCEPTED_TOKENS = registry.counter("llm_speculative_accepted_tokens", "本体モデルが受理したドラフトのトークン数", ["model"])
+SPECULATIVE_SPEEDUP = registry.histogram(
+    "llm_speculative_speedup", "投機的デコーディングによる推定速度向上率（リクエスト単位）", ["model"],
+    buckets=(0.5, 0.75, 1, 1.25, 1.5, 2, 2.5, 3, 4),
+)
+
+# クライアントIDをラベルにする数の上限（超えた分は "other" にまとめ、時系列が際限なく増えないようにする）
+MAX_CLIENT_LABELS = 100
+_client_labels = set()
+
+
+def client_label(client_id):
+    """クライアントIDをメトリクスのラベル値にする"""
+    if client_id not in _client_labels:
+        if len(_client_labels) >= MAX_CLIENT_LABELS:
+            return "other"
+        _client_labels.add(client_id)
+    return client_id
+
+
+def observe_generation(model_name, timer, prompt_tokens, completion_tokens):
+    """1回の生成（バッチ）分の時間とトークン数を記録する"""
+    PROMPT_TOKENS.inc(prompt_tokens, model=model_name)
+    COMPLETION_TOKENS.inc(completion_tokens, model=model_name)
+    if timer.prefill_time is not None:
+        PREFILL_TIME.observe(timer.prefill_time, model=model_name)
+    decode_time = timer.decode_time
+    if decode_time:
+        DECODE_TIME.observe(decode_time, model=model_name)
+        TOKENS_PER_SECOND.observe(completion_tokens / decode_time, model=model_name)
+
+
+def observe_speculative(model_name, run):
+    """1回の投機的デコーディングの提案・受理トークン数と推定速度向上率を記録する"""
+    DRAFT_TOKENS.inc(run.draft_tokens, model=model_name)
+    ACCEPTED_TOKENS.inc(run.accepted_tokens, model=model_name)
+    if run.estimated_speedup is not None:
+        SPECULATIVE_SPEEDUP.observe(run.estimated_speedup, model=model_name)
@@ -0,0 +1,291 @@
+# model_registry.py
+# 複数のモデルを名前で管理し、必要になったときに読み込み、メモリ予算を超えたら使われていない順に解放する
+import gc
+import glob
+import json
+import math
+import os
+import struct
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import torch
+from huggingface_hub import get_safetensors_metadata
+
+from quantization import quantized_weight_nbytes
+
+
+def model_memory_footprint(pipe):
+    """パイプラインのモデルが使用しているメモリ量（バイト）を返す"""
+    try:
+        nbytes = pipe.model.get_memory_footprint()
+    except Exception:
+        nbytes = sum(p.numel() * p.element_size() for p in pipe.model.parameters())
+    return nbytes + quantized_weight_nbytes(pipe.model)
+
+
+def safetensors_parameter_count(model_name):
+    """
+    重みを読み込まずに、safetensors のヘッダーからモデルのパラメータ数を数える
+
+    ローカルのディレクトリならファイルのヘッダーを、それ以外は Hugging Face Hub のメタデータを読む。数えられなければ None
+    """
+    try:
+        if os.path.isdir(model_name):
+            paths = glob.glob(os.path.join(model_name, "*.safetensors"))
+            if not paths:
+                return None
+            count = 0
+            for path in paths:
+                # 先頭8バイトがヘッダーの長さ、続くJSONがテンソルごとの dtype と shape
+                with open(path, "rb") as f:
+                    header_size = struct.unpack("<Q", f.read(8))[0]
+                    header = json.loads(f.read(header_size))
+                count += sum(math.prod(info["shape"]) for key, info in header.items() if key != "__metadata__")
+            return count
+        return sum(get_safetensors_metadata(model_name).parameter_count.values())
+    except Exception as e:
+        print(f"ModelRegistry: モデル '{model_name}' のパラメータ数を取得できませんでした: {e}")
+        return None
+
+
+class _ResidentModel:
+    """メモリ上に読み込まれているモデル1件分"""
+
+    def __init__(self, name, pipe, load_time):
+        self.name = name
+        self.pipe = pipe
+        self.nbytes = model_memory_footprint(pipe)
+        self.load_time = load_time
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.requests = 0
+
+    def info(self):
+        return {
+            "model": self.name,
+            "memory_bytes": self.nbytes,
+            "memory_gb": round(self.nbytes / 1024 ** 3, 3),
+            "load_time": self.load_time,
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "requests": self.requests,
+        }
+
+
+class ModelRegistry:
+    """名前付きモデルの遅延読み込みと、メモリ予算に基づくLRU解放を行うレジストリ"""
+
+    def __init__(self, loader, model_names, memory_budget_bytes=0, retry_interval=30, on_evict=None, on_load=None,
+                 estimate_bytes=None):
+        """
+        初期化
+
+        Args:
+            loader (callable): (model_name, registry) を受け取り、読み込んだパイプラインを返す関数。失敗時は None
+            model_names (list): 提供するモデル名のリスト。先頭がデフォルトモデル
+            memory_budget_bytes (int): 常駐させるモデルの合計メモリの上限（バイト）。0以下なら無制限
+            retry_interval (float): 読み込みに失敗したモデルを再度読み込むまでの間隔（秒）
+            on_evict (callable, optional): モデルを解放したときに呼ばれる関数（引数はモデル名）
+            on_load (callable, optional): モデルが推論可能になったときに呼ばれる関数（引数はモデル名）
+            estimate_bytes (callable, optional): モデル名を受け取り、読み込み中に必要になるメモリ量（バイト）の
+                見積もりを返す関数（分からなければ None）。読み込む前に、この分の空きを作っておく
+
+        デフォルトモデルは解放の対象にしない（/ready が失敗し続けることになるため）。
+        """
+        if not model_names:
+            raise ValueError("モデル名が1つも指定されていません")
+        self.loader = loader
+        self.model_names = list(model_names)
+        self.default_model = self.model_names[0]
+        self.memory_budget = memory_budget_bytes
+        self.retry_interval = retry_interval
+        self.on_evict = on_evict
+        self.on_load = on_load
+        self.estimate_bytes = estimate_bytes
+
+        self._resident = OrderedDict()  # モデル名 -> _ResidentModel（末尾ほど最近使われた）
+        self._states = {name: self._new_state() for name in self.model_names}
+        self._footprints = {}  # 一度読み込んだモデルのメモリ量（次回読み込み前の見積もりに使う）
+        self._estimates = {}  # estimate_bytes による見積もり（モデル名 -> バイト）
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def _new_state():
+        return {"status": "not_loaded", "stage": None, "started_at": None, "finished_at": None, "error": None}
+
+    def resolve(self, name=None):
+        """リクエストで指定されたモデル名を確定する。未指定ならデフォルトモデル"""
+        if name is None:
+            return self.default_model
+        if name not in self._states:
+            raise KeyError(name)
+        return name
+
+    def get(self, name):
+        """読み込み済みならパイプラインを返し、最近使われたものとして記録する。未読み込みなら None"""
+        with self._lock:
+            entry = self._resident.get(name)
+            if entry is None:
+                return None
+            self._resident.move_to_end(name)
+            entry.last_used = time.time()
+            entry.requests += 1
+            return entry.pipe
+
+    def is_resident(self, name):
+        return name in self._resident
+
+    def ensure_loaded(self, name):
+        """
+        未読み込みのモデルの読み込みをバックグラウンドで開始する
+
+        読み込み中・読み込み済みのモデル、失敗から retry_interval が経っていないモデルでは何もしない。
+
+        Returns:
+            bool: 新たに読み込みを開始した場合は True
+        """
+        with self._lock:
+            state = self._states[name]
+            if name in self._resident or state["status"] == "loading":
+                return False
+            if state["status"] == "failed" and time.time() - (state["finished_at"] or 0) < self.retry_interval:
+                return False
+            self._states[name] = dict(self._new_state(), status="loading", stage="開始", started_at=time.time())
+            threading.Thread(target=self._load, args=(name,), name=f"model-loader-{name}", daemon=True).start()
+            return True
+
+    def load_now(self, name):
+        """
+        モデルを呼び出し元のスレッドで読み込み、完了まで待つ（複数ワーカーへ fork する前の読み込み用）
+
+        Returns:
+            bool: 読み込み済みになった場合は True
+        """
+        with self._lock:
+            if name in self._resident:
+                return True
+            self._states[name] = dict(self._new_state(), status="loading", stage="開始", started_at=time.time())
+        self._load(name)
+        return name in self._resident
+
+    def set_stage(self, name, stage):
+        """読み込み中の段階を記録する（/ready や503応答で返す進行状況）"""
+        self._states[name]["stage"] = stage
+        print(f"モデル読み込み ({name}): {stage}")
+
+    def progress(self, name):
+        """モデル読み込みの進行状況を返す"""
+        state = self._states[name]
+        progress = {
+            "status": "ready" if name in self._resident else state["status"],
+            "model": name,
+            "stage": state["stage"],
+            "error": state["error"],
+        }
+        if state["started_at"] is not None:
+            progress["elapsed_seconds"] = (state["finished_at"] or time.time()) - state["started_at"]
+        return progress
+
+    def retry_after(self, name):
+        """次に読み込みが完了・再試行される見込みまでの秒数"""
+        state = self._states[name]
+        if state["status"] == "failed":
+            remaining = self.retry_interval - (time.time() - (state["finished_at"] or 0))
+            return max(1, int(remaining))
+        return 5  # 読み込み中は短い間隔で再試行してもらう
+
+    def _load(self, name):
+        """モデルを読み込み、予算を超えた分のモデルを解放する（読み込み用スレッドで実行）"""
+        print(f"ModelRegistry: モデル '{name}' の読み込みを開始...")
+        # 重みが常駐してから解放すると一時的に予算を超えるため、読み込む前に見積もった分の空きを作っておく
+        self._evict_for(self._incoming_bytes(name), keep=name)
+
+        pipe = None
+        try:
+            pipe = self.loader(name, self)
+        except Exception as e:
+            print(f"ModelRegistry: モデル '{name}' の読み込み中にエラーが発生しました: {e}")
+            traceback.print_exc()
+
+        state = self._states[name]
+        state["finished_at"] = time.time()
+        if pipe is None:
+            state.update(status="failed", error="モデルの読み込みに失敗しました。サーバーのログを確認してください。")
+            print(f"ModelRegistry: モデル '{name}' の読み込みに失敗しました。")
+            return
+
+        entry = _ResidentModel(name, pipe, state["finished_at"] - state["started_at"])
+        self._footprints[name] = entry.nbytes
+        with self._lock:
+            self._resident[name] = entry
+        state.update(status="ready", stage=None)
+        print(f"ModelRegistry: モデル '{name}' の読み込みが完了しました。({entry.load_time:.1f}秒, {entry.nbytes / 1024 ** 3:.2f}GB)")
+        if self.on_load is not None:
+            self.on_load(name)
+        self._evict_for(0, keep=name)
+
+    def _incoming_bytes(self, name):
+        """
+        読み込むモデルのメモリ量の見積もり（バイト）
+
+        前回の読み込みで測ったメモリ量と estimate_bytes の見積もりの大きい方（量子化の前に bf16 で読み込む場合など、
+        読み込み中は常駐後より多くのメモリを使うことがあるため）
+        """
+        if name not in self._estimates:
+            estimate = None
+            if self.estimate_bytes is not None:
+                try:
+                    estimate = self.estimate_bytes(name)
+                except Exception as e:
+                    print(f"ModelRegistry: モデル '{name}' のメモリ量を見積もれませんでした: {e}")
+            self._estimates[name] = estimate or 0
+            if estimate:
+                print(f"ModelRegistry: モデル '{name}' の読み込みに約{estimate / 1024 ** 3:.2f}GBが必要と見積もりました")
+        return max(self._footprints.get(name, 0), self._estimates[name])
+
+    def _evict_for(self, incoming_bytes, keep):
+        """incoming_bytes 分を追加しても予算に収まるよう、最も古く使われたモデルから解放する"""
+        if not self.memory_budget or self.memory_budget <= 0:
+            return
+        evicted = []
+        with self._lock:
+            while self._resident:
+                total = sum(entry.nbytes for entry in self._resident.values())
+                if total + incoming_bytes <= self.memory_budget:
+                    break
+                candidates = [name for name in self._resident if name not in (keep, self.default_model)]
+                if not candidates:
+                    print(f"ModelRegistry: 警告: モデル '{keep}' を読み込むと、解放できるモデルを解放してもメモリ予算を超えます")
+                    break
+                victim = candidates[0]
+                del self._resident[victim]
+                self._states[victim] = self._new_state()
+                self.evictions += 1
+                evicted.append(victim)
+        for name in evicted:
+            print(f"ModelRegistry: メモリ予算を超えるため、モデル '{name}' を解放しました")
+            if self.on_evict is not None:
+                self.on_evict(name)
+        if evicted:
+            # 推論中のリクエストが参照を持っている間は、その処理が終わってから解放される
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def stats(self):
+        """常駐しているモデルとメモリ使用量を返す"""
+        with self._lock:
+            resident = [entry.info() for entry in self._resident.values()]
+        total = sum(entry["memory_bytes"] for entry in resident)
+        return {
+            "default_model": self.default_model,
+            "available_models": self.model_names,
+            "resident_models": resident,
+            "total_memory_bytes": total,
+            "memory_budget_bytes": self.memory_budget,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,109 @@
+# multi_sample.py
+# 同じプロンプトから複数の候補を生成する（self-consistency や best-of-N 用）
+#
+# 同じプロンプトを N 回 /generate に送ると、プロンプトのプレフィルも N 回行われる。
+# ここではプロンプトを1回だけプレフィルし、その past_key_values を候補の数だけ複製して、
+# 全候補を1回のバッチデコードで生成する。増える計算は生成するトークンの分だけになる。
+import torch
+from transformers import StoppingCriteriaList
+
+from stopping import RequestStoppingCriteria
+
+
+def candidate_logprobs(logits, tokens, lengths):
+    """
+    各候補が生成したトークンの対数確率（温度や top-p を適用する前のモデルの分布での値）の合計
+
+    Args:
+        logits (tuple): ステップごとの (候補数, 語彙数) のロジット
+        tokens (torch.Tensor): (候補数, ステップ数) の生成されたトークンID
+        lengths (list): 候補ごとの生成トークン数（それ以降はパディング）
+    """
+    steps = min(len(logits), tokens.shape[1])
+    if steps == 0:
+        return [0.0] * tokens.shape[0]
+    log_probs = torch.stack([
+        torch.log_softmax(logits[step].float(), dim=-1).gather(1, tokens[:, step:step + 1]).squeeze(1)
+        for step in range(steps)
+    ], dim=1)
+    return [log_probs[row, :min(length, steps)].sum().item() for row, length in enumerate(lengths)]
+
+
+def generate_samples(pipe, prompt, num_samples, params, controls, past_key_values=None, reused_tokens=0,
+                     logits_processor=None):
+    """
+    プロンプトを1回だけプレフィルし、KVキャッシュを num_samples 個に複製して候補を1回のバッチデコードで生成する
+    （推論スレッドで実行）
+
+    Args:
+        num_samples (int): 生成する候補の数
+        params (dict): generate に渡す生成パラメータ（max_new_tokens, do_sample, temperature, top_p）
+        controls (list): 候補ごとの打ち切り条件（RequestControl.split で作る）
+        past_key_values (optional): 登録済みプレフィックスの past_key_values（プロンプトの先頭 reused_tokens 個分）
+
+    Returns:
+        dict: 候補ごとの {"text", "completion_tokens", "logprob"} のリスト（生成順）、
+            プロンプトのトークン数、新たにプレフィルしたトークン数
+    """
+    tokenizer = pipe.tokenizer
+    model = pipe.model
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(model.device)
+    prompt_tokens = input_ids.shape[1]
+    if past_key_values is None:
+        reused_tokens = 0
+
+    with torch.no_grad():
+        # 最後の1トークンは generate に入力する必要があるため、その手前までをプレフィルする
+        if prompt_tokens - 1 > reused_tokens:
+            outputs = model(
+                input_ids=input_ids[:, reused_tokens:-1],
+                attention_mask=torch.ones_like(input_ids[:, :-1]),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+        if past_key_values is not None:
+            # 1候補分のキャッシュを候補の数だけ複製する（プレフィルの計算はしない）
+            past_key_values.batch_repeat_interleave(num_samples)
+
+        batch_ids = input_ids.repeat(num_samples, 1)
+        stopping_criteria = StoppingCriteriaList([
+            RequestStoppingCriteria(tokenizer, controls, prompt_tokens, model.generation_config.eos_token_id)
+        ])
+        output = model.generate(
+            input_ids=batch_ids,
+            attention_mask=torch.ones_like(batch_ids),
+            past_key_values=past_key_values,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            return_dict_in_generate=True,
+            output_logits=True,
+            use_cache=True,
+            logits_processor=logits_processor,
+            stopping_criteria=stopping_criteria,
+            **params,
+        )
+
+    tokens = output.sequences[:, prompt_tokens:]
+    # 先に止まった候補の後ろはパディングなので、打ち切り条件が数えた生成トークン数までを候補とする
+    lengths = [min(control.generated_tokens or tokens.shape[1], tokens.shape[1]) for control in controls]
+    logprobs = candidate_logprobs(output.logits, tokens, lengths)
+    candidates = [
+        {
+            "text": tokenizer.decode(tokens[row, :length], skip_special_tokens=True).strip(),
+            "completion_tokens": length,
+            "logprob": logprob,
+        }
+        for row, (length, logprob) in enumerate(zip(lengths, logprobs))
+    ]
+    return {
+        "candidates": candidates,
+        "prompt_tokens": prompt_tokens,
+        "prefilled_tokens": max(0, prompt_tokens - 1 - reused_tokens),
+    }
+
+
+def rank_candidates(candidates, n):
+    """1トークンあたりの対数確率が高い順に並べ、上位 n 個を返す（best_of 用）"""
+    def score(candidate):
+        return candidate["logprob"] / max(1, candidate["completion_tokens"])
+    return sorted(candidates, key=score, reverse=True)[:n]
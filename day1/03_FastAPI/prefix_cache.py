@@ -0,0 +1,214 @@
+# prefix_cache.py
+# 共通のシステムプロンプトなどの past_key_values を保持し、プレフィル（プロンプトの読み込み）を途中から再開する
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def kv_cache_nbytes(past_key_values):
+    """past_key_values が使用しているメモリ量（バイト）を返す"""
+    if hasattr(past_key_values, "layers"):
+        tensors = [t for layer in past_key_values.layers for t in (layer.keys, layer.values) if t is not None]
+    elif hasattr(past_key_values, "key_cache"):
+        # 古いバージョンのtransformersの DynamicCache
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    else:
+        tensors = [t for layer in past_key_values for t in layer]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def common_prefix_length(a, b):
+    """2つのトークンID列の先頭から一致している長さを返す"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixEntry:
+    """登録済みプレフィックス1件分（トークンIDと計算済みの past_key_values）"""
+
+    def __init__(self, model_name, text, token_ids, past_key_values, prefill_time):
+        self.model_name = model_name
+        self.text = text
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.prefill_time = prefill_time
+        self.nbytes = kv_cache_nbytes(past_key_values)
+        self.hits = 0
+
+    def info(self):
+        return {
+            "model": self.model_name,
+            "prefix": self.text[:100],
+            "tokens": len(self.token_ids),
+            "bytes": self.nbytes,
+            "prefill_time": self.prefill_time,
+            "hits": self.hits,
+        }
+
+
+class PrefixCache:
+    """登録されたプレフィックスの past_key_values をメモリ上限付きのLRUで保持する"""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, min_match_tokens=8):
+        """
+        初期化
+
+        Args:
+            max_bytes (int): 保持する past_key_values の合計サイズの上限（バイト）
+            min_match_tokens (int): 再利用する最小の一致トークン数。短すぎる一致はコピーの手間の方が大きい
+        """
+        self.max_bytes = max_bytes
+        self.min_match_tokens = min_match_tokens
+        self._entries = OrderedDict()  # (モデル名, プレフィックス文字列) -> PrefixEntry
+        self._lock = threading.Lock()  # 推論スレッドとイベントループの両方から参照されるため
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def register(self, pipe, model_name, text):
+        """プレフィックスをプレフィルして past_key_values を保存する（推論スレッドで実行）"""
+        tokenizer = pipe.tokenizer
+        input_ids = tokenizer(text, return_tensors="pt").input_ids.to(pipe.model.device)
+        start_time = time.time()
+        with torch.no_grad():
+            outputs = pipe.model(input_ids=input_ids, use_cache=True)
+        entry = PrefixEntry(model_name, text, input_ids[0].tolist(), outputs.past_key_values, time.time() - start_time)
+        if entry.nbytes > self.max_bytes:
+            raise ValueError(f"プレフィックスのKVキャッシュ({entry.nbytes}バイト)が上限({self.max_bytes}バイト)を超えています")
+
+        with self._lock:
+            self._entries.pop((model_name, text), None)
+            self._entries[(model_name, text)] = entry
+            while self.total_bytes > self.max_bytes:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        print(f"PrefixCache: プレフィックスを登録しました (tokens={len(entry.token_ids)}, bytes={entry.nbytes}, prefill_time={entry.prefill_time:.3f}秒)")
+        return entry
+
+    def remove(self, model_name, text):
+        with self._lock:
+            return self._entries.pop((model_name, text), None) is not None
+
+    def drop_model(self, model_name):
+        """解放されたモデルのプレフィックスをまとめて削除する"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_name]:
+                del self._entries[key]
+
+    def match(self, model_name, token_ids):
+        """
+        プロンプトのトークンID列に最も長く一致するプレフィックスを探す
+
+        Returns:
+            tuple: (PrefixEntry, 再利用できるトークン数)。一致が無ければ (None, 0)
+        """
+        with self._lock:
+            best_entry, best_length = None, 0
+            for entry in self._entries.values():
+                if entry.model_name != model_name:
+                    continue
+                # 最低1トークンはモデルに入力する必要があるため、プロンプト全体は再利用しない
+                length = min(common_prefix_length(entry.token_ids, token_ids), len(token_ids) - 1)
+                if length > best_length:
+                    best_entry, best_length = entry, length
+            if best_entry is None or best_length < self.min_match_tokens:
+                self.misses += 1
+                return None, 0
+            self._entries.move_to_end((model_name, best_entry.text))
+            best_entry.hits += 1
+            self.hits += 1
+            self.reused_tokens += best_length
+            return best_entry, best_length
+
+    def cache_for(self, entry, length):
+        """entry の past_key_values を length トークンに切り詰めたコピーを返す"""
+        with self._lock:
+            # 生成中に書き換えられるため、保存している past_key_values はコピーして渡す
+            past_key_values = copy.deepcopy(entry.past_key_values)
+        cached_length = past_key_values.get_seq_length()
+        if length < cached_length:
+            # 一致した長さまで切り詰める（負の値は末尾から削るトークン数）
+            past_key_values.crop(length - cached_length)
+        return past_key_values
+
+    def lookup(self, model_name, token_ids):
+        """
+        プロンプトのトークンID列に最も長く一致するプレフィックスを探す
+
+        Returns:
+            tuple: (past_key_values のコピー, 再利用できるトークン数)。一致が無ければ (None, 0)
+        """
+        entry, length = self.match(model_name, token_ids)
+        if entry is None:
+            return None, 0
+        return self.cache_for(entry, length), length
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": [entry.info() for entry in self._entries.values()],
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
+
+
+def generate_with_prefix(pipe, prefix_cache, entry, reused_tokens, token_ids_list, params):
+    """
+    同じプレフィックスに一致したプロンプト群を、保存済みの past_key_values を行数分に複製して1回のバッチで生成する
+    （推論スレッドで実行）
+
+    続きの長さは、プレフィックスと続きの間にパディングを入れて揃える（attention_mask で除外し、位置もマスクから数える）。
+
+    Args:
+        entry (PrefixEntry): PrefixCache.match で一致したプレフィックス
+        reused_tokens (int): 再利用するトークン数（全行で共通）
+        token_ids_list (list): プロンプトごとのトークンID列
+
+    Returns:
+        list: プロンプトごとの生成された応答
+    """
+    tokenizer = pipe.tokenizer
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(len(token_ids) for token_ids in token_ids_list)
+    rows, masks = [], []
+    for token_ids in token_ids_list:
+        padding = width - len(token_ids)
+        rows.append(token_ids[:reused_tokens] + [pad_token_id] * padding + token_ids[reused_tokens:])
+        masks.append([1] * reused_tokens + [0] * padding + [1] * (len(token_ids) - reused_tokens))
+    input_ids = torch.tensor(rows, device=pipe.model.device)
+    attention_mask = torch.tensor(masks, device=pipe.model.device)
+
+    past_key_values = prefix_cache.cache_for(entry, reused_tokens)
+    if len(rows) > 1:
+        # 1行分のキャッシュを行数分に複製する（プレフィルの計算はしない）
+        past_key_values.batch_repeat_interleave(len(rows))
+    print(f"PrefixCache: {len(rows)}件のプロンプトで{reused_tokens}トークンのプレフィルを再利用します")
+    with torch.no_grad():
+        output_ids = pipe.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            pad_token_id=pad_token_id,
+            **params,
+        )
+    return [tokenizer.decode(row[width:], skip_special_tokens=True).strip() for row in output_ids]
@@ -1,22 +1,150 @@
 # python_client.py
 # このコードは、ngrokで公開されたAPIにアクセスするPythonクライアントの例です
 
+import asyncio
+import hashlib
+import os
+import random
+import sqlite3
+import threading
 import requests
+import httpx
 import json
 import time
+import base64
+import numpy as np
+
+# 時間をおいて再試行するステータスコード（429: レート制限、503: 待ち行列が一杯）
+RETRY_STATUS_CODES = (429, 503)
+# 期限切れや切断で途中まで生成した結果はキャッシュに保存しない
+INCOMPLETE_FINISH_REASONS = ("deadline", "cancelled")
+
+class APIError(Exception):
+    """API がエラー（200以外）を返したことを表す例外"""
+
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"API error: {status_code} - {text}")
+        self.status_code = status_code
+        self.retry_after = retry_after  # 503 の場合にサーバーが指定した再試行までの秒数
+
+class ResponseDiskCache:
+    """
+    生成結果をローカルの SQLite ファイルに保存するキャッシュ
+
+    同じプロンプトを同じパラメータで何度も送る評価の繰り返しで、API（GPU）を使わずに結果を再利用する。
+    キーはエンドポイントの URL・モデル名・プロンプト・生成パラメータ。古すぎる結果は使わず、
+    合計サイズが上限を超えたら最後に使われたのが古いものから削除する。
+    """
+
+    def __init__(self, path, max_age_seconds=7 * 24 * 3600, max_mb=512):
+        """
+        初期化
+
+        Args:
+            path (str): SQLite ファイルのパス（無ければ作る）
+            max_age_seconds (float, optional): 保存してからこの秒数を過ぎた結果は使わない。None なら無期限
+            max_mb (float, optional): 保存する結果の合計サイズの上限（MB）。None なら無制限
+        """
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, created_at REAL, last_used REAL, size INTEGER, value TEXT)"
+        )
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(url, payload):
+        """エンドポイントの URL とリクエストの内容（モデル名・プロンプト・パラメータ）からキーを作る"""
+        data = json.dumps({"url": url, "payload": payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """保存済みで期限内の結果を返す。無ければ None"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT created_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age_seconds is not None and now - row[0] > self.max_age_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return json.loads(row[1])
+
+    def put(self, key, value):
+        """結果を保存し、期限切れとサイズの上限を超えた分を削除する"""
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, created_at, last_used, size, value) VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(data.encode("utf-8")), data),
+            )
+            self._expire(now)
+            self._db.commit()
+
+    def _expire(self, now):
+        if self.max_age_seconds is not None:
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age_seconds,))
+        if self.max_bytes is None:
+            return
+        total = 0
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used DESC"):
+            total += size
+            if total > self.max_bytes:
+                evicted.append((key,))
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        """保存した結果をすべて削除する"""
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def stats(self):
+        """保存件数・合計サイズ・ヒット数・ミス数"""
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": entries, "size_bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
 
 class LLMClient:
     """LLM API クライアントクラス"""
     
-    def __init__(self, api_url):
+    def __init__(self, api_url, timeout=None, cache_path=None, cache_max_age_seconds=7 * 24 * 3600, cache_max_mb=512):
         """
         初期化
         
         Args:
             api_url (str): API のベース URL（ngrok URL）
+            timeout (float, optional): 1リクエストのタイムアウト（秒）。None なら無制限
+            cache_path (str, optional): 指定すると、generate / generate_batch の結果をこの SQLite ファイルに保存して再利用する
+                （do_sample=True の結果も保存するので、同じプロンプトには同じ応答が返る）
+            cache_max_age_seconds (float, optional): 保存した結果を使う期限（秒）。None なら無期限
+            cache_max_mb (float, optional): 保存する結果の合計サイズの上限（MB）
         """
         self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
         self.session = requests.Session()
+        self.cache = None
+        if cache_path:
+            self.cache = ResponseDiskCache(cache_path, cache_max_age_seconds, cache_max_mb)
     
     def health_check(self):
         """
@@ -25,10 +153,10 @@ class LLMClient:
         Returns:
             dict: ヘルスチェック結果
         """
-        response = self.session.get(f"{self.api_url}/health")
+        response = self.session.get(f"{self.api_url}/health", timeout=self.timeout)
         return response.json()
     
-    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+    def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None):
         """
         テキスト生成
         
@@ -38,9 +166,10 @@ class LLMClient:
             temperature (float, optional): 温度パラメータ
             top_p (float, optional): top-p サンプリングのパラメータ
             do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルト）
         
         Returns:
-            dict: 生成結果
+            dict: 生成結果（キャッシュを使った場合は client_cached が True）
         """
         payload = {
             "prompt": prompt,
@@ -49,20 +178,432 @@ class LLMClient:
             "top_p": top_p,
             "do_sample": do_sample
         }
+        if model:
+            payload["model"] = model
+        
+        start_time = time.time()
+        url = f"{self.api_url}/generate"
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(url, payload)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached["client_cached"] = True
+                cached["total_request_time"] = time.time() - start_time
+                return cached
+        
+        response = self.session.post(
+            url,
+            json=payload,
+            timeout=self.timeout
+        )
+        total_time = time.time() - start_time
+        
+        if response.status_code == 200:
+            result = response.json()
+            if cache_key is not None and is_complete(result):
+                self.cache.put(cache_key, result)
+            result["client_cached"] = False
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise api_error(response)
+
+    def generate_batch(self, items, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True):
+        """
+        複数プロンプトの一括テキスト生成（1回のHTTPリクエストで処理）
+        
+        Args:
+            items (list): プロンプト文字列、または "prompt" と個別の生成パラメータを持つ dict のリスト
+            max_new_tokens (int, optional): 個別指定が無い場合に使う最大トークン数
+            temperature (float, optional): 個別指定が無い場合に使う温度パラメータ
+            top_p (float, optional): 個別指定が無い場合に使う top-p
+            do_sample (bool, optional): 個別指定が無い場合にサンプリングを行うかどうか
+        
+        Returns:
+            dict: 要素ごとの生成結果 (results) と合計時間
+                （キャッシュを使う場合は、保存済みの要素を除いて送信し、その要素の client_cached を True にする）
+        """
+        defaults = {
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        payload_items = []
+        for item in items:
+            if isinstance(item, str):
+                item = {"prompt": item}
+            payload_items.append({**defaults, **item})
         
         start_time = time.time()
+        url = f"{self.api_url}/generate/batch"
+        results = [None] * len(payload_items)
+        cache_keys = [None] * len(payload_items)
+        if self.cache is not None:
+            for i, item in enumerate(payload_items):
+                cache_keys[i] = self.cache.make_key(url, item)
+                cached = self.cache.get(cache_keys[i])
+                if cached is not None:
+                    results[i] = {**cached, "client_cached": True}
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return {"results": results, "total_time": 0.0, "total_request_time": time.time() - start_time}
+        
         response = self.session.post(
-            f"{self.api_url}/generate",
-            json=payload
+            url,
+            json={"items": [payload_items[i] for i in misses]},
+            timeout=self.timeout
         )
         total_time = time.time() - start_time
         
+        if response.status_code == 200:
+            result = response.json()
+            for i, item_result in zip(misses, result["results"]):
+                if cache_keys[i] is not None and is_complete(item_result):
+                    self.cache.put(cache_keys[i], item_result)
+                results[i] = {**item_result, "client_cached": False}
+            result["results"] = results
+            result["total_request_time"] = total_time
+            return result
+        else:
+            raise api_error(response)
+
+    def embed(self, texts, mode="document", encoding_format="float16", normalize=False, model=None):
+        """
+        テキストの埋め込み（サーバーに常駐している埋め込みモデルを使う）
+        
+        Args:
+            texts (list): テキストのリスト
+            mode (str, optional): "query"（検索クエリ）または "document"（検索対象の文書）
+            encoding_format (str, optional): 転送時の形式（"float16" が最も小さい。"base64" は float32、"float" はJSONの数値）
+            normalize (bool, optional): 長さ1に正規化するかどうか
+            model (str, optional): 使用する埋め込みモデル名（省略時はサーバーのデフォルト）
+        
+        Returns:
+            numpy.ndarray: (テキスト数, 次元数) の float32 の配列
+        """
+        payload = {"texts": list(texts), "mode": mode, "encoding_format": encoding_format, "normalize": normalize}
+        if model:
+            payload["model"] = model
+        response = self.session.post(f"{self.api_url}/embeddings", json=payload, timeout=self.timeout)
+        if response.status_code != 200:
+            raise api_error(response)
+        return decode_embeddings(response.json())
+
+    def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None):
+        """
+        テキスト生成（/generate/stream を使い、生成されたテキスト片を届いた順に返す）
+        
+        Args:
+            prompt (str): プロンプト文字列
+            max_new_tokens (int, optional): 生成する最大トークン数
+            temperature (float, optional): 温度パラメータ
+            top_p (float, optional): top-p サンプリングのパラメータ
+            do_sample (bool, optional): サンプリングを行うかどうか
+            model (str, optional): 使用するモデル名（省略時はサーバーのデフォルト）
+        
+        Yields:
+            dict: テキスト片ごとに {"token": テキスト片}、最後に {"done": True, ...生成結果}
+                （生成結果にはサーバーの集計に加えて、クライアントで測った最初のトークンまでの時間と
+                テキスト片の間隔、total_request_time を含む）
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if model:
+            payload["model"] = model
+        
+        stream = StreamReader()
+        response = self.session.post(
+            f"{self.api_url}/generate/stream",
+            json=payload,
+            stream=True,
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise api_error(response)
+        # text/event-stream は UTF-8（サーバーが charset を付けない場合に備える）
+        response.encoding = response.encoding or "utf-8"
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                event = stream.feed(line)
+                if event is not None:
+                    yield event
+
+class StreamReader:
+    """
+    Server-Sent Events の行を読み、テキスト片と完了時の生成結果を取り出す
+
+    クライアントで観測した最初のテキスト片までの時間とテキスト片の間隔を記録し、サーバーの集計
+    （time_to_first_token, response_time）と並べて返すことで、ネットワークの遅延を切り分けられるようにする。
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.event = None
+        self.chunk_times = []  # 各テキスト片を受信した時刻
+
+    def feed(self, line):
+        """
+        SSE の1行を読む
+
+        Returns:
+            dict: テキスト片 {"token": ...} または完了時の生成結果。それ以外の行では None
+        """
+        if line.startswith("event:"):
+            self.event = line[len("event:"):].strip()
+            return None
+        if not line.startswith("data:"):
+            if not line:
+                self.event = None  # 空行でイベントが終わる
+            return None
+        data = json.loads(line[len("data:"):])
+        if self.event == "error":
+            raise APIError(200, data.get("detail", ""))
+        if self.event == "done":
+            return self.result(data)
+        if "token" in data:
+            self.chunk_times.append(time.time())
+            return {"token": data["token"]}
+        return None
+
+    def result(self, summary):
+        """サーバーの集計にクライアントで測った時間を加えた生成結果"""
+        total_time = time.time() - self.start_time
+        gaps = [later - earlier for earlier, later in zip(self.chunk_times, self.chunk_times[1:])]
+        client_ttft = self.chunk_times[0] - self.start_time if self.chunk_times else None
+        server_ttft = summary.get("time_to_first_token")
+        result = {
+            "done": True,
+            **summary,
+            "total_request_time": total_time,
+            "client_time_to_first_token": client_ttft,
+            "client_inter_token_gaps": gaps,
+            "client_inter_token_latency": sum(gaps) / len(gaps) if gaps else None,
+        }
+        # クライアントとサーバーで測った時間の差は、ネットワークと、サーバーがトークンを表示できるテキスト片に
+        # まとめるまでの待ち（単語や文字の区切りまでデコードを保留する）にかかった時間
+        if client_ttft is not None and server_ttft is not None:
+            result["network_time_to_first_token"] = client_ttft - server_ttft
+        if summary.get("response_time") is not None:
+            result["network_time"] = total_time - summary["response_time"]
+        return result
+
+class AsyncLLMClient:
+    """
+    LLM API の非同期クライアントクラス
+
+    キープアライブの接続プールを共有し、同時に送るリクエスト数を max_in_flight 以下に抑える。
+    429/503 が返った場合は Retry-After（無ければ指数バックオフ）にジッターを加えた時間だけ待って再試行する。
+    """
+
+    def __init__(self, api_url, max_in_flight=8, timeout=None, max_retries=3, backoff_base=0.5, backoff_max=30.0):
+        """
+        初期化
+
+        Args:
+            api_url (str): API のベース URL（ngrok URL）
+            max_in_flight (int, optional): 同時に応答を待つリクエスト数の上限（接続プールの大きさも同じにする）
+            timeout (float, optional): 1リクエストのタイムアウト（秒）。None なら無制限
+            max_retries (int, optional): 429/503 や接続エラーのときに再試行する回数
+            backoff_base (float, optional): 指数バックオフの初回の待ち時間（秒）
+            backoff_max (float, optional): 再試行までの待ち時間の上限（秒）
+        """
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.client = httpx.AsyncClient(
+            base_url=self.api_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """接続プールを閉じる"""
+        await self.client.aclose()
+
+    def retry_delay(self, attempt, retry_after=None):
+        """
+        attempt 回目（0始まり）の再試行までの待ち時間
+
+        Retry-After があればそれを下限とし、多数のクライアントが同時に再送しないようにジッターを加える。
+        """
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, backoff)
+
+    async def _request(self, method, path, **kwargs):
+        """
+        同時実行数の上限内でリクエストを送り、429/503 と接続エラーは再試行する
+
+        Returns:
+            tuple: (レスポンス, 再試行した回数)
+        """
+        for attempt in range(self.max_retries + 1):
+            # 再試行を待つ間は枠を返し、他のリクエストを先に送れるようにする
+            async with self._semaphore:
+                try:
+                    response = await self.client.request(method, path, **kwargs)
+                except httpx.ConnectError:
+                    # 送信前に失敗した場合のみ再試行する（生成が二重に実行されないように）
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.retry_delay(attempt)
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                        return response, attempt
+                    delay = self.retry_delay(attempt, api_error(response).retry_after)
+            await asyncio.sleep(delay)
+
+    async def health_check(self):
+        """
+        ヘルスチェック
+
+        Returns:
+            dict: ヘルスチェック結果
+        """
+        response, _ = await self._request("GET", "/health")
+        return response.json()
+
+    async def generate(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True, model=None):
+        """
+        テキスト生成（引数と戻り値は LLMClient.generate と同じ）
+
+        Returns:
+            dict: 生成結果（total_request_time は再試行の待ち時間を含む。retries は再試行した回数）
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if model:
+            payload["model"] = model
+
+        start_time = time.time()
+        response, retries = await self._request("POST", "/generate", json=payload)
+        total_time = time.time() - start_time
+
         if response.status_code == 200:
             result = response.json()
             result["total_request_time"] = total_time
+            result["retries"] = retries
             return result
         else:
-            raise Exception(f"API error: {response.status_code} - {response.text}")
+            raise api_error(response)
+
+    async def generate_stream(self, prompt, max_new_tokens=512, temperature=0.7, top_p=0.9, do_sample=True,
+                              model=None):
+        """
+        テキスト生成（LLMClient.generate_stream の非同期版）
+
+        ストリームが始まる前に 429/503 が返った場合は generate と同じように再試行する（待つ間は枠を返す）。
+        クライアントで測る時間は成功した試行の送信から数え、再試行と待ちにかかった時間は retry_time で別に返す。
+
+        Yields:
+            dict: テキスト片ごとに {"token": テキスト片}、最後に {"done": True, ...生成結果}
+        """
+        payload = {
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "do_sample": do_sample
+        }
+        if model:
+            payload["model"] = model
+
+        start_time = time.time()
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                stream = StreamReader()
+                async with self.client.stream("POST", "/generate/stream", json=payload) as response:
+                    if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                        await response.aread()
+                        delay = self.retry_delay(attempt, api_error(response).retry_after)
+                    else:
+                        if response.status_code != 200:
+                            await response.aread()
+                            raise api_error(response)
+                        async for line in response.aiter_lines():
+                            event = stream.feed(line)
+                            if event is not None:
+                                if event.get("done"):
+                                    event["retries"] = attempt
+                                    event["retry_time"] = stream.start_time - start_time
+                                yield event
+                        return
+            await asyncio.sleep(delay)
+
+    async def generate_many(self, items, return_exceptions=False, **kwargs):
+        """
+        複数のプロンプトを並行して生成し、完了した順に結果を返す非同期ジェネレーター
+
+        同時に送るのは max_in_flight 件まで。各プロンプトは別々のリクエストとして送るので、
+        サーバー側のマイクロバッチングでまとめて推論される。
+
+        Args:
+            items (list): プロンプト文字列、または "prompt" と個別の生成パラメータを持つ dict のリスト
+            return_exceptions (bool, optional): True の場合、失敗したリクエストは例外を結果として返す
+            **kwargs: 個別指定が無い場合に使う生成パラメータ
+
+        Yields:
+            tuple: (items 内の位置, 生成結果または例外)
+        """
+        async def run(index, item):
+            if isinstance(item, str):
+                item = {"prompt": item}
+            try:
+                return index, await self.generate(**{**kwargs, **item})
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return index, e
+
+        tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 途中で例外が起きた・呼び出し側が読むのをやめた場合は、残りのリクエストを取り消す
+            for task in tasks:
+                task.cancel()
+
+def is_complete(result):
+    """最後まで生成した結果かどうか（キャッシュに保存してよいか）"""
+    return result.get("finish_reason") not in INCOMPLETE_FINISH_REASONS
+
+def decode_embeddings(result):
+    """/embeddings の応答を (テキスト数, 次元数) の float32 の配列にする"""
+    if result.get("embeddings") is not None:
+        return np.asarray(result["embeddings"], dtype=np.float32)
+    matrix = np.frombuffer(base64.b64decode(result["data"]), dtype=result["dtype"])
+    return matrix.reshape(result["count"], result["dimensions"]).astype(np.float32)
+
+def api_error(response):
+    """エラー応答から APIError を作る"""
+    retry_after = response.headers.get("Retry-After")
+    try:
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after = None  # 日時形式の Retry-After には対応しない
+    return APIError(response.status_code, response.text, retry_after)
 
 # 使用例
 if __name__ == "__main__":
@@ -79,9 +620,50 @@ if __name__ == "__main__":
     
     # 単一の質問
     print("Simple question:")
-    result = client.generate([
-        {"prompt": "AIについて100文字で教えてください"}
-    ])
+    result = client.generate("AIについて100文字で教えてください")
     print(f"Response: {result['generated_text']}")
     print(f"Model processing time: {result['response_time']:.2f}s")
-    print(f"Total request time: {result['total_request_time']:.2f}s")    
\ No newline at end of file
+    print(f"Total request time: {result['total_request_time']:.2f}s")
+    print()
+    
+    # 複数の質問を一括で送信
+    print("Batch questions:")
+    batch = client.generate_batch([
+        "AIについて100文字で教えてください",
+        {"prompt": "機械学習について100文字で教えてください", "do_sample": False}
+    ])
+    for item in batch["results"]:
+        print(f"Response: {item['generated_text']} ({item['response_time']:.2f}s)")
+    print(f"Model processing time: {batch['total_time']:.2f}s")
+    print(f"Total request time: {batch['total_request_time']:.2f}s")
+    print()
+
+    # 非同期クライアントで複数の質問を並行して送信（完了した順に表示）
+    print("Concurrent questions:")
+
+    async def run_concurrent():
+        async with AsyncLLMClient(NGROK_URL, max_in_flight=4) as async_client:
+            prompts = [f"{topic}について100文字で教えてください" for topic in ["AI", "機械学習", "深層学習", "自然言語処理"]]
+            async for index, result in async_client.generate_many(prompts, do_sample=False):
+                print(f"[{index}] {result['generated_text']} ({result['total_request_time']:.2f}s, retries={result['retries']})")
+
+    asyncio.run(run_concurrent())
+    print()
+
+    # 生成されたテキスト片を届いた順に表示
+    print("Streaming question:")
+    for event in client.generate_stream("AIについて100文字で教えてください"):
+        if event.get("done"):
+            print()
+            print(f"Time to first token: {event['client_time_to_first_token']:.2f}s "
+                  f"(server: {event['time_to_first_token']:.2f}s)")
+            print(f"Total request time: {event['total_request_time']:.2f}s (server: {event['response_time']:.2f}s)")
+        else:
+            print(event["token"], end="", flush=True)
+    print()
+
+    # 検索クエリと文書の埋め込み（day3 のRAGノートブックと同じ類似度スコア）
+    print("Embeddings:")
+    query_embeddings = client.embed(["LLMにおけるInference Time Scalingとは？"], mode="query")
+    document_embeddings = client.embed(["推論時に計算量を増やして性能を高める手法です。", "学習データを増やす手法です。"])
+    print(f"Scores: {((query_embeddings @ document_embeddings.T) * 100).tolist()}")
@@ -0,0 +1,90 @@
+# quantization.py
+# CUDAが無い環境向けに、Linear層の重みをint8へ動的量子化してモデルを読み込む
+#
+# 注意: 活性化の量子化スケールは、Linear層に入力されたテンソル全体（バッチの全行・全トークン）の最大値から
+# 1つだけ決まる（per-tensor）。そのため貪欲法（do_sample=False）でも、同じバッチで推論した他のプロンプトや
+# 左パディング、プレフィックスのKVキャッシュでプレフィルを分けたかどうかによって出力が変わりうる。
+# 行ごと・トークンごとのスケールにするには Linear 層を行ごとに呼び分ける必要があり、バッチ推論の利点が無くなるため、
+# 応答キャッシュの側で、1件だけで推論した応答のみを保存する（activations_depend_on_batch を参照）。
+import torch
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from torch.ao.quantization import per_channel_dynamic_qconfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+
+
+def quantize_linear_layers_int8(model, skip_modules=("lm_head",)):
+    """
+    モデル内の Linear 層を1層ずつ int8 の動的量子化 Linear に置き換える
+
+    重みは int8（出力チャネルごとのスケール）、活性化は推論時に都度量子化される（入力テンソル全体で1つのスケール）ため、
+    残りのパラメータは float32 にそろえる。
+    bf16 で読み込んだモデルを1層ずつ変換するので、float32 のモデル全体がメモリに載ることはない。
+
+    Args:
+        model: bf16 などで読み込んだ CausalLM モデル（CPU上）
+        skip_modules (tuple): 量子化しない Linear 層の名前。出力層は精度への影響が大きいため除く
+
+    Returns:
+        int: 量子化した Linear 層の数
+    """
+    count = 0
+    for parent in list(model.modules()):
+        for child_name, child in list(parent.named_children()):
+            if not isinstance(child, torch.nn.Linear) or child_name in skip_modules:
+                continue
+            child = child.float()
+            child.qconfig = per_channel_dynamic_qconfig
+            setattr(parent, child_name, DynamicQuantizedLinear.from_float(child))
+            count += 1
+    # 埋め込み層・正規化層・出力層など、量子化しなかった部分は float32 で計算する
+    for param in model.parameters():
+        param.data = param.data.float()
+    for buffer_name, buffer in list(model.named_buffers()):
+        if buffer.is_floating_point():
+            buffer.data = buffer.data.float()
+    return count
+
+
+def activations_depend_on_batch(model):
+    """
+    活性化をテンソル全体で動的量子化する層を含み、貪欲法でも出力がバッチの他の行に左右されるモデルなら True
+    """
+    modules = getattr(model, "modules", None)
+    return callable(modules) and any(isinstance(module, DynamicQuantizedLinear) for module in modules())
+
+
+def quantized_weight_nbytes(model):
+    """動的量子化した Linear 層の重みのバイト数（get_memory_footprint には含まれない）"""
+    return sum(
+        module.weight().numel() * module.weight().element_size()
+        for module in model.modules()
+        if isinstance(module, DynamicQuantizedLinear)
+    )
+
+
+def load_int8_pipeline(model_name, on_stage=None):
+    """
+    CPU上で Linear 層を int8 に動的量子化したモデルを読み込み、text-generation パイプラインを返す
+
+    Args:
+        model_name (str): Hugging Face のモデル名
+        on_stage (callable, optional): 読み込みの段階（文字列）を受け取るコールバック
+    """
+    def stage(message):
+        if on_stage is not None:
+            on_stage(message)
+
+    stage("トークナイザーを読み込み中")
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    # float32 で読み込むと7Bモデルでは約28GBになるため、bf16 で読み込んでから1層ずつ変換する
+    stage("bf16の重みを読み込み中")
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    model.eval()
+
+    stage("Linear層をint8に量子化中")
+    count = quantize_linear_layers_int8(model)
+    print(f"int8動的量子化: {count}個のLinear層を変換しました")
+
+    stage("パイプラインを構築中")
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device="cpu")
@@ -0,0 +1,436 @@
+# scheduler.py
+# 同時に届いた生成リクエストを数ミリ秒まとめ、1回のバッチ推論として実行するスケジューラ
+import asyncio
+import math
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fairness import DEFAULT_CLIENT_ID, FairQueue
+
+
+def sampling_key(params):
+    """同じバッチにまとめられるかを判定するためのキーを返す"""
+    if not params.get("do_sample"):
+        # 貪欲法では temperature / top_p は結果に影響しないため区別しない
+        return (params.get("max_new_tokens"), False, None, None, params.get("speculative"))
+    return (
+        params.get("max_new_tokens"),
+        True,
+        params.get("temperature"),
+        params.get("top_p"),
+        params.get("speculative"),
+    )
+
+
+def percentile(values, q):
+    """値のリストから q パーセンタイル（0〜100）を返す"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class QueueFullError(Exception):
+    """待ち行列が上限に達し、リクエストを受け付けられないことを表す例外"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"待ち行列が上限に達しています。{retry_after}秒後に再試行してください。")
+        self.retry_after = retry_after
+
+
+class _PendingRequest:
+    """キューで待機している1件分のリクエスト"""
+
+    def __init__(self, model_name, prompt, params, control=None, client_id=DEFAULT_CLIENT_ID, priority="normal", key=None):
+        self.model_name = model_name
+        self.prompt = prompt
+        self.params = params
+        self.control = control  # 期限・停止文字列・切断による打ち切り条件（stopping.RequestControl）
+        self.client_id = client_id
+        self.priority = priority
+        # 同じキー（モデルとサンプリング条件）のものだけを同じバッチにまとめる
+        self.key = key
+        self.fn = None  # バッチにまとめない処理（submit_single）の場合に実行する関数と引数
+        self.args = ()
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.time()
+
+
+def _batchable(item):
+    return item.fn is None
+
+
+class BatchScheduler:
+    """動的マイクロバッチングを行うスケジューラ"""
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=10, max_workers=1, max_queue_size=64, on_wait=None,
+                 quotas=None, batch_key=sampling_key):
+        """
+        初期化
+
+        Args:
+            run_batch (callable): (model_name, prompts, params, controls) を受け取り、プロンプトごとの応答リストを返す関数
+            max_batch_size (int): 1バッチにまとめる最大リクエスト数
+            max_wait_ms (float): 最初のリクエストが届いてから後続を待つ最大時間（ミリ秒）
+            max_workers (int): 同時に実行する推論バッチの数（推論用スレッド数）
+            max_queue_size (int): 推論開始を待てるリクエスト数の上限。超えた分は即座に拒否する
+            on_wait (callable, optional): リクエストごとの待ち時間（秒）・モデル名・クライアントID・優先度を受け取るコールバック
+            quotas (fairness.ClientQuotas, optional): クライアントごとの重みと、同時実行数・トークンレートの上限
+            batch_key (callable): params から、同じバッチにまとめられるかを判定するキーを返す関数
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue_size = max(1, int(max_queue_size))
+        self.on_wait = on_wait
+        self.quotas = quotas
+        self.batch_key = batch_key
+        self.executor = None
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._slots = None
+        self._tasks = set()
+
+        # 待ち行列の状態
+        self.waiting = 0
+        self.in_flight = 0
+        # モデルごとの内訳（メトリクスをモデル別に出すため。submit_single で model_name を省略したものは None）
+        self._waiting_by_model = {}
+        self._in_flight_by_model = {}
+        self.rejected_total = 0
+        self._wait_times = deque(maxlen=1000)
+        self._batch_seconds = None  # バッチ実行時間の指数移動平均
+
+        # バッチの充填率を把握するための統計情報
+        self.batches_total = 0
+        self.requests_total = 0
+        self.batch_size_counts = {}
+
+    def start(self):
+        """イベントループ上でバッチ処理用のワーカーを起動する"""
+        if self._worker is None or self._worker.done():
+            if self.executor is None:
+                # 推論はブロッキング処理なので、イベントループを止めないよう専用スレッドで実行する
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+            # 優先度クラス間は厳密に優先し、同じクラスの中ではクライアント間で重み付き公平に取り出す
+            self._queue = FairQueue(self.quotas.weights() if self.quotas is not None else None)
+            self._slots = asyncio.Semaphore(self.max_workers)
+            self._loop = asyncio.get_running_loop()
+            self._worker = self._loop.create_task(self._run())
+            print(
+                f"BatchScheduler: 起動しました (max_batch_size={self.max_batch_size}, "
+                f"max_wait_ms={self.max_wait * 1000:.1f}, max_workers={self.max_workers}, "
+                f"max_queue_size={self.max_queue_size})"
+            )
+
+    async def stop(self):
+        """ワーカーを停止する"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def resize(self, max_workers):
+        """同時に実行する推論バッチの数を変更する（推論スレッドなど、イベントループ以外のスレッドから呼んでもよい）"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is not None and running is not self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._resize, max_workers)
+        else:
+            self._resize(max_workers)
+
+    def _resize(self, max_workers):
+        max_workers = max(1, int(max_workers))
+        delta = max_workers - self.max_workers
+        self.max_workers = max_workers
+        if self.executor is not None:
+            # 実行中の推論は古いスレッドで最後まで続け、以降は新しいスレッド（新しいスレッド数の設定）で実行する
+            self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        if self._slots is None:
+            return
+        for _ in range(max(0, delta)):
+            self._slots.release()
+        if delta < 0:
+            task = asyncio.get_running_loop().create_task(self._retire_slots(-delta))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        print(f"BatchScheduler: 同時に実行する推論の数を {max_workers} にしました")
+
+    async def _retire_slots(self, count):
+        """減らした分の枠を、実行中の推論が終わり次第取り上げる"""
+        for _ in range(count):
+            await self._slots.acquire()
+
+    def retry_after(self):
+        """現在の待ち行列が捌けるまでのおおよその秒数を返す"""
+        batch_seconds = self._batch_seconds or 1.0
+        batches_ahead = math.ceil(self.waiting / self.max_batch_size) / self.max_workers
+        return max(1, math.ceil(batch_seconds * batches_ahead))
+
+    def _admit(self, client_id, cost):
+        """
+        待ち行列に空きがなければ QueueFullError を、クライアントの上限を超えていれば
+        fairness.QuotaExceededError を送出する
+        """
+        if self.waiting >= self.max_queue_size:
+            # 待ち時間を際限なく伸ばすより、すぐに断って再試行してもらう
+            self.rejected_total += 1
+            raise QueueFullError(self.retry_after())
+        if self.quotas is not None:
+            self.quotas.acquire(client_id, cost)
+
+    def _enqueue(self, pending, cost):
+        if self.quotas is not None:
+            # 応答を返した時点（取り消された場合を含む）で、クライアントの同時実行数の枠を返す
+            pending.future.add_done_callback(lambda future: self.quotas.release(pending.client_id))
+        self.waiting += 1
+        self._count(self._waiting_by_model, pending.model_name, 1)
+        self._queue.put(pending, pending.client_id, pending.priority, cost)
+
+    async def submit(self, model_name, prompt, params, control=None, client_id=DEFAULT_CLIENT_ID, priority="normal"):
+        """リクエストをキューに積み、自分の応答が得られるまで待つ"""
+        self.start()
+        cost = params.get("max_new_tokens") or 1
+        self._admit(client_id, cost)
+        pending = _PendingRequest(
+            model_name, prompt, params, control, client_id, priority, key=(model_name,) + self.batch_key(params)
+        )
+        self._enqueue(pending, cost)
+        return await pending.future
+
+    def submit_many(self, model_name, prompts, params, client_id=DEFAULT_CLIENT_ID, priority="normal"):
+        """
+        複数のプロンプトを1つずつバッチにまとめられるリクエストとして、まとめて受け付ける
+
+        待ち行列に全件分の空きが無ければ1件も受け付けずに QueueFullError を送出する
+        （一部だけ受け付けて残りを断ることはない）。
+
+        Returns:
+            list: プロンプトごとの応答を結果に持つ asyncio.Future のリスト
+        """
+        self.start()
+        if self.waiting + len(prompts) > self.max_queue_size:
+            self.rejected_total += 1
+            raise QueueFullError(self.retry_after())
+        cost = params.get("max_new_tokens") or 1
+        acquired = 0
+        try:
+            if self.quotas is not None:
+                for _ in prompts:
+                    self.quotas.acquire(client_id, cost)
+                    acquired += 1
+        except Exception:
+            for _ in range(acquired):
+                self.quotas.release(client_id)
+            raise
+        futures = []
+        for prompt in prompts:
+            pending = _PendingRequest(
+                model_name, prompt, params, None, client_id, priority, key=(model_name,) + self.batch_key(params)
+            )
+            self._enqueue(pending, cost)
+            futures.append(pending.future)
+        return futures
+
+    async def _collect(self, first):
+        """最初の1件に続き、待機時間内に届いた後続リクエストをまとめて返す"""
+        items = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            item = self._queue.pop(_batchable)
+            if item is not None:
+                items.append(item)
+                continue
+            if len(self._queue):
+                # 次に取り出すべきものがバッチにまとめられない処理なら、そこで打ち切る
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self._queue.wait(remaining):
+                break
+        return items
+
+    async def _next(self):
+        """次に処理するリクエストを、優先度とクライアント間の公平性に従って取り出す"""
+        while True:
+            item = self._queue.pop()
+            if item is not None:
+                return item
+            await self._queue.wait()
+
+    async def _run(self):
+        """リクエストを集め、サンプリング条件ごとにバッチ推論する"""
+        while True:
+            # 推論スレッドが空くまで取り出さないことで、混雑時ほどバッチが大きくなり、
+            # 待っている間に届いた優先度の高いリクエストが先に選ばれる
+            await self._slots.acquire()
+            first = await self._next()
+            if first.fn is not None:
+                task = asyncio.get_running_loop().create_task(self._execute_single(first))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            items = await self._collect(first)
+
+            # モデルとサンプリング条件が同じものだけを同じバッチにまとめる（到着順は維持）
+            groups = {}
+            for item in items:
+                groups.setdefault(item.key, []).append(item)
+
+            for i, group in enumerate(groups.values()):
+                if i > 0:
+                    await self._slots.acquire()
+                task = asyncio.get_running_loop().create_task(self._execute(group))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, group):
+        """1グループ分を推論スレッドでバッチ推論し、各リクエストに結果を返す"""
+        self.waiting -= len(group)
+        self._count(self._waiting_by_model, group[0].model_name, -len(group))
+        # 待っている間にクライアントが切断したリクエストは推論しない
+        group = [item for item in group if not item.future.done()]
+        if not group:
+            self._slots.release()
+            return
+        now = time.time()
+        for item in group:
+            self._record_wait(now - item.enqueued_at, item)
+        self._record_batch(len(group))
+        self.in_flight += len(group)
+        self._count(self._in_flight_by_model, group[0].model_name, len(group))
+        started = time.monotonic()
+        try:
+            prompts = [item.prompt for item in group]
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.run_batch, group[0].model_name, prompts, group[0].params,
+                [item.control for item in group],
+            )
+            for item, result in zip(group, results):
+                if not item.future.done():
+                    item.future.set_result(result)
+        except Exception as e:
+            print(f"BatchScheduler: バッチ推論中にエラーが発生しました: {e}")
+            traceback.print_exc()
+            for item in group:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        finally:
+            self.in_flight -= len(group)
+            self._count(self._in_flight_by_model, group[0].model_name, -len(group))
+            self._record_duration(time.monotonic() - started)
+            self._slots.release()
+
+    def submit_single(self, fn, *args, model_name=None, client_id=DEFAULT_CLIENT_ID, priority="normal", cost=1):
+        """
+        バッチにまとめられない処理（ストリーミング生成など）を推論スレッドで単独実行する
+
+        バッチ推論と同じ待ち行列に並び、優先度とクライアント間の公平性に従って順番が来たら実行する。
+        受け付けの可否はこの呼び出し時点で判定し、満杯なら QueueFullError を、
+        クライアントの上限を超えていれば fairness.QuotaExceededError を送出する。
+
+        Args:
+            model_name (str, optional): 処理に使うモデル名（待ち行列の深さなどをモデルごとに数えるため）
+            cost (int): 公平性とトークンレートの計算に使う処理の重さ（生成する最大トークン数）
+
+        Returns:
+            asyncio.Future: fn の戻り値を結果に持つ Future（cancel() すると、実行前なら実行しない）
+        """
+        self.start()
+        self._admit(client_id, cost)
+        pending = _PendingRequest(model_name, None, None, client_id=client_id, priority=priority)
+        pending.fn, pending.args = fn, args
+        self._enqueue(pending, cost)
+        return pending.future
+
+    async def _execute_single(self, item):
+        self.waiting -= 1
+        self._count(self._waiting_by_model, item.model_name, -1)
+        if item.future.done():
+            self._slots.release()
+            return
+        self._record_wait(time.time() - item.enqueued_at, item)
+        self.in_flight += 1
+        self._count(self._in_flight_by_model, item.model_name, 1)
+        started = time.monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, item.fn, *item.args)
+            if not item.future.done():
+                item.future.set_result(result)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self._count(self._in_flight_by_model, item.model_name, -1)
+            self._record_duration(time.monotonic() - started)
+            self._slots.release()
+
+    @staticmethod
+    def _count(counts, model_name, delta):
+        counts[model_name] = counts.get(model_name, 0) + delta
+
+    def waiting_for(self, model_name):
+        """指定したモデルで推論開始を待っているリクエスト数"""
+        return self._waiting_by_model.get(model_name, 0)
+
+    def in_flight_for(self, model_name):
+        """指定したモデルで推論中のリクエスト数"""
+        return self._in_flight_by_model.get(model_name, 0)
+
+    def _record_wait(self, seconds, item):
+        self._wait_times.append(seconds)
+        if self.on_wait is not None:
+            self.on_wait(seconds, item.model_name, item.client_id, item.priority)
+
+    def _record_batch(self, size):
+        self.batches_total += 1
+        self.requests_total += size
+        self.batch_size_counts[size] = self.batch_size_counts.get(size, 0) + 1
+
+    def _record_duration(self, seconds):
+        if self._batch_seconds is None:
+            self._batch_seconds = seconds
+        else:
+            self._batch_seconds = 0.8 * self._batch_seconds + 0.2 * seconds
+
+    def stats(self):
+        """待ち行列とバッチの充填状況を返す"""
+        avg_batch_size = self.requests_total / self.batches_total if self.batches_total else 0.0
+        wait_times = list(self._wait_times)
+        return {
+            "queue_depth": self.waiting,
+            "in_flight": self.in_flight,
+            "max_queue_size": self.max_queue_size,
+            "max_workers": self.max_workers,
+            "rejected_total": self.rejected_total,
+            "wait_time_avg": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "wait_time_p95": percentile(wait_times, 95),
+            "wait_time_max": max(wait_times) if wait_times else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches_total": self.batches_total,
+            "requests_total": self.requests_total,
+            "avg_batch_size": avg_batch_size,
+            "avg_fill_ratio": avg_batch_size / self.max_batch_size,
+            "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+            "queued": self._queue.depths() if self._queue is not None else {},
+            "models": {
+                model_name: {"queue_depth": self.waiting_for(model_name), "in_flight": self.in_flight_for(model_name)}
+                for model_name in sorted(set(self._waiting_by_model) | set(self._in_flight_by_model), key=str)
+            },
+            "clients": self.quotas.stats() if self.quotas is not None else None,
+        }
@@ -0,0 +1,286 @@
+# sessions.py
+# /chat の会話ごとに past_key_values を保持し、次のターンでは新しく追加されたトークンだけをプレフィルする
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import torch
+from transformers import StoppingCriteriaList
+
+from prefix_cache import common_prefix_length, kv_cache_nbytes
+from stopping import RequestStoppingCriteria
+
+
+class ChatSession:
+    """1つの会話の履歴と、これまでに処理したトークンの past_key_values"""
+
+    def __init__(self, session_id, model_name):
+        self.session_id = session_id
+        self.model_name = model_name
+        self.messages = []  # {"role": ..., "content": ...} のリスト
+        self.token_ids = []  # 最後のターンで処理したトークンID列（プロンプト＋生成した応答）
+        self.past_key_values = None  # token_ids の先頭 past_key_values.get_seq_length() 個分のキャッシュ
+        self.nbytes = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.turns = 0
+        self.busy = False  # 同じ会話のターンは1つずつ処理する
+
+    def drop_cache(self):
+        """past_key_values を解放する（履歴は残すので、次のターンで全体をプレフィルし直す）"""
+        self.past_key_values = None
+        self.token_ids = []
+        self.nbytes = 0
+
+    def info(self):
+        return {
+            "session_id": self.session_id,
+            "model": self.model_name,
+            "turns": self.turns,
+            "messages": len(self.messages),
+            "cached_tokens": self.past_key_values.get_seq_length() if self.past_key_values is not None else 0,
+            "bytes": self.nbytes,
+            "idle_seconds": time.time() - self.last_used,
+        }
+
+
+class SessionStore:
+    """
+    会話セッションを保持し、一定時間使われなかった会話を削除し、KVキャッシュの合計がメモリ上限を超えたら
+    最も古く使われた会話のキャッシュから解放する
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024, idle_timeout=1800, sweep_interval=60):
+        """
+        初期化
+
+        Args:
+            max_bytes (int): 全セッションの past_key_values の合計サイズの上限（バイト）
+            idle_timeout (float): この秒数使われなかったセッションは削除する。0以下なら削除しない
+            sweep_interval (float): リクエストが無い間も、この秒数ごとに使われなくなったセッションを削除する
+        """
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._sessions = OrderedDict()  # セッションID -> ChatSession（末尾ほど最近使われた）
+        self._lock = threading.Lock()  # 推論スレッドとイベントループの両方から参照されるため
+        self._sweeper = None
+
+        self.expirations = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def total_bytes(self):
+        return sum(session.nbytes for session in self._sessions.values())
+
+    def expire_idle(self, now=None):
+        """
+        一定時間使われなかったセッションを削除する
+
+        Returns:
+            int: 削除したセッションの数
+        """
+        if not self.idle_timeout or self.idle_timeout <= 0:
+            return 0
+        now = now or time.time()
+        with self._lock:
+            expired = [
+                session_id for session_id, session in self._sessions.items()
+                if not session.busy and now - session.last_used > self.idle_timeout
+            ]
+            for session_id in expired:
+                del self._sessions[session_id]
+            self.expirations += len(expired)
+        return len(expired)
+
+    def start(self):
+        """使われなくなったセッションを定期的に削除するタスクをイベントループ上で起動する"""
+        if self.idle_timeout <= 0 or self.sweep_interval <= 0:
+            return
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep(self):
+        # get / create が呼ばれない（リクエストが無い）間も、期限切れの会話とそのKVキャッシュを解放する
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.expire_idle()
+            if expired:
+                print(f"SessionStore: 使われなくなった会話を{expired}件削除しました")
+
+    def get(self, session_id):
+        """セッションを返す。無い場合（期限切れを含む）は None"""
+        self.expire_idle()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    @staticmethod
+    def new_session(model_name, session_id=None):
+        """
+        まだ保持しない新しいセッションを作る（session_id を省略した場合はランダムなIDを割り当てる）
+
+        最初のターンが受け付けられてから add で保持する。
+        """
+        return ChatSession(session_id or uuid.uuid4().hex, model_name)
+
+    def add(self, session):
+        """new_session で作ったセッションを保持する"""
+        self.expire_idle()
+        with self._lock:
+            self._sessions[session.session_id] = session
+        return session
+
+    def create(self, model_name, session_id=None):
+        """新しいセッションを作って保持する"""
+        return self.add(self.new_session(model_name, session_id))
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def drop_model(self, model_name):
+        """解放されたモデルのセッションのKVキャッシュをまとめて解放する（履歴は残す）"""
+        with self._lock:
+            for session in self._sessions.values():
+                if session.model_name == model_name:
+                    session.drop_cache()
+
+    def update(self, session, reused_tokens, prefilled_tokens):
+        """ターンを終えたセッションのメモリ量を更新し、上限を超えた分を古いセッションから解放する"""
+        with self._lock:
+            session.nbytes = kv_cache_nbytes(session.past_key_values) if session.past_key_values is not None else 0
+            session.last_used = time.time()
+            self.reused_tokens += reused_tokens
+            self.prefilled_tokens += prefilled_tokens
+            if session.nbytes > self.max_bytes:
+                # 1つの会話だけで上限を超える場合は、その会話もキャッシュせずに毎回プレフィルする
+                session.drop_cache()
+                self.evictions += 1
+            for other in list(self._sessions.values()):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if other is session or other.busy or other.past_key_values is None:
+                    continue
+                other.drop_cache()
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "idle_timeout": self.idle_timeout,
+                "sweep_interval": self.sweep_interval,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+                "prefilled_tokens": self.prefilled_tokens,
+            }
+
+
+def render_chat(tokenizer, messages):
+    """会話の履歴を、アシスタントの応答を続けて生成するためのトークンID列にする"""
+    if getattr(tokenizer, "chat_template", None):
+        ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True)
+        if hasattr(ids, "input_ids"):
+            ids = ids["input_ids"]
+        return list(ids)
+    # チャットテンプレートが無いモデルでは、役割名を付けて並べる
+    text = "".join(f"{message['role']}: {message['content']}\n" for message in messages) + "assistant: "
+    return tokenizer(text).input_ids
+
+
+def commit_turn(session, messages, reply):
+    """生成を終えたターンの新しいメッセージと応答を会話の履歴に追加する"""
+    session.messages = messages + [reply]
+    session.turns += 1
+
+
+def run_chat_turn(pipe, store, session, new_messages, params, control, logits_processor=None):
+    """
+    会話の履歴に新しいメッセージを続け、保持している past_key_values の続きから応答を生成する（推論スレッドで実行）
+
+    チャットテンプレートで履歴全体を描画し直したトークン列と、前回処理したトークン列の先頭から一致する部分は
+    キャッシュを再利用する（前回の応答の再トークン化で一致しなくなった位置からはプレフィルし直す）。
+    履歴への追加は行わない（応答を確定させてから commit_turn で追加する）。
+
+    Returns:
+        dict: 応答、新しいメッセージまでの履歴、プロンプトのトークン数、再利用したトークン数、新たにプレフィルしたトークン数
+    """
+    tokenizer = pipe.tokenizer
+    device = pipe.model.device
+    messages = session.messages + [dict(message) for message in new_messages]
+    prompt_ids = render_chat(tokenizer, messages)
+
+    past_key_values = session.past_key_values
+    reused_tokens = 0
+    if past_key_values is not None:
+        # 最低1トークンはモデルに入力する必要があるため、プロンプト全体は再利用しない
+        reused_tokens = min(
+            common_prefix_length(session.token_ids, prompt_ids), len(prompt_ids) - 1, past_key_values.get_seq_length()
+        )
+        if reused_tokens <= 0:
+            past_key_values, reused_tokens = None, 0
+        elif reused_tokens < past_key_values.get_seq_length():
+            # 一致した長さまで切り詰める（負の値は末尾から削るトークン数）
+            past_key_values.crop(reused_tokens - past_key_values.get_seq_length())
+    prefilled_tokens = len(prompt_ids) - reused_tokens
+    print(f"chat: session={session.session_id}, {reused_tokens}/{len(prompt_ids)}トークンのプレフィルを再利用します")
+
+    input_ids = torch.tensor([prompt_ids], device=device)
+    stopping_criteria = StoppingCriteriaList([
+        RequestStoppingCriteria(tokenizer, [control], input_ids.shape[1], pipe.model.generation_config.eos_token_id)
+    ])
+    try:
+        with torch.no_grad():
+            output = pipe.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                pad_token_id=tokenizer.pad_token_id,
+                return_dict_in_generate=True,
+                use_cache=True,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+                **params,
+            )
+    except Exception:
+        # 途中まで書き換えられたキャッシュは使えないため、次のターンでは全体をプレフィルし直す
+        session.drop_cache()
+        store.update(session, 0, 0)
+        raise
+
+    output_ids = output.sequences[0].tolist()
+    text = tokenizer.decode(output_ids[len(prompt_ids):], skip_special_tokens=True).strip()
+    # 履歴に残さないターン（切断など）でも、キャッシュは次のターンの先頭の一致部分に再利用できる
+    session.token_ids = output_ids
+    session.past_key_values = output.past_key_values
+    store.update(session, reused_tokens, prefilled_tokens)
+    return {
+        "text": text,
+        "messages": messages,
+        "prompt_tokens": len(prompt_ids),
+        "completion_tokens": len(output_ids) - len(prompt_ids),
+        "reused_tokens": reused_tokens,
+        "prefilled_tokens": prefilled_tokens,
+    }
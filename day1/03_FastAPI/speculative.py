@@ -0,0 +1,189 @@
+# speculative.py
+# 小さなドラフトモデルに候補トークンを提案させ、本体モデルが1回の順伝播でまとめて検証する投機的デコーディング
+import threading
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+def load_draft_model(model_name, device):
+    """ドラフトモデルとそのトークナイザーを読み込む"""
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(device)
+    model.eval()
+    return model, tokenizer
+
+
+class _ForwardProbe:
+    """モデルの forward の呼び出し回数と所要時間を、呼び出したスレッドごとに記録するフック"""
+
+    def __init__(self, model):
+        self._local = threading.local()  # 推論スレッドが複数ある場合に計測が混ざらないようにする
+        self._handles = [
+            model.register_forward_pre_hook(self._before),
+            model.register_forward_hook(self._after),
+        ]
+
+    def start(self):
+        self._local.durations = []
+
+    def stop(self):
+        durations = getattr(self._local, "durations", None) or []
+        self._local.durations = None
+        return durations
+
+    def _before(self, module, args):
+        if getattr(self._local, "durations", None) is not None:
+            self._local.started_at = time.perf_counter()
+
+    def _after(self, module, args, output):
+        durations = getattr(self._local, "durations", None)
+        if durations is not None:
+            durations.append(time.perf_counter() - self._local.started_at)
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+
+
+class SpeculativeRun:
+    """1回の投機的デコーディングの計測結果（GenerationTimer と同じく prefill_time / decode_time を持つ）"""
+
+    def __init__(self, target_durations, draft_durations, new_tokens, elapsed):
+        self.target_forwards = len(target_durations)
+        self.draft_tokens = len(draft_durations)  # ドラフトモデルの順伝播1回で1トークンを提案する
+        self.new_tokens = new_tokens
+        self.elapsed = elapsed
+        # 本体モデルの順伝播1回ごとに「受理された候補 + 本体が決めた1トークン」が確定する
+        self.accepted_tokens = max(0, new_tokens - self.target_forwards)
+        self.prefill_time = target_durations[0] if target_durations else None
+        self.decode_time = elapsed - self.prefill_time if target_durations else None
+
+        # 同じ本体モデルで1トークンずつデコードした場合の時間を、検証時の順伝播1回の時間から推定する
+        self.estimated_speedup = None
+        if len(target_durations) > 1 and elapsed > 0:
+            verify_time = sum(target_durations[1:]) / (len(target_durations) - 1)
+            baseline = target_durations[0] + max(0, new_tokens - 1) * verify_time
+            self.estimated_speedup = baseline / elapsed
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else None
+
+    def info(self):
+        return {
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.acceptance_rate,
+            "target_forward_passes": self.target_forwards,
+            "tokens_per_forward": self.new_tokens / self.target_forwards if self.target_forwards else None,
+            "estimated_speedup": self.estimated_speedup,
+        }
+
+
+class SpeculativeDecoder:
+    """本体モデルのパイプラインとドラフトモデルを組にして、投機的デコーディングで生成する"""
+
+    def __init__(self, pipe, draft_model, draft_tokenizer, draft_model_name=None, num_assistant_tokens=None):
+        """
+        初期化
+
+        Args:
+            pipe: 本体モデルの text-generation パイプライン
+            draft_model: 候補トークンを提案する小さなモデル
+            draft_tokenizer: ドラフトモデルのトークナイザー
+            draft_model_name (str, optional): 統計情報に表示するドラフトモデル名
+            num_assistant_tokens (int, optional): 1回に提案させる候補トークン数の初期値
+        """
+        self.pipe = pipe
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self.draft_model_name = draft_model_name
+        # 語彙が異なる場合は、transformers がトークナイザー間で変換しながら検証する
+        self.same_tokenizer = draft_tokenizer.get_vocab() == pipe.tokenizer.get_vocab()
+        if num_assistant_tokens:
+            draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        self._target_probe = _ForwardProbe(pipe.model)
+        self._draft_probe = _ForwardProbe(draft_model)
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.target_forwards = 0
+        self.generation_time = 0.0
+        self.estimated_baseline_time = 0.0
+
+    def generate_kwargs(self):
+        """generate（またはパイプライン呼び出し）に追加する引数"""
+        kwargs = {"assistant_model": self.draft_model}
+        if not self.same_tokenizer:
+            kwargs.update(tokenizer=self.pipe.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        return kwargs
+
+    def begin(self):
+        """計測を開始する（推論スレッドで呼ぶ）"""
+        self._target_probe.start()
+        self._draft_probe.start()
+        return time.perf_counter()
+
+    def end(self, started_at, new_tokens):
+        """計測を終了し、受理率と推定速度向上率を集計して返す"""
+        run = SpeculativeRun(self._target_probe.stop(), self._draft_probe.stop(), new_tokens, time.perf_counter() - started_at)
+        with self._lock:
+            self.requests += 1
+            self.draft_tokens += run.draft_tokens
+            self.accepted_tokens += run.accepted_tokens
+            self.generated_tokens += run.new_tokens
+            self.target_forwards += run.target_forwards
+            if run.estimated_speedup is not None:
+                self.generation_time += run.elapsed
+                self.estimated_baseline_time += run.elapsed * run.estimated_speedup
+        return run
+
+    def generate(self, prompt, params):
+        """
+        1件分を投機的デコーディングで生成する（推論スレッドで実行）
+
+        貪欲法（do_sample=False）では、本体モデルだけで生成した場合と同じ出力になる。
+
+        Returns:
+            tuple: (生成された応答, SpeculativeRun)
+        """
+        tokenizer = self.pipe.tokenizer
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(self.pipe.model.device)
+        started_at = self.begin()
+        with torch.no_grad():
+            output_ids = self.pipe.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                pad_token_id=tokenizer.pad_token_id,
+                **self.generate_kwargs(),
+                **params,
+            )
+        new_ids = output_ids[0, input_ids.shape[1]:]
+        run = self.end(started_at, new_ids.shape[0])
+        return tokenizer.decode(new_ids, skip_special_tokens=True).strip(), run
+
+    def close(self):
+        """本体モデルに付けたフックを外す"""
+        self._target_probe.remove()
+        self._draft_probe.remove()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "draft_model": self.draft_model_name,
+                "same_tokenizer": self.same_tokenizer,
+                "num_assistant_tokens": self.draft_model.generation_config.num_assistant_tokens,
+                "requests": self.requests,
+                "draft_tokens": self.draft_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": self.accepted_tokens / self.draft_tokens if self.draft_tokens else None,
+                "tokens_per_forward": self.generated_tokens / self.target_forwards if self.target_forwards else None,
+                "estimated_speedup": (
+                    self.estimated_baseline_time / self.generation_time if self.generation_time else None
+                ),
+            }
@@ -0,0 +1,148 @@
+# stopping.py
+# リクエストごとの期限・停止文字列・クライアント切断に応じて、生成を途中で打ち切るための仕組み
+import copy
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class RequestControl:
+    """1リクエスト分の打ち切り条件と、生成を止めた理由を保持する"""
+
+    def __init__(self, deadline_seconds=None, stop=None, max_new_tokens=None):
+        """
+        初期化
+
+        Args:
+            deadline_seconds (float, optional): 受信からこの秒数を過ぎたら生成を打ち切る。None や0以下なら期限なし
+            stop (list, optional): 生成結果に現れたら生成を打ち切る文字列のリスト
+            max_new_tokens (int, optional): 生成する最大トークン数（打ち切り理由の判定に使う）
+        """
+        self.created_at = time.time()
+        self.deadline = self.created_at + deadline_seconds if deadline_seconds and deadline_seconds > 0 else None
+        self.stop = [s for s in (stop or []) if s]
+        self.max_new_tokens = max_new_tokens
+        self._cancelled = threading.Event()
+        self.finish_reason = None  # "eos" / "length" / "stop" / "deadline" / "cancelled"
+        self.generated_tokens = 0
+
+    def cancel(self):
+        """クライアントが切断したときにイベントループ側から呼ぶ"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.time()) >= self.deadline
+
+    def split(self, count):
+        """
+        同じ期限・停止文字列・切断を共有し、打ち切り理由と生成トークン数は別々に持つ打ち切り条件を count 個作る
+        （1つのリクエストで複数の候補を生成する場合に、候補ごとに使う）
+        """
+        controls = []
+        for _ in range(count):
+            control = copy.copy(self)
+            control.finish_reason = None
+            control.generated_tokens = 0
+            controls.append(control)
+        return controls
+
+    def check_before_start(self):
+        """
+        推論を始める前に、待っている間に切断・期限切れになっていないかを確認する
+
+        Returns:
+            bool: 推論を行う必要が無い場合は True（finish_reason を設定する）
+        """
+        if self.cancelled:
+            self.finish_reason = "cancelled"
+        elif self.expired():
+            self.finish_reason = "deadline"
+        return self.finish_reason is not None
+
+    def finish(self, text):
+        """
+        生成後のテキストを停止文字列の位置で切り詰め、打ち切り理由を確定する
+
+        Returns:
+            tuple: (切り詰めたテキスト, 切り捨てた部分のテキスト)
+        """
+        trimmed, dropped = truncate_at_stop(text, self.stop)
+        if self.cancelled:
+            self.finish_reason = "cancelled"
+        elif dropped is not None:
+            self.finish_reason = "stop"
+        elif self.finish_reason is None or self.finish_reason == "stop":
+            # 停止文字列を検出した後に、デコード結果では一致しなくなった場合も長さ/EOSで判定する
+            reached_limit = self.max_new_tokens is not None and self.generated_tokens >= self.max_new_tokens
+            self.finish_reason = "length" if reached_limit else "eos"
+        return trimmed, dropped
+
+
+def truncate_at_stop(text, stop):
+    """最初に現れた停止文字列より前の部分と、それ以降（停止文字列を含む）を返す。無ければ (text, None)"""
+    positions = [text.find(s) for s in stop if s in text]
+    if not positions:
+        return text, None
+    index = min(positions)
+    return text[:index].rstrip(), text[index:]
+
+
+class RequestStoppingCriteria(StoppingCriteria):
+    """バッチ内の各行について、対応する RequestControl の条件を満たしたら生成を止める"""
+
+    def __init__(self, tokenizer, controls, start_length, eos_token_id=None):
+        """
+        初期化
+
+        Args:
+            tokenizer: 停止文字列の判定のためにデコードするトークナイザー
+            controls (list): バッチの行ごとの RequestControl
+            start_length (int): 入力（左パディング込み）のトークン数。これ以降が生成されたトークン
+            eos_token_id (int | list, optional): 生成を終えるトークンID。省略時はトークナイザーのEOS
+        """
+        self.tokenizer = tokenizer
+        self.controls = controls
+        self.start_length = start_length
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id])
+        # 停止文字列を含みうる末尾だけをデコードする（1トークンは少なくとも1文字になる前提）
+        self.tail_tokens = max((len(s) for control in controls for s in control.stop), default=0) + 4
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.time()
+        generated = input_ids.shape[1] - self.start_length
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for row, control in enumerate(self.controls):
+            if control.finish_reason is not None:
+                done[row] = True
+                continue
+            control.generated_tokens = generated
+            if input_ids[row, -1].item() in self.eos_token_ids:
+                control.finish_reason = "eos"
+            elif control.cancelled:
+                control.finish_reason = "cancelled"
+            elif control.expired(now):
+                control.finish_reason = "deadline"
+            elif control.stop:
+                tail = input_ids[row, max(self.start_length, input_ids.shape[1] - self.tail_tokens):]
+                text = self.tokenizer.decode(tail, skip_special_tokens=True)
+                if any(s in text for s in control.stop):
+                    control.finish_reason = "stop"
+            done[row] = control.finish_reason is not None
+        return done
+
+
+def stopping_criteria_for(pipe, controls, prompts):
+    """パイプラインで prompts を生成するときに generate に渡す stopping_criteria を作る"""
+    tokenizer = pipe.tokenizer
+    # 左パディング後の入力トークン数（生成されたトークンが始まる位置）
+    start_length = max(len(tokenizer(prompt).input_ids) for prompt in prompts)
+    eos_token_id = pipe.model.generation_config.eos_token_id
+    return StoppingCriteriaList([RequestStoppingCriteria(tokenizer, controls, start_length, eos_token_id)])
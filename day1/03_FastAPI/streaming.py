@@ -0,0 +1,67 @@
+# streaming.py
+# 生成中のトークンを逐次クライアントへ送るためのストリーマーとSSE整形用の関数
+import asyncio
+import json
+import time
+
+from transformers import TextStreamer
+
+
+class AsyncTextStreamer(TextStreamer):
+    """推論スレッドで生成されたテキスト片を、イベントループ側の asyncio.Queue へ渡すストリーマー"""
+
+    def __init__(self, tokenizer, loop, skip_prompt=True, **decode_kwargs):
+        """
+        初期化
+
+        Args:
+            tokenizer: デコードに使用するトークナイザー
+            loop (asyncio.AbstractEventLoop): テキスト片を受け取るイベントループ
+            skip_prompt (bool): プロンプト部分を送らない場合は True
+        """
+        super().__init__(tokenizer, skip_prompt=skip_prompt, **decode_kwargs)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.started_at = time.time()
+        self.prompt_tokens = 0
+        self.token_times = []  # 各トークンが生成された時刻
+        self.finished = False
+
+    def put(self, value):
+        """generate から渡されたトークンIDを記録してデコードする"""
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            # 最初の呼び出しはプロンプト全体
+            self.prompt_tokens = value.shape[-1]
+        else:
+            now = time.time()
+            self.token_times.extend([now] * value.numel())
+        super().put(value)
+
+    def on_finalized_text(self, text, stream_end=False):
+        """デコード済みのテキスト片をイベントループへ渡す"""
+        if stream_end:
+            self.finished = True
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (text, stream_end))
+
+    def timings(self):
+        """最初のトークンまでの時間、トークン間の平均間隔、生成トークン数を返す"""
+        total_tokens = len(self.token_times)
+        time_to_first_token = self.token_times[0] - self.started_at if total_tokens else None
+        inter_token_latency = None
+        if total_tokens > 1:
+            inter_token_latency = (self.token_times[-1] - self.token_times[0]) / (total_tokens - 1)
+        return {
+            "time_to_first_token": time_to_first_token,
+            "inter_token_latency": inter_token_latency,
+            "prompt_tokens": self.prompt_tokens,
+            "total_tokens": total_tokens,
+        }
+
+
+def sse_event(data, event=None):
+    """Server-Sent Events 形式の1イベント分の文字列を作る"""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,110 @@
+# thread_tuning.py
+# 読み込んだモデルで短い推論を試し、同時に実行する推論の数と1つあたりの torch のスレッド数の組み合わせを選ぶ
+#
+# torch は既定でコア数と同じ数のスレッドで行列演算を並列化するため、複数の推論を同時に実行すると
+# スレッドがコア数を大きく超えて奪い合い、スループットが落ちる。ここでは「同時実行数 × スレッド数 ≒ コア数」となる
+# 組み合わせをいくつか実測し、遅延の目標を満たす中で最もトークン/秒が高いものを選ぶ。
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from scheduler import percentile
+from warmup import warmup_prompts
+
+
+def parse_split(text):
+    """"2x4" のような指定を (同時実行数, スレッド数) にする。形式が違う場合は ValueError"""
+    workers, _, threads = text.lower().partition("x")
+    workers, threads = int(workers), int(threads)
+    if workers < 1 or threads < 1:
+        raise ValueError(f"同時実行数とスレッド数は1以上を指定してください: {text}")
+    return workers, threads
+
+
+def candidate_splits(cores, max_workers=4):
+    """同時実行数を1, 2, 4, ... と倍にしながら、コアを等分した組み合わせを返す"""
+    splits = []
+    workers = 1
+    while workers <= min(cores, max_workers):
+        splits.append((workers, max(1, cores // workers)))
+        workers *= 2
+    return splits
+
+
+def clone_pipeline(pipe):
+    """
+    モデルの重みは共有したまま、トークナイザーやパイプライン自体の状態を別に持つコピーを作る
+
+    パイプラインとトークナイザーはスレッドセーフではないため、同時に推論するスレッドごとに別のコピーを使う。
+    """
+    clone = copy.copy(pipe)
+    clone.tokenizer = copy.deepcopy(pipe.tokenizer)
+    return clone
+
+
+def benchmark_split(pipe, prompt, workers, threads, max_new_tokens=16, rounds=2):
+    """
+    workers 個のスレッドから同時に推論し、全体のトークン/秒と1件あたりの遅延を測る
+
+    Returns:
+        dict: 同時実行数、スレッド数、トークン/秒、遅延の p50 / p95（秒）
+    """
+    torch.set_num_threads(threads)
+    latencies = []
+    params = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False}
+    pipes = [pipe] + [clone_pipeline(pipe) for _ in range(workers - 1)]
+
+    def run(index):
+        # OpenMP のスレッド数はスレッドごとの設定なので、推論するスレッドでも設定する
+        torch.set_num_threads(threads)
+        for _ in range(rounds):
+            started = time.perf_counter()
+            pipes[index](prompt, **params)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thread-tuning") as executor:
+        list(executor.map(run, range(workers)))
+    elapsed = time.perf_counter() - started
+    return {
+        "workers": workers,
+        "threads": threads,
+        "tokens_per_second": workers * rounds * max_new_tokens / elapsed,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+    }
+
+
+def tune_threads(pipe, splits, latency_target=0.0, prompt_tokens=64, max_new_tokens=16, rounds=2):
+    """
+    候補の組み合わせを順に試し、遅延（p95）が latency_target 以下の中で最もトークン/秒が高いものを選ぶ
+
+    どれも目標を満たさない場合は、最も遅延が小さいものを選ぶ。
+
+    Args:
+        splits (list): (同時実行数, スレッド数) の候補
+        latency_target (float): 1件あたりの遅延の目標（秒）。0なら遅延は見ない
+
+    Returns:
+        tuple: (選んだ結果, すべての候補の結果)
+    """
+    prompt = warmup_prompts(pipe.tokenizer, [prompt_tokens])[0]
+    # スレッド数を変えた直後の最初の推論は遅くなるため、計測の前に1回推論しておく
+    pipe(prompt, max_new_tokens=2, do_sample=False)
+    results = []
+    for workers, threads in splits:
+        result = benchmark_split(pipe, prompt, workers, threads, max_new_tokens, rounds)
+        result["meets_target"] = not latency_target or result["latency_p95"] <= latency_target
+        print(
+            f"スレッド調整: 同時実行数={workers}, スレッド数={threads}: {result['tokens_per_second']:.1f}トークン/秒, "
+            f"p95={result['latency_p95']:.2f}秒"
+        )
+        results.append(result)
+    eligible = [result for result in results if result["meets_target"]]
+    if eligible:
+        best = max(eligible, key=lambda result: result["tokens_per_second"])
+    else:
+        best = min(results, key=lambda result: result["latency_p95"])
+    return best, results
@@ -0,0 +1,101 @@
+# warmup.py
+# 起動直後の最初のリクエストが遅くならないよう、モデルを事前に推論させる（必要なら torch.compile も行う）
+import os
+import time
+
+import torch
+
+# ウォームアップ用のプロンプトの元になる文章（指定したトークン数になるまで繰り返す）
+WARMUP_TEXT = (
+    "人工知能（AI）は、人間の知的な振る舞いをコンピュータで再現する技術です。"
+    "大規模言語モデルは大量の文章から学習し、質問への回答や文章の要約、翻訳などを行うことができます。"
+)
+
+
+def warmup_prompts(tokenizer, lengths):
+    """指定したトークン数ごとのウォームアップ用プロンプトを作る"""
+    ids = tokenizer(WARMUP_TEXT, add_special_tokens=False).input_ids
+    prompts = []
+    for length in lengths:
+        repeated = ids * (length // max(1, len(ids)) + 1)
+        prompts.append(tokenizer.decode(repeated[:length], skip_special_tokens=True))
+    return prompts
+
+
+def warm_up_pipeline(pipe, lengths, batch_sizes=(1,), max_new_tokens=8, speculative_decoder=None):
+    """
+    長さとバッチサイズを変えながら数回推論し、遅延初期化・カーネル選択・メモリ確保を済ませておく
+
+    torch.compile を使う場合は、ここでの推論がコンパイルを兼ねる。
+
+    Returns:
+        list: 長さ・バッチサイズごとの所要時間
+    """
+    timings = []
+    params = {"max_new_tokens": max_new_tokens, "do_sample": False}
+    for length, prompt in zip(lengths, warmup_prompts(pipe.tokenizer, lengths)):
+        for batch_size in batch_sizes:
+            start_time = time.time()
+            pipe([prompt] * batch_size, batch_size=batch_size, **params)
+            elapsed = time.time() - start_time
+            timings.append({"prompt_tokens": length, "batch_size": batch_size, "seconds": elapsed})
+            print(f"ウォームアップ: prompt_tokens={length}, batch_size={batch_size}, {elapsed:.2f}秒")
+        if speculative_decoder is not None:
+            # ドラフトモデルを使う経路も、最初のリクエストで初期化が走らないようにしておく
+            speculative_decoder.generate(prompt, params)
+    return timings
+
+
+def _artifact_path(cache_dir, model_name):
+    return os.path.join(cache_dir, model_name.replace("/", "--") + ".bin")
+
+
+def configure_compile_cache(cache_dir):
+    """TorchInductor のコンパイル結果をディスクに保存し、再起動後も再利用する設定にする"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+
+
+def compile_pipeline(pipe, model_name, mode, cache_dir):
+    """
+    パイプラインのモデルの forward を torch.compile する
+
+    前回の起動で保存したコンパイル結果があれば読み込んでから使う。失敗した場合はコンパイルせずに続ける。
+
+    Returns:
+        bool: コンパイルを有効にした場合は True
+    """
+    configure_compile_cache(cache_dir)
+    artifact_path = _artifact_path(cache_dir, model_name)
+    if os.path.exists(artifact_path):
+        try:
+            with open(artifact_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            print(f"torch.compile: 保存済みのコンパイル結果を読み込みました ({artifact_path})")
+        except Exception as e:
+            print(f"torch.compile: 保存済みのコンパイル結果を読み込めませんでした: {e}")
+    try:
+        # プロンプトの長さやバッチサイズが変わるたびに再コンパイルしないよう、動的な形状として扱う
+        pipe.model.forward = torch.compile(pipe.model.forward, mode=mode, dynamic=True)
+    except Exception as e:
+        print(f"torch.compile: コンパイルを有効にできませんでした。通常のモードで続けます: {e}")
+        return False
+    print(f"torch.compile: mode={mode} でコンパイルを有効にしました")
+    return True
+
+
+def save_compile_artifacts(cache_dir, model_name):
+    """ウォームアップでコンパイルした結果を、次回の起動で読み込めるように保存する"""
+    try:
+        artifacts = torch.compiler.save_cache_artifacts()
+    except Exception as e:
+        print(f"torch.compile: コンパイル結果を保存できませんでした: {e}")
+        return
+    if artifacts is None:
+        return
+    data, _ = artifacts
+    with open(_artifact_path(cache_dir, model_name), "wb") as f:
+        f.write(data)
+    print(f"torch.compile: コンパイル結果を保存しました ({len(data)}バイト)")
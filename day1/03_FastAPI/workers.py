@@ -0,0 +1,153 @@
+# workers.py
+# モデルを親プロセスで一度だけ読み込んでから複数の uvicorn ワーカーへ fork し、重みをコピーオンライトで共有する
+#
+# uvicorn の --workers は各ワーカーが別々にアプリを読み込むため、モデルのメモリがワーカー数倍になる。
+# ここでは読み込み済みのプロセスを fork するので、重み（テンソルのデータ）は書き換えない限り物理メモリ上で1つのまま共有され、
+# HTTP の解析・JSON の処理・スケジューリングだけを複数のコア（複数の GIL）に分散できる。
+# 応答キャッシュ・メトリクス・スケジューラは各ワーカーが別々に持つ（/metrics は応答したワーカーの値になる）。
+import gc
+import os
+import signal
+import socket
+import time
+import traceback
+
+import uvicorn
+
+# fork 後、ワーカーのメモリ使用量を表示するまでの時間（秒）
+MEMORY_REPORT_DELAY = 10.0
+
+
+def process_memory(pid="self"):
+    """
+    /proc/<pid>/smaps_rollup からプロセスのメモリ使用量を読む（Linux のみ）
+
+    Returns:
+        dict: rss（常駐量）、pss（共有ページをプロセス数で割った量）、shared（他のプロセスと共有しているページ）、
+            private（このプロセスだけのページ）のバイト数。読めない場合は None
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return {
+        "pid": os.getpid() if pid == "self" else pid,
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def memory_report(pids):
+    """ワーカーごとのメモリ使用量と、RSS の合計と実際の使用量（PSS の合計）を比べた結果"""
+    workers = [usage for usage in (process_memory(pid) for pid in pids) if usage is not None]
+    return {
+        "workers": workers,
+        "total_rss": sum(usage["rss"] for usage in workers),
+        "total_pss": sum(usage["pss"] for usage in workers),
+    }
+
+
+def print_memory_report(report):
+    gb = 1024 ** 3
+    print(f"{'pid':>8} {'RSS(GB)':>8} {'共有(GB)':>9} {'専有(GB)':>9} {'PSS(GB)':>8}")
+    for usage in report["workers"]:
+        print(
+            f"{usage['pid']:>8} {usage['rss'] / gb:>8.2f} {usage['shared'] / gb:>9.2f} "
+            f"{usage['private'] / gb:>9.2f} {usage['pss'] / gb:>8.2f}"
+        )
+    print(
+        f"RSSの合計: {report['total_rss'] / gb:.2f}GB, 実際の使用量（PSSの合計）: {report['total_pss'] / gb:.2f}GB"
+    )
+
+
+def bind_socket(host, port, backlog=2048):
+    """全ワーカーで共有する待ち受けソケットを親プロセスで作る"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_forked(app, host, port, workers, on_fork=None, log_level="info"):
+    """
+    読み込み済みのアプリを workers 個のプロセスへ fork し、同じソケットで待ち受ける
+
+    モデルの読み込みなど、共有したい状態は呼び出す前に済ませておく。fork 前にスレッドを起動しないこと
+    （スケジューラのスレッドプールなどは、各ワーカーの startup イベントで作られる）。
+
+    Args:
+        app: ASGI アプリ
+        workers (int): ワーカープロセスの数
+        on_fork (callable, optional): 各ワーカーで fork 直後に呼ばれる関数（引数はワーカー番号）
+    """
+    sock = bind_socket(host, port)
+    # 読み込み時に作られたオブジェクトを GC の対象外にし、ワーカーでの GC が参照カウント以外のページを書き換えないようにする
+    gc.collect()
+    gc.freeze()
+
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # ワーカープロセス: 親のシグナルハンドラを外して uvicorn に任せる
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                if on_fork is not None:
+                    on_fork(index)
+                uvicorn.Server(uvicorn.Config(app, log_level=log_level)).run(sockets=[sock])
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    sock.close()
+    print(f"{workers}個のワーカーを起動しました: pids={pids} (http://{host}:{port})")
+
+    stopping = False
+    report_requested = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def request_report(signum, frame):
+        nonlocal report_requested
+        report_requested = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    # kill -USR1 <親プロセスのpid> で、いつでもメモリ使用量を表示できる
+    signal.signal(signal.SIGUSR1, request_report)
+
+    report_at = time.time() + MEMORY_REPORT_DELAY
+    alive = set(pids)
+    while alive:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            alive.discard(pid)
+            if not stopping:
+                print(f"ワーカー {pid} が終了しました (status={status})")
+            continue
+        if report_requested or (report_at is not None and time.time() >= report_at):
+            print_memory_report(memory_report(sorted(alive)))
+            report_requested = False
+            report_at = None
+        time.sleep(0.5)
+    print("すべてのワーカーが終了しました。")